@@ -0,0 +1,291 @@
+"""
+Hot/cold tiering for the append-only tables.
+
+Messages of inactive threads (no activity for ARCHIVE_THREAD_IDLE_DAYS, no open ticket)
+and audit events older than ARCHIVE_AUDIT_DAYS are moved, in batches of about
+ARCHIVE_BATCH_ROWS, into gzip JSONL segment files under ARCHIVE_DIR. Each segment is
+written to a temp file and renamed into place; its archive_segments row and the delete
+of the hot rows then commit together. A crash can leave an orphan file, but never a
+manifest row without a file or rows lost from both tiers.
+
+Readers go through `archived_messages` / `query_audit_events`, which consult the
+in-memory segment catalog and read only the segments whose ranges overlap the request.
+Archiving usually runs in another process (the CLI), so every lookup first compares
+max(archive_segments.id) with the cached copy and reloads on a mismatch; hot rows are
+gone as soon as their segment row commits. The catalog is also reloaded every
+ARCHIVE_CATALOG_TTL_S regardless.
+
+    python -m app.archive run [--dry-run]
+    python -m app.archive audit --since 2025-01-01 [--event-type login]
+"""
+import argparse
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, func
+from sqlalchemy.orm import Session
+
+from .config import (ARCHIVE_DIR, ARCHIVE_THREAD_IDLE_DAYS, ARCHIVE_AUDIT_DAYS, ARCHIVE_BATCH_ROWS,
+                     ARCHIVE_CATALOG_TTL_S)
+from .models import ArchiveSegment, AuditEvent, Message, Ticket
+
+DELETE_CHUNK = 1000
+DECODED_SEGMENTS_MAX = 32
+
+
+def _encode(obj) -> Dict[str, Any]:
+    out = {}
+    for c in obj.__table__.columns:
+        v = getattr(obj, c.key)
+        out[c.key] = v.isoformat() if isinstance(v, datetime) else v
+    return out
+
+
+def _decode(model, row: Dict[str, Any]):
+    kw = {}
+    for c in model.__table__.columns:
+        v = row.get(c.key)
+        if v is not None and isinstance(c.type, DateTime):
+            v = datetime.fromisoformat(v)
+        kw[c.key] = v
+    return model(**kw)
+
+
+def write_segment(directory: str, kind: str, rows: List[Dict[str, Any]]) -> str:
+    """Write rows to a new segment file; returns its path relative to directory."""
+    rel = os.path.join(kind, f"{datetime.utcnow():%Y%m%d}-{rows[0]['id']}-{uuid.uuid4().hex[:8]}.jsonl.gz")
+    path = os.path.join(directory, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n")
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return rel
+
+
+class SegmentCatalog:
+    """Per-database (per-shard) copy of archive_segments plus a small LRU of decoded segment files."""
+
+    def __init__(self, directory: str = ARCHIVE_DIR, ttl_s: float = ARCHIVE_CATALOG_TTL_S):
+        self.directory, self.ttl_s = directory, ttl_s
+        self.lock = threading.Lock()
+        # 数据库 URL -> kind -> 段列表
+        self.segments: Dict[str, Dict[str, List[ArchiveSegment]]] = {}
+        self.loaded_at: Dict[str, float] = {}
+        # 数据库 URL -> 加载时的 max(archive_segments.id)
+        self.generation: Dict[str, Optional[int]] = {}
+        self.decoded: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = {}
+
+    def _ensure_loaded(self, db: Session) -> Dict[str, List[ArchiveSegment]]:
+        key = str(db.get_bind().url)
+        with self.lock:
+            t = self.loaded_at.get(key)
+            fresh = t is not None and time.monotonic() - t < self.ttl_s
+        # 段只增不删：max(id) 没变就说明缓存完整（主键上的 max，很便宜）
+        if fresh and db.query(func.max(ArchiveSegment.id)).scalar() == self.generation.get(key):
+            return self.segments[key]
+        segs = db.query(ArchiveSegment).order_by(ArchiveSegment.id_min.asc()).all()
+        by_kind: Dict[str, List[ArchiveSegment]] = {}
+        for s in segs:
+            db.expunge(s)
+            by_kind.setdefault(s.kind, []).append(s)
+        with self.lock:
+            self.segments[key], self.loaded_at[key] = by_kind, time.monotonic()
+            self.generation[key] = max((s.id for s in segs), default=None)
+        return by_kind
+
+    def find(self, db: Session, kind: str, key: Optional[int] = None, id_below: Optional[int] = None,
+             since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[ArchiveSegment]:
+        out = []
+        for s in self._ensure_loaded(db).get(kind, []):
+            if key is not None and not (s.key_min <= key <= s.key_max):
+                continue
+            if id_below is not None and s.id_min >= id_below:
+                continue
+            if since is not None and s.created_max < since:
+                continue
+            if until is not None and s.created_min >= until:
+                continue
+            out.append(s)
+        return out
+
+    def rows(self, seg: ArchiveSegment) -> List[Dict[str, Any]]:
+        with self.lock:
+            hit = self.decoded.get(seg.path)
+            if hit is not None:
+                self.decoded.move_to_end(seg.path)
+                return hit
+        with gzip.open(os.path.join(self.directory, seg.path), "rt", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        with self.lock:
+            self.decoded[seg.path] = rows
+            while len(self.decoded) > DECODED_SEGMENTS_MAX:
+                self.decoded.popitem(last=False)
+        return rows
+
+
+catalog = SegmentCatalog()
+
+
+def _commit_segment(db: Session, kind: str, model, objs: List[Any], key_min=None, key_max=None) -> int:
+    rows = [_encode(o) for o in objs]
+    path = write_segment(catalog.directory, kind, rows)
+    db.add(ArchiveSegment(kind=kind, path=path, row_count=len(rows),
+                          id_min=min(o.id for o in objs), id_max=max(o.id for o in objs),
+                          key_min=key_min, key_max=key_max,
+                          created_min=min(o.created_at for o in objs), created_max=max(o.created_at for o in objs),
+                          archived_at=datetime.utcnow()))
+    ids = [o.id for o in objs]
+    for i in range(0, len(ids), DELETE_CHUNK):
+        db.query(model).filter(model.id.in_(ids[i:i + DELETE_CHUNK])).delete(synchronize_session=False)
+    db.commit()
+    db.expunge_all()
+    return len(rows)
+
+
+def archive_messages(db: Session, now: Optional[datetime] = None, idle_days: int = ARCHIVE_THREAD_IDLE_DAYS,
+                     batch_rows: int = ARCHIVE_BATCH_ROWS, dry_run: bool = False) -> int:
+    """Move all messages of idle threads without an open ticket to cold storage."""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=idle_days)
+    open_threads = db.query(Ticket.thread_id).filter(Ticket.status == "open")
+    idle = (db.query(Message.thread_id, func.count(Message.id))
+            .filter(~Message.thread_id.in_(open_threads))
+            .group_by(Message.thread_id)
+            .having(func.max(Message.created_at) < cutoff)
+            .order_by(Message.thread_id.asc()).all())
+    if dry_run:
+        return sum(n for _, n in idle)
+
+    moved, batch, batch_n = 0, [], 0
+    for thread_id, n in idle + [(None, 0)]:
+        if thread_id is not None:
+            batch.append(thread_id)
+            batch_n += n
+        if batch and (batch_n >= batch_rows or thread_id is None):
+            objs = (db.query(Message).filter(Message.thread_id.in_(batch))
+                    .order_by(Message.thread_id.asc(), Message.id.asc()).all())
+            # 读出后又有新消息的 thread 不再空闲，留在热表
+            active = {m.thread_id for m in objs if m.created_at >= cutoff}
+            objs = [m for m in objs if m.thread_id not in active]
+            if objs:
+                moved += _commit_segment(db, "messages", Message, objs,
+                                         key_min=objs[0].thread_id, key_max=objs[-1].thread_id)
+            batch, batch_n = [], 0
+    catalog.invalidate()
+    return moved
+
+
+def archive_audit_events(db: Session, now: Optional[datetime] = None, days: int = ARCHIVE_AUDIT_DAYS,
+                         batch_rows: int = ARCHIVE_BATCH_ROWS, dry_run: bool = False) -> int:
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    if dry_run:
+        return db.query(func.count(AuditEvent.id)).filter(AuditEvent.created_at < cutoff).scalar()
+    moved = 0
+    while True:
+        objs = (db.query(AuditEvent).filter(AuditEvent.created_at < cutoff)
+                .order_by(AuditEvent.id.asc()).limit(batch_rows).all())
+        if not objs:
+            break
+        moved += _commit_segment(db, "audit_events", AuditEvent, objs)
+    catalog.invalidate()
+    return moved
+
+
+def archived_messages(db: Session, thread_id: int, before_id: Optional[int] = None,
+                      limit: int = 50) -> Tuple[List[Message], bool]:
+    """Newest `limit` archived messages of a thread older than before_id, oldest first; plus whether more exist."""
+    found: List[Dict[str, Any]] = []
+    for seg in catalog.find(db, "messages", key=thread_id, id_below=before_id):
+        found.extend(r for r in catalog.rows(seg)
+                     if r["thread_id"] == thread_id and (before_id is None or r["id"] < before_id))
+    found.sort(key=lambda r: r["id"])
+    more = len(found) > limit
+    return [_decode(Message, r) for r in found[-limit:]] if limit > 0 else [], more
+
+
+def has_archived_messages(db: Session, thread_id: int, before_id: Optional[int] = None) -> bool:
+    return bool(catalog.find(db, "messages", key=thread_id, id_below=before_id))
+
+
+def query_audit_events(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                       event_type: Optional[str] = None, actor_user_id: Optional[int] = None,
+                       limit: int = 1000) -> List[AuditEvent]:
+    """Audit events in [since, until), hot and archived, oldest first."""
+    q = db.query(AuditEvent)
+    if since is not None:
+        q = q.filter(AuditEvent.created_at >= since)
+    if until is not None:
+        q = q.filter(AuditEvent.created_at < until)
+    if event_type is not None:
+        q = q.filter(AuditEvent.event_type == event_type)
+    if actor_user_id is not None:
+        q = q.filter(AuditEvent.actor_user_id == actor_user_id)
+    hot = q.order_by(AuditEvent.created_at.asc(), AuditEvent.id.asc()).limit(limit).all()
+
+    cold = []
+    for seg in catalog.find(db, "audit_events", since=since, until=until):
+        for r in catalog.rows(seg):
+            e = _decode(AuditEvent, r)
+            if since is not None and e.created_at < since:
+                continue
+            if until is not None and e.created_at >= until:
+                continue
+            if event_type is not None and e.event_type != event_type:
+                continue
+            if actor_user_id is not None and e.actor_user_id != actor_user_id:
+                continue
+            cold.append(e)
+    out = sorted(cold + hot, key=lambda e: (e.created_at, e.id))
+    return out[:limit]
+
+
+def main():
+    from .shards import router
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run", help="archive idle threads and old audit events")
+    run.add_argument("--dry-run", action="store_true", help="only count what would move")
+    run.add_argument("--idle-days", type=int, default=ARCHIVE_THREAD_IDLE_DAYS)
+    run.add_argument("--audit-days", type=int, default=ARCHIVE_AUDIT_DAYS)
+    run.add_argument("--batch-rows", type=int, default=ARCHIVE_BATCH_ROWS)
+    run.add_argument("--shard", help="only this shard (default: every shard)")
+    audit = sub.add_parser("audit", help="print audit events (hot + archived) as JSONL")
+    audit.add_argument("--since", type=datetime.fromisoformat)
+    audit.add_argument("--until", type=datetime.fromisoformat)
+    audit.add_argument("--event-type")
+    audit.add_argument("--actor-user-id", type=int)
+    audit.add_argument("--limit", type=int, default=1000)
+    audit.add_argument("--shard", default="default")
+    a = ap.parse_args()
+
+    if a.cmd == "run":
+        for shard in router.all():
+            if a.shard and shard.name != a.shard:
+                continue
+            with shard.SessionLocal() as db:
+                m = archive_messages(db, idle_days=a.idle_days, batch_rows=a.batch_rows, dry_run=a.dry_run)
+                e = archive_audit_events(db, days=a.audit_days, batch_rows=a.batch_rows, dry_run=a.dry_run)
+            print(f"{shard.name}: {'would move' if a.dry_run else 'moved'} {m} messages, {e} audit events")
+    else:
+        with router.shards[a.shard].SessionLocal() as db:
+            for ev in query_audit_events(db, a.since, a.until, a.event_type, a.actor_user_id, a.limit):
+                print(json.dumps(_encode(ev), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
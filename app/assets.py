@@ -0,0 +1,183 @@
+"""
+In-memory cache for static files and the rendered /patient and /clinician pages.
+
+Everything is loaded once at import time: bytes, a content-hash ETag and gzip / brotli
+variants (brotli only if the `brotli` package is installed). Assets are also served under
+fingerprinted names (`/static/patient.<hash>.js`) with a one-year immutable lifetime;
+templates link to those via `asset_url()`. Plain names and pages are `no-cache` and
+revalidate with If-None-Match.
+
+`AssetMiddleware` answers these paths before the rest of the middleware stack, so a page
+reload never touches the DB.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, List, Optional, Tuple
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+try:
+    import brotli
+except ImportError:  # 可选依赖：没有就只提供 gzip
+    brotli = None
+
+STATIC_DIR = "app/static"
+TEMPLATE_DIR = "app/templates"
+STATIC_PREFIX = "/static/"
+PAGES = {"/patient": "patient.html", "/clinician": "clinician.html"}
+IMMUTABLE = b"public, max-age=31536000, immutable"
+REVALIDATE = b"no-cache"
+# 太小的文件压缩不划算
+MIN_COMPRESS = 256
+
+
+class Asset:
+    __slots__ = ("content_type", "etag", "variants", "cache_control")
+
+    def __init__(self, body: bytes, content_type: str, cache_control: bytes = REVALIDATE):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        self.etag = digest
+        # encoding -> (body, etag)；每种编码的 ETag 不同，避免中间缓存混用
+        self.variants: Dict[str, Tuple[bytes, bytes]] = {"identity": (body, f'"{digest}"'.encode())}
+        if len(body) >= MIN_COMPRESS and _compressible(content_type):
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                self.variants["gzip"] = (gz, f'"{digest}-gz"'.encode())
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.variants["br"] = (br, f'"{digest}-br"'.encode())
+
+    def immutable(self) -> "Asset":
+        other = Asset.__new__(Asset)
+        other.content_type, other.etag, other.variants = self.content_type, self.etag, self.variants
+        other.cache_control = IMMUTABLE
+        return other
+
+    def pick(self, accept_encoding: str) -> Tuple[str, bytes, bytes]:
+        accepted = _accepted(accept_encoding)
+        for enc in ("br", "gzip"):
+            if enc in self.variants and enc in accepted:
+                return (enc,) + self.variants[enc]
+        return ("identity",) + self.variants["identity"]
+
+
+def _compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type.split(";")[0] in (
+        "application/javascript", "application/json", "image/svg+xml")
+
+
+def _accepted(header: str) -> set:
+    out = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            out.add(name.strip().lower())
+    return out
+
+
+def _fingerprinted(name: str, digest: str) -> str:
+    base, ext = os.path.splitext(name)
+    return f"{base}.{digest[:12]}{ext}"
+
+
+class AssetCache:
+    def __init__(self, static_dir: str = STATIC_DIR, template_dir: str = TEMPLATE_DIR):
+        self.static_dir, self.template_dir = static_dir, template_dir
+        self.by_path: Dict[str, Asset] = {}
+        self.urls: Dict[str, str] = {}
+        self.load()
+
+    def load(self):
+        by_path: Dict[str, Asset] = {}
+        urls: Dict[str, str] = {}
+        for root, _, files in os.walk(self.static_dir):
+            for fn in sorted(files):
+                full = os.path.join(root, fn)
+                name = os.path.relpath(full, self.static_dir).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    body = f.read()
+                ctype = mimetypes.guess_type(fn)[0] or "application/octet-stream"
+                if ctype.startswith("text/") or ctype == "application/javascript":
+                    ctype += "; charset=utf-8"
+                asset = Asset(body, ctype)
+                by_path[STATIC_PREFIX + name] = asset
+                url = STATIC_PREFIX + _fingerprinted(name, asset.etag)
+                by_path[url] = asset.immutable()
+                urls[name] = url
+        self.urls = urls
+        env = Environment(loader=FileSystemLoader(self.template_dir), autoescape=select_autoescape(["html"]))
+        env.globals["asset_url"] = self.asset_url
+        for path, tpl in PAGES.items():
+            html = env.get_template(tpl).render().encode("utf-8")
+            by_path[path] = Asset(html, "text/html; charset=utf-8")
+        self.by_path = by_path
+
+    def asset_url(self, name: str) -> str:
+        return self.urls.get(name, STATIC_PREFIX + name)
+
+    def get(self, path: str) -> Optional[Asset]:
+        return self.by_path.get(path)
+
+
+def _header(scope, name: bytes) -> str:
+    for k, v in scope.get("headers", ()):
+        if k == name:
+            return v.decode("latin-1")
+    return ""
+
+
+def _etag_matches(if_none_match: str, asset: Asset) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        # 弱比较：任何编码变体的 ETag 都表示内容没变
+        if tag.strip('"').split("-")[0] == asset.etag:
+            return True
+    return False
+
+
+class AssetMiddleware:
+    """Pure ASGI: serves cached assets/pages for GET/HEAD and passes everything else through."""
+
+    def __init__(self, app, cache: "AssetCache"):
+        self.app, self.cache = app, cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return await self.app(scope, receive, send)
+        asset = self.cache.get(scope["path"])
+        if asset is None:
+            return await self.app(scope, receive, send)
+
+        enc, body, etag = asset.pick(_header(scope, b"accept-encoding"))
+        headers: List[Tuple[bytes, bytes]] = [
+            (b"etag", etag), (b"cache-control", asset.cache_control), (b"vary", b"Accept-Encoding")]
+        if _etag_matches(_header(scope, b"if-none-match"), asset):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        headers += [(b"content-type", asset.content_type.encode()), (b"content-length", str(len(body)).encode())]
+        if enc != "identity":
+            headers.append((b"content-encoding", enc.encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+
+
+asset_cache = AssetCache()
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .config import REALTIME_BACKPLANE, REALTIME_BACKPLANE_DIR
+from .metrics import BACKPLANE_DROPPED
+
+# data 为空串表示 gap 通知：该 stream 在 event_id 处丢了一帧，接收方应让客户端 reset
+Deliver = Callable[[str, int, int, str], None]
+
+log = logging.getLogger("nightingale.backplane")
+
+# 期望的单个 datagram 上限；实际值受 SO_SNDBUF（net.core.wmem_max）限制，start() 时按真实值收紧
+MAX_FRAME = 1024 * 1024
+# 内核按 skb 记账，SO_SNDBUF 里有一小段不能用于 payload
+DGRAM_OVERHEAD = 64
+DROP_LOG_INTERVAL_S = 10.0
+
+
+class Backplane:
+    """Carries (channel, key, event id, serialized frame) to the ConnectionManager of every worker."""
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+
+    def attach(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def publish(self, channel: str, key: int, event_id: int, data: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InProcessBackplane(Backplane):
+    """Default: single worker, frames go straight to the local manager."""
+
+    async def publish(self, channel: str, key: int, event_id: int, data: str):
+        self.deliver(channel, key, event_id, data)
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    Every worker binds a datagram socket in a shared directory and publishes by
+    sending the frame to each peer socket found there. Only needs a local
+    filesystem, so `uvicorn --workers N` on one host works without extra services.
+
+    Frames that cannot be sent (over the datagram limit, peer buffer full) are counted
+    in nightingale_backplane_dropped_frames_total and replaced by a gap notice (empty
+    data) for that stream, retried until the peer takes it.
+    """
+
+    def __init__(self, directory: str = REALTIME_BACKPLANE_DIR):
+        super().__init__()
+        self.directory = directory
+        self.path: Optional[str] = None
+        self.sock: Optional[socket.socket] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._peers: List[str] = []
+        self._peers_mtime = -1
+        self.max_frame = MAX_FRAME
+        # peer -> 尚未送达的 gap 通知 {(channel, key): event_id}
+        self._gaps: Dict[str, Dict[Tuple[str, int], int]] = {}
+        self._drop_logged: Dict[str, float] = {}
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.sock is not None and self.loop is loop:
+            return
+        await self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{id(self):x}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MAX_FRAME)
+        except OSError:
+            pass
+        # 超过发送缓冲区的 datagram 会 EMSGSIZE，按内核实际给的大小算上限
+        self.max_frame = min(MAX_FRAME, sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) - DGRAM_OVERHEAD)
+        self.sock, self.loop = sock, loop
+        loop.add_reader(sock.fileno(), self._on_readable)
+
+    async def publish(self, channel: str, key: int, event_id: int, data: str):
+        await self.start()
+        self.deliver(channel, key, event_id, data)
+        frame = f"{channel}\n{key}\n{event_id}\n".encode() + data.encode("utf-8")
+        too_large = len(frame) > self.max_frame
+        if too_large:
+            self._dropped("too_large", f"{channel}/{key}: {len(frame)} B frame over the {self.max_frame} B limit")
+        for peer in self._list_peers():
+            # 先送积压的 gap 通知，对端要先标记断档再收后续帧
+            if too_large:
+                sent = False
+            elif not self._send_gaps(peer):
+                sent = False
+                self._dropped("peer_busy", f"to {os.path.basename(peer)}")
+            else:
+                sent = self._send(peer, frame)
+            if not sent:
+                # 对端把这个 stream 标成断档：恢复中的客户端收到 reset，而不是缺帧的补发
+                self._gaps.setdefault(peer, {})[(channel, key)] = event_id
+                self._send_gaps(peer)
+
+    def _send(self, peer: str, frame: bytes) -> bool:
+        try:
+            self.sock.sendto(frame, peer)
+            return True
+        except (ConnectionRefusedError, FileNotFoundError):
+            # 进程已退出但留下了 socket 文件
+            self._forget(peer)
+            return True
+        except BlockingIOError:
+            # 对端接收缓冲区满：和慢 WebSocket 一样丢弃，但要记下来
+            self._dropped("peer_busy", f"to {os.path.basename(peer)}")
+        except OSError as e:
+            self._dropped("send_error", f"to {os.path.basename(peer)}: {e}")
+        return False
+
+    def _send_gaps(self, peer: str) -> bool:
+        """Flush pending gap notices to peer; False if some are still pending."""
+        gaps = self._gaps.get(peer)
+        while gaps:
+            (channel, key), event_id = next(iter(gaps.items()))
+            try:
+                self.sock.sendto(f"{channel}\n{key}\n{event_id}\n".encode(), peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._forget(peer)
+                return True
+            except OSError:
+                return False
+            del gaps[(channel, key)]
+        return True
+
+    def _dropped(self, reason: str, detail: str):
+        BACKPLANE_DROPPED.inc(reason)
+        now = time.monotonic()
+        if now - self._drop_logged.get(reason, -DROP_LOG_INTERVAL_S) >= DROP_LOG_INTERVAL_S:
+            self._drop_logged[reason] = now
+            log.warning("backplane frame dropped (%s): %s", reason, detail)
+
+    async def close(self):
+        if self.sock is None:
+            return
+        try:
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.remove_reader(self.sock.fileno())
+        finally:
+            self.sock.close()
+            self.sock = None
+            self.loop = None
+            if self.path and os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _on_readable(self):
+        while True:
+            try:
+                frame = self.sock.recv(MAX_FRAME + DGRAM_OVERHEAD)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                channel, key, event_id, data = frame.decode("utf-8").split("\n", 3)
+                self.deliver(channel, int(key), int(event_id), data)
+            except Exception:
+                continue
+
+    def _list_peers(self) -> List[str]:
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime != self._peers_mtime:
+            self._peers = [os.path.join(self.directory, n) for n in os.listdir(self.directory)
+                           if n.endswith(".sock")]
+            self._peers_mtime = mtime
+        return [p for p in self._peers if p != self.path]
+
+    def _forget(self, peer: str):
+        try:
+            os.unlink(peer)
+        except OSError:
+            pass
+        self._gaps.pop(peer, None)
+        self._peers_mtime = -1
+
+
+def make_backplane(kind: str = REALTIME_BACKPLANE) -> Backplane:
+    if kind == "memory":
+        return InProcessBackplane()
+    if kind == "unix":
+        return UnixSocketBackplane()
+    raise ValueError(f"unknown REALTIME_BACKPLANE: {kind}")
@@ -0,0 +1,351 @@
+"""
+Bulk onboarding import: NDJSON of users, threads and messages into one clinic.
+
+One JSON object per line:
+
+    {"type": "user", "email": "a@x.org", "role": "patient", "password": "..."}      # or "password_hash"
+    {"type": "thread", "patient_email": "a@x.org", "created_at": "2024-03-01T09:00:00"}
+    {"type": "message", "patient_email": "a@x.org", "sender_role": "patient",
+     "content": "I have a cough.", "created_at": "2024-03-01T09:01:00"}
+
+Lines are processed in batches of BULK_IMPORT_BATCH. Each batch commits once. Within a
+batch, users come first, then threads, then messages, so a batch can mix all three.
+Passwords are hashed on a thread pool; PBKDF2 releases the GIL. With `nlp=True`, patient
+messages go through redaction, risk and memory extraction on a process pool, and the
+extracted facts update memory_items in message order. The process pool is created on the
+first NLP import and shared by later ones; the app shuts it down on exit. Users whose email
+exists on any shard are skipped, not updated.
+
+    python -m app.bulk_import export.ndjson --clinic-id 1001 --nlp
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from .audit import log_event
+from .config import BULK_IMPORT_BATCH, BULK_IMPORT_WORKERS
+from .models import MemoryItem, Message, Thread, User, ROLE_ENUM, SENDER_ENUM
+from .nlp.memory import extract_memory_facts
+from .nlp.redaction import redact_no_phi
+from .nlp.risk import assess_risk
+from .security import hash_password
+from .services import apply_memory_facts
+from .shards import router
+
+MAX_ERRORS = 100
+
+# NLP 进程池：spawn 出的 worker 要重新 import 整个 app，按进程只建一次，各次导入共用
+_nlp_pool: Optional[ProcessPoolExecutor] = None
+_nlp_pool_lock = threading.Lock()
+
+
+def nlp_pool(workers: int) -> ProcessPoolExecutor:
+    """The shared NLP process pool, created on first use with `workers` processes."""
+    global _nlp_pool
+    with _nlp_pool_lock:
+        if _nlp_pool is None:
+            # spawn：在 web 进程里 fork 带线程/事件循环的进程不安全
+            _nlp_pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        return _nlp_pool
+
+
+def shutdown_nlp_pool():
+    global _nlp_pool
+    with _nlp_pool_lock:
+        pool, _nlp_pool = _nlp_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def analyze(text: str) -> Tuple[str, Dict, List[Dict]]:
+    """Per-message NLP, run in worker processes."""
+    return redact_no_phi(text), assess_risk(text), extract_memory_facts(text)
+
+
+def _ts(v) -> datetime:
+    if not v:
+        return datetime.utcnow()
+    if not isinstance(v, str):
+        raise ValueError(f"bad created_at {v!r}")
+    try:
+        return datetime.fromisoformat(v.rstrip("Z"))
+    except ValueError:
+        raise ValueError(f"bad created_at {v!r}") from None
+
+
+def _text(v) -> str:
+    return v.strip() if isinstance(v, str) else ""
+
+
+@dataclass
+class ImportReport:
+    lines: int = 0
+    users_created: int = 0
+    users_skipped: int = 0
+    threads_created: int = 0
+    messages: int = 0
+    memory_facts: int = 0
+    errors: List[Dict] = field(default_factory=list)
+    error_count: int = 0
+    elapsed_s: float = 0.0
+
+    def error(self, line: int, msg: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({"line": line, "error": msg})
+
+    def as_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in self.__dataclass_fields__}
+
+
+class BulkImporter:
+    def __init__(self, db: Session, clinic_id: int, actor_user_id: Optional[int] = None, nlp: bool = False,
+                 batch_size: int = BULK_IMPORT_BATCH, workers: int = BULK_IMPORT_WORKERS,
+                 progress: Optional[Callable[[ImportReport], None]] = None):
+        self.db, self.clinic_id, self.actor_user_id = db, clinic_id, actor_user_id
+        self.nlp, self.batch_size, self.progress = nlp, batch_size, progress
+        self.workers = workers or os.cpu_count() or 1
+        self.report = ImportReport()
+        # email -> (user_id, role)，跨批次复用
+        self.users: Dict[str, Tuple[int, str]] = {}
+        self.threads: Dict[int, int] = {}
+        self._batch: List[Tuple[int, Dict]] = []
+        self._t0 = time.perf_counter()
+        self._hash_pool: Optional[Executor] = None
+        self._nlp_pool: Optional[Executor] = None
+
+    def __enter__(self):
+        self._hash_pool = ThreadPoolExecutor(self.workers)
+        if self.nlp and self.workers > 1:
+            self._nlp_pool = nlp_pool(self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        if self._hash_pool is not None:
+            self._hash_pool.shutdown()
+
+    def run(self, lines: Iterable) -> ImportReport:
+        self.add_lines(lines)
+        return self.finish()
+
+    def add_lines(self, lines: Iterable):
+        """Feed NDJSON lines; full batches are imported as they fill up."""
+        for raw in lines:
+            self.report.lines += 1
+            if isinstance(raw, bytes):
+                raw = raw.decode("utf-8")
+            if not raw.strip():
+                continue
+            try:
+                rec = json.loads(raw)
+                if not isinstance(rec, dict):
+                    raise ValueError("not an object")
+            except ValueError as e:
+                self.report.error(self.report.lines, f"bad json: {e}")
+                continue
+            self._batch.append((self.report.lines, rec))
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def finish(self) -> ImportReport:
+        self._flush()
+        log_event(self.db, "bulk_import", actor_user_id=self.actor_user_id, target_type="clinic",
+                  target_id=self.clinic_id, meta={k: v for k, v in self.report.as_dict().items() if k != "errors"})
+        return self.report
+
+    def _flush(self):
+        if self._batch:
+            self.import_batch(self._batch)
+            self._batch = []
+        self.report.elapsed_s = round(time.perf_counter() - self._t0, 2)
+        if self.progress:
+            self.progress(self.report)
+
+    def import_batch(self, batch: List[Tuple[int, Dict]]):
+        by_type: Dict[str, List[Tuple[int, Dict]]] = {"user": [], "thread": [], "message": []}
+        for n, rec in batch:
+            t = rec.get("type")
+            if t not in by_type:
+                self.report.error(n, f"unknown type {t!r}")
+                continue
+            by_type[t].append((n, rec))
+        try:
+            self._users(by_type["user"])
+            rejected = self._threads(by_type["thread"] + by_type["message"])
+            self._messages([(n, r) for n, r in by_type["message"] if n not in rejected])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        self.db.expunge_all()
+
+    def _resolve_users(self, emails: Iterable[str]):
+        missing = {e for e in emails if e and e not in self.users}
+        if missing:
+            for u in self.db.query(User.id, User.email, User.role, User.clinic_id).filter(User.email.in_(missing)):
+                # 其他诊所的用户不能被导入数据引用
+                if (u.clinic_id or self.clinic_id) == self.clinic_id:
+                    self.users[u.email] = (u.id, u.role)
+
+    def _existing_emails(self, emails: List[str]) -> Set[str]:
+        """Emails already registered on any shard (login looks users up across all of them)."""
+        found = {e for (e,) in self.db.query(User.email).filter(User.email.in_(emails))}
+        bind = self.db.get_bind()
+        for shard in router.all():
+            if shard.engine is bind:
+                continue
+            with shard.SessionLocal() as db:
+                found.update(e for (e,) in db.query(User.email).filter(User.email.in_(emails)))
+        return found
+
+    def _users(self, recs: List[Tuple[int, Dict]]):
+        if not recs:
+            return
+        existing = self._existing_emails([_text(r.get("email")) for _, r in recs])
+        todo, seen = [], set()
+        for n, r in recs:
+            email, role = _text(r.get("email")), r.get("role", "patient")
+            if not email or role not in ROLE_ENUM:
+                self.report.error(n, "user needs email and role patient|clinician")
+                continue
+            try:
+                ts = _ts(r.get("created_at"))
+            except ValueError as e:
+                self.report.error(n, str(e))
+                continue
+            if email in existing or email in seen:
+                self.report.users_skipped += 1
+            else:
+                seen.add(email)
+                todo.append((email, role, ts, r))
+        # 没给密码的账号用随机密码，需走重置流程才能登录
+        plain = [_text(r.get("password")) or os.urandom(16).hex()
+                 for *_, r in todo if not _text(r.get("password_hash"))]
+        hashed = iter(self._hash_pool.map(hash_password, plain) if self._hash_pool else map(hash_password, plain))
+        users = [User(email=email, role=role, clinic_id=self.clinic_id, created_at=ts,
+                      password_hash=_text(r.get("password_hash")) or next(hashed)) for email, role, ts, r in todo]
+        self.db.add_all(users)
+        self.db.flush()
+        for u in users:
+            self.users[u.email] = (u.id, u.role)
+        self.report.users_created += len(users)
+
+    def _threads(self, recs: List[Tuple[int, Dict]]) -> Set[int]:
+        """Create missing threads; returns the line numbers rejected here (already reported)."""
+        self._resolve_users(_text(r.get("patient_email")) for _, r in recs)
+        want: Dict[int, datetime] = {}
+        rejected: Set[int] = set()
+        for n, r in recs:
+            u = self.users.get(_text(r.get("patient_email")))
+            if u is None or u[1] != "patient":
+                self.report.error(n, f"unknown patient {r.get('patient_email')!r}")
+                rejected.add(n)
+                continue
+            try:
+                ts = _ts(r.get("created_at"))
+            except ValueError as e:
+                self.report.error(n, str(e))
+                rejected.add(n)
+                continue
+            if u[0] not in self.threads:
+                want[u[0]] = min(want.get(u[0], ts), ts)
+        if not want:
+            return rejected
+        for tid, pid in self.db.query(Thread.id, Thread.patient_id).filter(Thread.patient_id.in_(list(want))):
+            self.threads[pid] = tid
+        new = [Thread(patient_id=pid, clinic_id=self.clinic_id, created_at=ts)
+               for pid, ts in want.items() if pid not in self.threads]
+        self.db.add_all(new)
+        self.db.flush()
+        for th in new:
+            self.threads[th.patient_id] = th.id
+        self.report.threads_created += len(new)
+        return rejected
+
+    def _messages(self, recs: List[Tuple[int, Dict]]):
+        rows: List[Dict] = []
+        for n, r in recs:
+            u = self.users[_text(r.get("patient_email"))]  # 无效行已被 _threads 剔除
+            role, content = r.get("sender_role", "patient"), r.get("content")
+            if role not in SENDER_ENUM or not content or not isinstance(content, str):
+                self.report.error(n, "message needs content and a valid sender_role")
+                continue
+            rows.append({"patient_id": u[0], "thread_id": self.threads[u[0]], "sender_role": role,
+                         "content": content, "created_at": _ts(r.get("created_at"))})
+        if not rows:
+            return
+        if not self.nlp:
+            # 不需要回填 memory 时走 executemany，不取回 id
+            self.db.execute(insert(Message), [{k: v for k, v in row.items() if k != "patient_id"} for row in rows])
+            self.report.messages += len(rows)
+            return
+
+        texts = [row["content"] for row in rows if row["sender_role"] == "patient"]
+        chunk = max(1, len(texts) // (self.workers * 4))
+        results = iter(self._nlp_pool.map(analyze, texts, chunksize=chunk) if self._nlp_pool else map(analyze, texts))
+        msgs, facts = [], []
+        for row in rows:
+            pid = row.pop("patient_id")
+            m = Message(**row)
+            if row["sender_role"] == "patient":
+                red, risk, f = next(results)
+                m.redacted_for_llm, m.risk_level, m.risk_reason = red, risk["risk_level"], risk["risk_reason"]
+                if f:
+                    facts.append((pid, m, f))
+            msgs.append(m)
+        self.db.add_all(msgs)
+        self.db.flush()
+        self.report.messages += len(msgs)
+
+        # 按消息顺序回放 memory 变化；每批只查一次 active 条目
+        pids = {pid for pid, _, _ in facts}
+        active: Dict[int, List[MemoryItem]] = {pid: [] for pid in pids}
+        if pids:
+            for item in self.db.query(MemoryItem).filter(MemoryItem.patient_id.in_(pids), MemoryItem.status == "active"):
+                active[item.patient_id].append(item)
+        for pid, m, f in facts:
+            apply_memory_facts(self.db, pid, m.id, f, active[pid])
+            self.report.memory_facts += len(f)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("path", help="NDJSON file, or - for stdin")
+    ap.add_argument("--clinic-id", type=int, required=True)
+    ap.add_argument("--nlp", action="store_true", help="run redaction, risk and memory extraction on patient messages")
+    ap.add_argument("--batch-size", type=int, default=BULK_IMPORT_BATCH)
+    ap.add_argument("--workers", type=int, default=BULK_IMPORT_WORKERS, help="0 = one per CPU")
+    a = ap.parse_args()
+
+    def progress(r: ImportReport):
+        rate = r.messages / r.elapsed_s if r.elapsed_s else 0
+        print(f"\r{r.lines} lines  {r.users_created} users  {r.messages} messages  {r.error_count} errors  "
+              f"{rate:.0f} msg/s", end="", file=sys.stderr, flush=True)
+
+    f = sys.stdin if a.path == "-" else open(a.path, encoding="utf-8")
+    try:
+        session = router.for_clinic(a.clinic_id).SessionLocal
+        with session() as db, BulkImporter(db, a.clinic_id, nlp=a.nlp, batch_size=a.batch_size,
+                                           workers=a.workers, progress=progress) as imp:
+            report = imp.run(f)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        shutdown_nlp_pool()
+    print(file=sys.stderr)
+    print(json.dumps(report.as_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,101 @@
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from .config import DATABASE_URL
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool, StaticPool
+from .config import (DATABASE_URL, ASYNC_DATABASE_URL, DATABASE_READ_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE_S,
+                     DB_POOL_TIMEOUT_S, READ_YOUR_WRITES_S)
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, future=True)
+
+class PoolWaitStats:
+    """How long checkouts waited for a free pooled connection."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.timeouts = 0
+
+    def record(self, waited_s: float, timed_out: bool = False):
+        with self.lock:
+            self.count += 1
+            self.total_s += waited_s
+            self.max_s = max(self.max_s, waited_s)
+            self.timeouts += int(timed_out)
+
+
+class TimedQueuePool(QueuePool):
+    stats: PoolWaitStats
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeout:
+            self.stats.record(time.perf_counter() - t0, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - t0)
+        return conn
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def make_engine(url: str, name: str) -> Engine:
+    if url.startswith("sqlite"):
+        # 测试用 SQLite：内存库必须共享同一个连接，否则每个线程看到的是不同的库
+        kwargs = {"connect_args": {"check_same_thread": False}}
+        if ":memory:" in url or url.split("://", 1)[-1] in ("", "/"):
+            kwargs["poolclass"] = StaticPool
+        return create_engine(url, future=True, **kwargs)
+    # 每个 engine 一个子类，这样 pool 被 recreate() 后统计仍然保留
+    pool_cls = type(f"{name.title()}QueuePool", (TimedQueuePool,), {"stats": PoolWaitStats(name)})
+    return create_engine(url, poolclass=pool_cls, pool_pre_ping=True, future=True,
+                         pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                         pool_recycle=DB_POOL_RECYCLE_S, pool_timeout=DB_POOL_TIMEOUT_S)
+
+
+_ASYNC_DRIVERS = {"mysql+pymysql": "mysql+aiomysql", "mysql": "mysql+aiomysql",
+                  "sqlite+pysqlite": "sqlite+aiosqlite", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return _ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+def make_async_engine(url: str, name: str) -> AsyncEngine:
+    if url.startswith("sqlite"):
+        # aiosqlite 连接绑定在创建它的事件循环上，不跨请求复用；SQLite 需要文件库才能和同步 engine 共享数据
+        return create_async_engine(url, poolclass=NullPool)
+    # 和同步池分开计数：pool_stats / /metrics 里是 <name>_async
+    pool_cls = type(f"{name.title()}AsyncQueuePool", (TimedAsyncQueuePool,),
+                    {"stats": PoolWaitStats(f"{name}_async")})
+    return create_async_engine(url, poolclass=pool_cls, pool_pre_ping=True,
+                               pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                               pool_recycle=DB_POOL_RECYCLE_S, pool_timeout=DB_POOL_TIMEOUT_S)
+
+
+engine = make_engine(DATABASE_URL, "primary")
+read_engine = make_engine(DATABASE_READ_URL, "replica") if DATABASE_READ_URL else engine
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, future=True)
+ReadSessionLocal = sessionmaker(bind=read_engine, autocommit=False, autoflush=False, future=True)
+
+# async def 路由用 AsyncSession，查询不阻塞事件循环；现有的同步 helper 通过 run_sync 复用
+async_engine = make_async_engine(ASYNC_DATABASE_URL or async_url(DATABASE_URL), "primary")
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
 def get_db():
     db = SessionLocal()
@@ -15,3 +103,119 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# -------------------------
+# Per-request SQL accounting
+# -------------------------
+class QueryStats:
+    __slots__ = ("count", "total_s")
+
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+
+
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+def start_query_stats() -> QueryStats:
+    """Begin counting statements for the current request/task (the middleware calls this)."""
+    qs = QueryStats()
+    _query_stats.set(qs)
+    return qs
+
+
+# 挂在 Engine 类上：主库、副本以及 async engine 底层的 sync_engine 都会计数
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_t0", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    t0 = conn.info["query_t0"].pop()
+    qs = _query_stats.get()
+    if qs is not None:
+        qs.count += 1
+        qs.total_s += time.perf_counter() - t0
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(ctx):
+    stack = ctx.connection.info.get("query_t0") if ctx.connection is not None else None
+    if stack:
+        stack.pop()
+
+
+# -------------------------
+# Read routing
+# -------------------------
+# user_id -> 截止时间（monotonic）。只在本进程内有效：多 worker 时其他进程可能短暂读到副本旧数据
+_recent_writes: Dict[int, float] = {}
+_recent_lock = threading.Lock()
+
+
+def mark_write(user_id: Optional[int]):
+    if user_id is None or read_engine is engine:
+        return
+    now = time.monotonic()
+    with _recent_lock:
+        _recent_writes[user_id] = now + READ_YOUR_WRITES_S
+        if len(_recent_writes) > 10000:
+            for uid in [k for k, v in _recent_writes.items() if v < now]:
+                del _recent_writes[uid]
+
+
+def read_sessionmaker(user_id: Optional[int]) -> sessionmaker:
+    """Replica unless this user wrote within READ_YOUR_WRITES_S."""
+    if ReadSessionLocal is SessionLocal or user_id is None:
+        return ReadSessionLocal
+    deadline = _recent_writes.get(user_id)
+    if deadline is not None and deadline > time.monotonic():
+        return SessionLocal
+    return ReadSessionLocal
+
+
+def _token_user_id(token: str) -> Optional[int]:
+    from .security import decode_token
+    try:
+        return int(decode_token(token)["sub"])
+    except Exception:
+        return None
+
+
+def get_read_db(token: str = ""):
+    """Dependency for read-only endpoints; routes by the token's user without a DB lookup."""
+    db = read_sessionmaker(_token_user_id(token))()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# 其他分片的 engine（app/shards.py 注册，async engine 以 <name>_async 注册），一并出现在 pool_stats 里
+extra_engines: Dict[str, Engine] = {}
+
+
+def pool_stats() -> List[Dict]:
+    out = []
+    for name, eng in (("primary", engine), ("primary_async", async_engine.sync_engine), ("replica", read_engine),
+                      *extra_engines.items()):
+        if name == "replica" and eng is engine:
+            continue
+        pool = eng.pool
+        row = {"name": name, "pool": type(pool).__name__}
+        stats = getattr(pool, "stats", None)
+        if isinstance(pool, QueuePool):
+            row.update({"size": pool.size(), "checked_out": pool.checkedout(), "overflow": pool.overflow()})
+        if stats is not None:
+            row.update({"checkouts": stats.count, "wait_total_ms": round(stats.total_s * 1000, 3),
+                        "wait_avg_ms": round(stats.total_s * 1000 / stats.count, 3) if stats.count else 0.0,
+                        "wait_max_ms": round(stats.max_s * 1000, 3), "timeouts": stats.timeouts})
+        out.append(row)
+    return out
@@ -0,0 +1,78 @@
+"""
+JSON encoding for the read-heavy paths (message polls, WebSocket frames, ticket queue).
+
+Uses orjson when it is installed and the stdlib otherwise; both produce compact UTF-8.
+A message never changes after it is written, so its encoded form is cached by id in
+`message_cache`. List responses are then spliced together from those fragments, so rows
+are not re-encoded on every poll. Endpoints return the bytes directly (`json_response`),
+which skips FastAPI's jsonable_encoder pass.
+"""
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional
+
+from starlette.responses import Response
+
+from .config import MESSAGE_JSON_CACHE_MAX
+
+try:
+    import orjson
+except ImportError:  # 可选依赖：没有就用标准库
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def splice(obj: Dict[str, Any], key: str, fragments: Iterable[bytes]) -> bytes:
+    """dumps(obj) with obj[key] replaced by a JSON array of already encoded items."""
+    head = dumps({key: None})[:-5]  # b'{"key":'
+    # key 放在最前面，编码结果必然以 head + null 开头
+    rest = dumps({key: None, **{k: v for k, v in obj.items() if k != key}})
+    return head + b"[" + b",".join(fragments) + b"]" + rest[len(head) + 4:]
+
+
+def encode_items(items: Iterable[Any]) -> list:
+    return [i if isinstance(i, bytes) else dumps(i) for i in items]
+
+
+class FragmentCache:
+    """Bounded LRU of encoded JSON values for immutable rows."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key: Optional[Hashable], build: Callable[[], Any]) -> bytes:
+        if key is None:
+            return dumps(build())
+        with self.lock:
+            hit = self.items.get(key)
+            if hit is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return hit
+            self.misses += 1
+        data = dumps(build())
+        with self.lock:
+            self.items[key] = data
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        return data
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+message_cache = FragmentCache(MESSAGE_JSON_CACHE_MAX)
+
+
+def json_response(body: bytes, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
@@ -1,6 +1,7 @@
 
 import hashlib
 from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from .models import RequestFingerprint
 from .audit import log_event
@@ -14,7 +15,13 @@ def check_and_record_ip(db: Session, ip: str, strike_on_every_request: bool=Fals
     now=datetime.utcnow()
     if not fp:
         fp=RequestFingerprint(kind="ip", fingerprint_hash=h, strikes=0, blocked_until=None, last_seen=now)
-        db.add(fp); db.commit()
+        db.add(fp)
+        try:
+            db.commit()
+        except IntegrityError:
+            # 同一新 IP 的并发首个请求：另一个已经插入
+            db.rollback()
+            fp=db.query(RequestFingerprint).filter_by(kind="ip", fingerprint_hash=h).first()
     if fp.blocked_until and fp.blocked_until > now:
         return False, fp.blocked_until
     if strike_on_every_request:
@@ -0,0 +1,26 @@
+
+import asyncio
+import weakref
+
+import httpx
+
+from .config import HTTP_MAX_CONNECTIONS
+
+# 每个事件循环一个共享 client：复用 keep-alive 连接，不再每次调用都新建 TCP 连接
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    c = _clients.get(loop)
+    if c is None or c.is_closed:
+        c = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                                               max_keepalive_connections=HTTP_MAX_CONNECTIONS))
+        _clients[loop] = c
+    return c
+
+
+async def close_http_client():
+    c = _clients.pop(asyncio.get_running_loop(), None)
+    if c is not None:
+        await c.aclose()
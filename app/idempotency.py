@@ -0,0 +1,202 @@
+
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import IDEMPOTENCY_TTL_S, IDEMPOTENCY_CACHE_MAX, IDEMPOTENCY_WAIT_S
+from .models import IdempotencyRecord
+
+MAX_KEY_LEN = 128
+POLL_S = 0.2
+PURGE_EVERY_S = 60
+
+log = logging.getLogger("nightingale.idempotency")
+
+
+def request_hash(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else str(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Replays the first response for a repeated (user, Idempotency-Key).
+
+    Lookup order: in-process LRU of finished responses, then an in-flight future for
+    concurrent duplicates in this process, then the idempotency_keys table, which also
+    covers other workers. A row with no response is a claim held by a running request.
+
+    The store fails open: if the table cannot be read or written (missing migration, DB
+    error) the request is processed without cross-worker dedupe and a warning is logged.
+    """
+
+    def __init__(self, ttl_s: int = IDEMPOTENCY_TTL_S, maxsize: int = IDEMPOTENCY_CACHE_MAX,
+                 wait_s: float = IDEMPOTENCY_WAIT_S):
+        self.ttl_s, self.maxsize, self.wait_s = ttl_s, maxsize, wait_s
+        self.cache: "OrderedDict[Tuple[int, str], Tuple[float, str, Dict]]" = OrderedDict()
+        self.inflight: Dict[Tuple[int, str], Tuple[str, asyncio.Future]] = {}
+        self._last_purge = 0.0
+
+    async def run(self, db: AsyncSession, user_id: int, key: Optional[str], req_hash: str,
+                  handler: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, bool]:
+        """Returns (response, replayed)."""
+        if not key:
+            return await handler(), False
+        if len(key) > MAX_KEY_LEN:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key longer than {MAX_KEY_LEN}")
+        k = (user_id, key)
+
+        hit = self._cached(k)
+        if hit is not None:
+            self._check(hit[0], req_hash)
+            return hit[1], True
+
+        inflight = self.inflight.get(k)
+        if inflight is not None and inflight[1].get_loop() is asyncio.get_running_loop():
+            self._check(inflight[0], req_hash)
+            return await asyncio.shield(inflight[1]), True
+
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[k] = (req_hash, fut)
+        try:
+            try:
+                resp = await self._claim_or_wait(db, user_id, key, req_hash)
+            except SQLAlchemyError:
+                # 存储不可用：照常处理（只剩进程内去重），不因去重失败返回 500
+                await self._unavailable(db, "claim")
+                resp = jsonable_encoder(await handler())
+                self._remember(k, req_hash, resp)
+                fut.set_result(resp)
+                return resp, False
+            if resp is not None:
+                fut.set_result(resp)
+                return resp, True
+            try:
+                resp = jsonable_encoder(await handler())
+            except BaseException:
+                await self._release(db, user_id, key)
+                raise
+            await self._complete(db, user_id, key, resp)
+            self._remember(k, req_hash, resp)
+            fut.set_result(resp)
+            return resp, False
+        except BaseException as e:
+            if not fut.done():
+                if isinstance(e, asyncio.CancelledError):
+                    fut.cancel()
+                else:
+                    # 并发的重复请求拿到同样的错误
+                    fut.set_exception(e)
+                    fut.exception()
+            raise
+        finally:
+            self.inflight.pop(k, None)
+
+    def _check(self, stored_hash: str, req_hash: str):
+        if stored_hash != req_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+
+    def _cached(self, k) -> Optional[Tuple[str, Dict]]:
+        hit = self.cache.get(k)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del self.cache[k]
+            return None
+        self.cache.move_to_end(k)
+        return hit[1], hit[2]
+
+    def _remember(self, k, req_hash: str, resp: Dict):
+        self.cache[k] = (time.monotonic() + self.ttl_s, req_hash, resp)
+        self.cache.move_to_end(k)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    async def _claim_or_wait(self, db: AsyncSession, user_id: int, key: str, req_hash: str) -> Optional[Dict]:
+        """None once we hold the claim; otherwise the stored response of the first request."""
+        await self._purge(db)
+        deadline = time.monotonic() + self.wait_s
+        while True:
+            row = (await db.execute(
+                select(IdempotencyRecord).filter_by(user_id=user_id, idem_key=key)
+                .execution_options(populate_existing=True))).scalars().first()
+            now = datetime.utcnow()
+            if row is not None:
+                age = (now - row.created_at).total_seconds()
+                # 过期的结果，或持有者早已超时（进程挂了）的占位，都可以接管
+                if age > self.ttl_s or (row.response_json is None and age > self.wait_s):
+                    await db.delete(row)
+                    await db.commit()
+                    row = None
+            if row is not None:
+                self._check(row.request_hash, req_hash)
+                if row.response_json is not None:
+                    self._remember((user_id, key), req_hash, row.response_json)
+                    return row.response_json
+            else:
+                db.add(IdempotencyRecord(user_id=user_id, idem_key=key, request_hash=req_hash,
+                                         response_json=None, created_at=now))
+                try:
+                    await db.commit()
+                    return None
+                except IntegrityError:
+                    await db.rollback()
+                    continue
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(POLL_S)
+
+    async def _complete(self, db: AsyncSession, user_id: int, key: str, resp: Dict):
+        try:
+            row = (await db.execute(
+                select(IdempotencyRecord).filter_by(user_id=user_id, idem_key=key))).scalars().first()
+            if row is not None:
+                row.response_json = resp
+                await db.commit()
+        except SQLAlchemyError:
+            # 请求已经处理完，结果照常返回；占位超过 wait_s 后可被接管
+            await self._unavailable(db, "complete")
+
+    async def _release(self, db: AsyncSession, user_id: int, key: str):
+        # 首个请求失败：删掉占位，重试可以重新执行
+        try:
+            await db.rollback()
+            await db.execute(delete(IdempotencyRecord).where(IdempotencyRecord.user_id == user_id,
+                                                             IdempotencyRecord.idem_key == key,
+                                                             IdempotencyRecord.response_json.is_(None)))
+            await db.commit()
+        except SQLAlchemyError:
+            await self._unavailable(db, "release")
+
+    async def _unavailable(self, db: AsyncSession, step: str):
+        log.warning("idempotency store unavailable during %s; processing without cross-worker dedupe",
+                    step, exc_info=True)
+        try:
+            await db.rollback()
+        except SQLAlchemyError:
+            pass
+
+    async def _purge(self, db: AsyncSession):
+        now = time.monotonic()
+        if now - self._last_purge < PURGE_EVERY_S:
+            return
+        self._last_purge = now
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_s)
+        await db.execute(delete(IdempotencyRecord).where(IdempotencyRecord.created_at < cutoff))
+        await db.commit()
+
+
+idempotency = IdempotencyStore()
@@ -1,11 +1,12 @@
 
-import httpx
 from ..config import OLLAMA_BASE_URL, OLLAMA_MODEL
+from ..metrics import upstream
+from ..http_client import http_client
 
 async def ollama_generate(prompt: str) -> str:
     url=f"{OLLAMA_BASE_URL.rstrip('/')}/api/generate"
     payload={"model": OLLAMA_MODEL, "prompt": prompt, "stream": False}
-    async with httpx.AsyncClient(timeout=60) as client:
-        r=await client.post(url, json=payload)
+    with upstream("ollama"):
+        r=await http_client().post(url, json=payload, timeout=60)
         r.raise_for_status()
         return r.json().get("response","").strip()
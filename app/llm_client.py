@@ -1,5 +1,7 @@
 import os
-import httpx
+
+from .http_client import http_client
+from .metrics import upstream
 
 LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://host.docker.internal:11434")
 LLM_MODEL = os.getenv("LLM_MODEL", "llama3.1")
@@ -26,8 +28,8 @@ async def generate_reply(history_messages, patient_text: str) -> str:
         "stream": False
     }
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(f"{LLM_BASE_URL}/api/chat", json=payload)
+    with upstream("llm_chat"):
+        r = await http_client().post(f"{LLM_BASE_URL}/api/chat", json=payload, timeout=60)
         r.raise_for_status()
         data = r.json()
 
@@ -1,26 +1,43 @@
 
+import asyncio
+import hashlib
+import logging
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
-from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect, UploadFile, File
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from .db import engine, Base, get_db, SessionLocal
+from .startup import readiness
+from .db import AsyncSessionLocal, mark_write, pool_stats, start_query_stats
+from .shards import router, get_db, get_read_db, get_async_db
 from .models import User, Thread, Message, Ticket
 from .security import hash_password, verify_password, create_token, decode_token
 from .audit import log_event
 from .fingerprint import check_and_record_ip
 from .realtime import manager
+from .profile_delta import profile_versions, flatten_profile, profile_version
 from .nlp.redaction import redact_no_phi
 from .nlp.risk import assess_risk
-from .services import upsert_memory, profile_snapshot, create_ticket
+from .services import upsert_memory, profile_snapshot, escalate
+from .ticket_index import ticket_index, ticket_summary
+from .config import TICKET_PAGE_MAX, SQL_QUERY_WARN, ARCHIVE_FILL_MESSAGES, MESSAGE_PAGE_MAX
+from .bulk_import import BulkImporter, shutdown_nlp_pool
+from .assets import asset_cache, AssetMiddleware
+from .archive import archived_messages, has_archived_messages
+from .idempotency import idempotency, request_hash
+from .fastjson import message_cache, dumps as json_bytes, splice, json_response
+from .metrics import registry, stage, Gauge, HTTP_SECONDS, HTTP_SQL_STATEMENTS
 from .voice.asr_client import transcribe_audio
+from .http_client import close_http_client
 
-# 你的 LLM 接口：确保这里函数名就是 generate_reply(messages: List[dict]) -> str
+# 你的 LLM 接口：async generate_reply(history_messages: List[dict], patient_text: str) -> str
+# history 不含当前这条患者消息，patient_text 是它脱敏后的文本
 from app.llm_client import generate_reply
 
 
@@ -28,27 +45,43 @@ from app.llm_client import generate_reply
 # App init (必须在所有 @app.xxx 之前)
 # -------------------------
 app = FastAPI(title="Nightingale Closed Loop")
-templates = Jinja2Templates(directory="app/templates")
+log = logging.getLogger("nightingale")
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
+manager.on_clinic_event(ticket_index.on_clinic_event)
 
 import time
 from sqlalchemy import text
-from sqlalchemy.exc import OperationalError
+
 
 @app.on_event("startup")
-def on_startup():
-    # 等待 MySQL 真正可连接（避免 compose 刚启动就 create_all 导致 app 崩溃）
-    last_err = None
-    for _ in range(30):  # 最多等 30 秒
-        try:
-            with engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
-            Base.metadata.create_all(bind=engine)
-            return
-        except OperationalError as e:
-            last_err = e
-            time.sleep(1)
-    raise last_err
+async def start_readiness():
+    # 不阻塞启动：DB 探测/schema 校验/预热在后台跑，/readyz 在完成前返回 503
+    readiness.start()
+
+
+@app.on_event("shutdown")
+async def stop_readiness():
+    await readiness.stop()
+    await close_http_client()
+
+
+@app.on_event("startup")
+async def start_realtime():
+    # 多 worker 时尽早加入 backplane，才能收到其他进程的广播
+    await manager.start()
+
+
+@app.on_event("shutdown")
+async def stop_bulk_import():
+    # 共享的 NLP 进程池：等 worker 退出，避免留下孤儿进程
+    await run_in_threadpool(shutdown_nlp_pool)
+
+
+@app.on_event("shutdown")
+async def stop_realtime():
+    # 先把合并窗口里还没发出的 thread 帧发掉，再关 backplane
+    await manager.flush()
+    await manager.backplane.close()
 
 
 DEMO_CLINIC_ID = 1001
@@ -70,6 +103,8 @@ class LoginIn(BaseModel):
 
 class SendMessageIn(BaseModel):
     text: str
+    # 也可以用 Idempotency-Key 头；重试时带同一个值
+    client_request_id: Optional[str] = None
 
 
 class ClinicianReplyIn(BaseModel):
@@ -97,20 +132,55 @@ def seed_demo(db: Session):
             clinic_id=DEMO_CLINIC_ID
         ))
     db.commit()
+    global _demo_seeded
+    _demo_seeded = True
+
+
+# demo 账号每个进程只检查一次，而不是每个请求两次 SELECT
+_demo_seeded = False
+
+
+def _seed_demo_once():
+    if not _demo_seeded:
+        with router.for_clinic(DEMO_CLINIC_ID).SessionLocal() as db:
+            seed_demo(db)
+
+
+readiness.warmups.append(_seed_demo_once)
+# 探针不碰数据库中间件：DB 没起来时 /healthz 也要能回答
+PROBE_PATHS = ("/healthz", "/readyz")
 
 
 @app.middleware("http")
 async def middleware(request: Request, call_next):
-    db = SessionLocal()
-    try:
+    if request.url.path in PROBE_PATHS:
+        return await call_next(request)
+    t0 = time.perf_counter()
+    qs = start_query_stats()
+    async with AsyncSessionLocal() as db:
         ip = request.client.host if request.client else "unknown"
-        ok, blocked_until = check_and_record_ip(db, ip, strike_on_every_request=False)
+        ok, blocked_until = await db.run_sync(check_and_record_ip, ip, False)
         if not ok:
             raise HTTPException(status_code=429, detail=f"Blocked until {blocked_until.isoformat()}Z")
-        seed_demo(db)
-    finally:
-        db.close()
-    return await call_next(request)
+    if not _demo_seeded:
+        await run_in_threadpool(_seed_demo_once)
+    response = await call_next(request)
+    # 每个请求的 SQL 条数/耗时，便于发现 N+1
+    response.headers["X-DB-Queries"] = str(qs.count)
+    response.headers["X-DB-Time-Ms"] = f"{qs.total_s * 1000:.1f}"
+    if SQL_QUERY_WARN and qs.count > SQL_QUERY_WARN:
+        log.warning("%s %s issued %d SQL statements (%.1f ms)", request.method, request.url.path,
+                    qs.count, qs.total_s * 1000)
+    # 用路由模板做 label（/api/clinician/tickets/{ticket_id}），避免 label 基数爆炸
+    route = request.scope.get("route")
+    route = getattr(route, "path", None) or "unmatched"
+    HTTP_SECONDS.observe(time.perf_counter() - t0, request.method, route, str(response.status_code))
+    HTTP_SQL_STATEMENTS.observe(qs.count, route)
+    return response
+
+
+# 后注册的在最外层：静态资源和页面在 DB 中间件之前直接从内存返回
+app.add_middleware(AssetMiddleware, cache=asset_cache)
 
 
 def auth_user(token: str, db: Session) -> User:
@@ -159,6 +229,11 @@ def serialize_message(m: Message) -> Dict[str, Any]:
     }
 
 
+def message_json(m: Message) -> bytes:
+    # 消息写入后不再修改：按 id 缓存编码结果，轮询/广播直接拼接
+    return message_cache.get(m.id, lambda: serialize_message(m))
+
+
 def serialize_ticket(t: Ticket) -> Dict[str, Any]:
     return {
         "id": t.id,
@@ -170,10 +245,17 @@ def serialize_ticket(t: Ticket) -> Dict[str, Any]:
         "risk_level": t.risk_level,
         "triage_summary": t.triage_summary_json,
         "profile_snapshot": t.profile_snapshot_json,
+        "escalation_count": t.escalation_count or 1,
         "created_at": t.created_at.isoformat() + "Z",
+        "updated_at": (t.updated_at or t.created_at).isoformat() + "Z",
     }
 
 
+def profile_delta(db: Session, patient_id: int) -> Dict[str, Any]:
+    # WS 只推送相对上一次推送的 profile 变更，不再每条消息带全量快照
+    return profile_versions.delta(patient_id, profile_snapshot(db, patient_id))
+
+
 def build_llm_messages(db: Session, thread_id: int, limit: int = 12) -> List[Dict[str, str]]:
     """
     从 DB 取上下文，拼给 LLM。优先用 redacted_for_llm。
@@ -206,48 +288,56 @@ def build_llm_messages(db: Session, thread_id: int, limit: int = 12) -> List[Dic
 
 
 # -------------------------
-# Pages
+# Auth
 # -------------------------
-@app.get("/patient", response_class=HTMLResponse)
-def patient_ui(request: Request):
-    return templates.TemplateResponse("patient.html", {"request": request})
-
-
-@app.get("/clinician", response_class=HTMLResponse)
-def clinician_ui(request: Request):
-    return templates.TemplateResponse("clinician.html", {"request": request})
+def find_user_by_email(email: str):
+    """(session, user) from the shard that owns the user's clinic, or (None, None). Caller closes the session."""
+    # 登录前不知道诊所：逐个分片查；单分片时就是一次查询
+    for shard in router.all():
+        db = shard.SessionLocal()
+        u = db.query(User).filter_by(email=email).first()
+        # 迁移刚切换、源分片还没删完时，只认目录指向的那一份
+        if u is not None and router.locate(u.clinic_id)[0] == shard.name:
+            return db, u
+        db.close()
+    return None, None
 
 
-# -------------------------
-# Auth
-# -------------------------
 @app.post("/api/auth/signup")
-def signup(body: SignupIn, db: Session = Depends(get_db)):
+def signup(body: SignupIn):
     if body.role not in ("patient", "clinician"):
         raise HTTPException(status_code=400, detail="role must be patient|clinician")
-    if db.query(User).filter_by(email=body.email).first():
+    db, existing = find_user_by_email(body.email)
+    if existing:
+        db.close()
         raise HTTPException(status_code=400, detail="email exists")
 
     clinic_id = DEMO_CLINIC_ID
-    u = User(email=body.email, password_hash=hash_password(body.password), role=body.role, clinic_id=clinic_id)
-    db.add(u)
-    db.commit()
-    db.refresh(u)
+    with router.for_clinic(clinic_id).SessionLocal() as db:
+        u = User(email=body.email, password_hash=hash_password(body.password), role=body.role, clinic_id=clinic_id)
+        db.add(u)
+        db.commit()
+        db.refresh(u)
 
-    token = create_token(u.id, u.role, u.clinic_id)
-    log_event(db, "signup", actor_user_id=u.id, target_type="user", target_id=u.id, meta={"role": u.role})
-    return {"token": token, "user": {"id": u.id, "email": u.email, "role": u.role, "clinic_id": u.clinic_id}}
+        token = create_token(u.id, u.role, u.clinic_id)
+        log_event(db, "signup", actor_user_id=u.id, target_type="user", target_id=u.id, meta={"role": u.role})
+        return {"token": token, "user": {"id": u.id, "email": u.email, "role": u.role, "clinic_id": u.clinic_id}}
 
 
 @app.post("/api/auth/login")
-def login(body: LoginIn, db: Session = Depends(get_db)):
-    u = db.query(User).filter_by(email=body.email).first()
-    if not u or not verify_password(body.password, u.password_hash):
-        raise HTTPException(status_code=401, detail="bad credentials")
+def login(body: LoginIn):
+    db, u = find_user_by_email(body.email)
+    try:
+        if not u or not verify_password(body.password, u.password_hash):
+            raise HTTPException(status_code=401, detail="bad credentials")
+        router.for_clinic(u.clinic_id)  # 迁移中的诊所返回 503
 
-    token = create_token(u.id, u.role, u.clinic_id)
-    log_event(db, "login", actor_user_id=u.id, target_type="user", target_id=u.id, meta={"role": u.role})
-    return {"token": token, "user": {"id": u.id, "email": u.email, "role": u.role, "clinic_id": u.clinic_id}}
+        token = create_token(u.id, u.role, u.clinic_id)
+        log_event(db, "login", actor_user_id=u.id, target_type="user", target_id=u.id, meta={"role": u.role})
+        return {"token": token, "user": {"id": u.id, "email": u.email, "role": u.role, "clinic_id": u.clinic_id}}
+    finally:
+        if db is not None:
+            db.close()
 
 
 # -------------------------
@@ -263,71 +353,137 @@ def get_thread(token: str, db: Session = Depends(get_db)):
 
 
 @app.get("/api/patient/messages")
-def get_messages(token: str, db: Session = Depends(get_db)):
+def get_messages(token: str, before: Optional[int] = None, limit: int = ARCHIVE_FILL_MESSAGES,
+                 db: Session = Depends(get_read_db)):
+    """
+    Without `before`: the whole hot thread (topped up from the archive when short).
+    With `before`: the `limit` messages older than that id, hot first, then archived.
+    `older_before` is the cursor for the next older page, or null.
+    """
+    # 轮询主路径：走只读副本（刚写过的患者会被路由回主库）
     u = auth_user(token, db)
     if u.role != "patient":
         raise HTTPException(status_code=403, detail="patient only")
-    th = ensure_thread(db, u)
-    msgs = db.query(Message).filter_by(thread_id=th.id).order_by(Message.created_at.asc()).all()
-    return {"messages": [serialize_message(m) for m in msgs], "profile": profile_snapshot(db, u.id)}
+    th = db.query(Thread).filter_by(patient_id=u.id).first()
+    if th is None:
+        with router.for_token(token).SessionLocal() as wdb:
+            th = ensure_thread(wdb, u)
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    q = db.query(Message).filter_by(thread_id=th.id)
+    if before is None:
+        msgs = q.order_by(Message.created_at.asc()).all()
+    else:
+        msgs = q.filter(Message.id < before).order_by(Message.id.desc()).limit(limit).all()[::-1]
+    # 热表不够时透明地从冷归档补更早的消息
+    oldest = msgs[0].id if msgs else before
+    if len(msgs) < limit:
+        older, more = archived_messages(db, th.id, oldest, limit - len(msgs))
+        msgs = older + msgs
+    elif before is not None:
+        more = True
+    else:
+        more = has_archived_messages(db, th.id, oldest)
+    profile = profile_snapshot(db, u.id)
+    return json_response(splice({
+        "older_before": msgs[0].id if (more and msgs) else None,
+        "profile": profile,
+        "profile_version": profile_version(flatten_profile(profile)),
+        "last_event_id": manager.last_event_id("thread", th.id),
+    }, "messages", [message_json(m) for m in msgs]))
+
+
+async def run_idempotent(db: AsyncSession, token: str, key: Optional[str], req_hash: str, handler):
+    """Run handler once per (user, key); duplicates get the first response replayed."""
+    uid = None
+    if key:
+        try:
+            uid = int(decode_token(token)["sub"])
+        except Exception:
+            raise HTTPException(status_code=401, detail="Invalid token")
+    resp, replayed = await idempotency.run(db, uid, key, req_hash, handler)
+    if replayed:
+        return JSONResponse(resp, headers={"Idempotent-Replayed": "true"})
+    return resp
 
 
 @app.post("/api/patient/message")
-async def post_message(body: SendMessageIn, token: str, db: Session = Depends(get_db)):
-    u = auth_user(token, db)
+async def post_message(body: SendMessageIn, token: str, db: AsyncSession = Depends(get_async_db),
+                       idempotency_key: Optional[str] = Header(None)):
+    key = idempotency_key or body.client_request_id
+    return await run_idempotent(db, token, key, request_hash("message", body.text),
+                                lambda: handle_patient_message(body.text, token, db))
+
+
+async def handle_patient_message(text: str, token: str, db: AsyncSession) -> Dict[str, Any]:
+    # 所有 DB 访问都走 AsyncSession；同步 helper 用 run_sync 在 greenlet 里执行，不阻塞事件循环
+    u = await db.run_sync(lambda s: auth_user(token, s))
     if u.role != "patient":
         raise HTTPException(status_code=403, detail="patient only")
 
-    th = ensure_thread(db, u)
-    text = (body.text or "").strip()
+    th = await db.run_sync(lambda s: ensure_thread(s, u))
+    text = (text or "").strip()
     if not text:
-        return {"ok": True, "escalation_required": False, "risk": {"risk_level": "low", "risk_reason": ""}, "profile": profile_snapshot(db, u.id)}
+        return {"ok": True, "escalation_required": False, "risk": {"risk_level": "low", "risk_reason": ""}, "profile": await db.run_sync(profile_snapshot, u.id)}
 
     # 1) 风险评估 + 写入 patient message
-    risk = assess_risk(text)
+    with stage("assess_risk"):
+        risk = assess_risk(text)
+    with stage("redact"):
+        redacted = redact_no_phi(text)
     pm = Message(
         thread_id=th.id,
         sender_role="patient",
         content=text,
-        redacted_for_llm=redact_no_phi(text),
+        redacted_for_llm=redacted,
         risk_level=risk["risk_level"],
         risk_reason=risk["risk_reason"],
         risk_provenance=datetime.utcnow(),
         created_at=datetime.utcnow(),
     )
-    db.add(pm)
-    db.commit()
-    db.refresh(pm)
+    with stage("db_commit"):
+        db.add(pm)
+        await db.commit()
+    mark_write(u.id)
 
-    upsert_memory(db, u.id, pm.id, text, source_is_clinician=False)
+    with stage("upsert_memory"):
+        await db.run_sync(upsert_memory, u.id, pm.id, text, False)
+    # 本请求后续不会再改 memory：快照只查一次，WS 增量、triage 和响应共用
+    with stage("profile_snapshot"):
+        snap = await db.run_sync(profile_snapshot, u.id)
 
     # ✅ 关键：把“患者自己的消息”也推送到 thread WS，这样前端不用刷新就能看到自己刚发的
-    await manager.broadcast_thread(
-        th.id,
-        {
-            "type": "new_message",
-            "message": serialize_message(pm),
-            "profile": profile_snapshot(db, u.id),
-            "escalation_required": False,
-        },
-    )
+    with stage("broadcast"):
+        await manager.broadcast_thread(
+            th.id,
+            {
+                "type": "new_message",
+                "message": message_json(pm),
+                "profile": profile_versions.delta(u.id, snap),
+                "escalation_required": False,
+            },
+        )
 
     escalation_required = risk["risk_level"] in ("medium", "high")
     ticket_id = None
 
     # 2) 升级：创建 ticket + 给安全提示
     if escalation_required:
-        t = await create_ticket(
-            db,
-            th.clinic_id or u.clinic_id or DEMO_CLINIC_ID,
-            u.id,
-            th.id,
-            pm.id,
-            "high" if risk["risk_level"] == "high" else "medium",
-            text,
-        )
+        # 窗口期内同一 thread 的风险消息并入已有 open ticket，避免刷出一堆 ticket
+        with stage("escalate"):
+            t, created = await escalate(
+                db,
+                th.clinic_id or u.clinic_id or DEMO_CLINIC_ID,
+                u.id,
+                th.id,
+                pm.id,
+                "high" if risk["risk_level"] == "high" else "medium",
+                text,
+                snap,
+            )
         ticket_id = t.id
-        await manager.broadcast_clinic(t.clinic_id, {"type": "ticket_created", "ticket_id": t.id})
+        with stage("broadcast"):
+            await manager.broadcast_clinic(t.clinic_id, {"type": "ticket_created" if created else "ticket_updated",
+                                                         "ticket_id": t.id, "ticket": ticket_summary(t)})
 
         assistant_text = "I can’t safely give advice on this. I’ve alerted the clinic so a clinician can review."
         a = Message(
@@ -341,29 +497,35 @@ async def post_message(body: SendMessageIn, token: str, db: Session = Depends(ge
             citations_json=[cite_span(pm.id, 0, min(len(text), 30))],
             created_at=datetime.utcnow(),
         )
-        db.add(a)
-        db.commit()
-        db.refresh(a)
-
-        await manager.broadcast_thread(
-            th.id,
-            {
-                "type": "new_message",
-                "message": serialize_message(a),
-                "profile": profile_snapshot(db, u.id),
-                "escalation_required": True,
-                "ticket_id": ticket_id,
-            },
-        )
-        return {"ok": True, "escalation_required": True, "ticket_id": ticket_id, "risk": risk, "profile": profile_snapshot(db, u.id)}
+        with stage("db_commit"):
+            db.add(a)
+            await db.commit()
+
+        with stage("broadcast"):
+            await manager.broadcast_thread(
+                th.id,
+                {
+                    "type": "new_message",
+                    "message": message_json(a),
+                    "profile": profile_versions.delta(u.id, snap),
+                    "escalation_required": True,
+                    "ticket_id": ticket_id,
+                },
+            )
+        return {"ok": True, "escalation_required": True, "ticket_id": ticket_id, "risk": risk, "profile": snap}
 
     # 3) 非升级：调用 LLM（带上下文）
-    llm_messages = build_llm_messages(db, th.id, limit=12)
+    with stage("build_context"):
+        llm_messages = await db.run_sync(build_llm_messages, th.id, 12)
+        # 结束读事务、把连接还给池子：LLM 调用可能要好几秒，期间不占连接
+        await db.commit()
 
-    try:
-        assistant_text = (generate_reply(llm_messages) or "").strip()
-    except Exception as e:
-        assistant_text = ""
+    with stage("generate_reply"):
+        try:
+            # 最后一条就是刚写入的患者消息（已脱敏），作为 patient_text 单独传
+            assistant_text = ((await generate_reply(llm_messages[:-1], redacted)) or "").strip()
+        except Exception as e:
+            assistant_text = ""
 
     if not assistant_text:
         assistant_text = "I’m here. Could you tell me more about what you’re feeling and when it started?"
@@ -379,57 +541,86 @@ async def post_message(body: SendMessageIn, token: str, db: Session = Depends(ge
         citations_json=[cite_span(pm.id, 0, min(len(text), 30))],
         created_at=datetime.utcnow(),
     )
-    db.add(a)
-    db.commit()
-    db.refresh(a)
+    with stage("db_commit"):
+        db.add(a)
+        await db.commit()
 
-    await manager.broadcast_thread(
-        th.id,
-        {
-            "type": "new_message",
-            "message": serialize_message(a),
-            "profile": profile_snapshot(db, u.id),
-            "escalation_required": False,
-        },
-    )
-    return {"ok": True, "escalation_required": False, "risk": risk, "profile": profile_snapshot(db, u.id)}
+    with stage("broadcast"):
+        await manager.broadcast_thread(
+            th.id,
+            {
+                "type": "new_message",
+                "message": message_json(a),
+                "profile": profile_versions.delta(u.id, snap),
+                "escalation_required": False,
+            },
+        )
+    return {"ok": True, "escalation_required": False, "risk": risk, "profile": snap}
 
 
 @app.post("/api/patient/message_audio")
-async def post_message_audio(token: str, file: UploadFile = File(...), db: Session = Depends(get_db)):
-    u = auth_user(token, db)
-    if u.role != "patient":
-        raise HTTPException(status_code=403, detail="patient only")
-
+async def post_message_audio(token: str, file: UploadFile = File(...), client_request_id: Optional[str] = Form(None),
+                             db: AsyncSession = Depends(get_async_db), idempotency_key: Optional[str] = Header(None)):
     audio = await file.read()
-    asr = await transcribe_audio(audio, file.filename or "audio")
-    transcript = (asr.get("transcript") or "").strip() or "[unintelligible audio]"
 
-    # 复用文字入口：会走风险评估、LLM、以及 WS 推送
-    return await post_message(SendMessageIn(text=transcript), token, db)
+    async def handle():
+        u = await db.run_sync(lambda s: auth_user(token, s))
+        if u.role != "patient":
+            raise HTTPException(status_code=403, detail="patient only")
+        with stage("asr", pipeline="message_audio"):
+            asr = await transcribe_audio(audio, file.filename or "audio")
+        transcript = (asr.get("transcript") or "").strip() or "[unintelligible audio]"
+        # 复用文字入口：会走风险评估、LLM、以及 WS 推送
+        return await handle_patient_message(transcript, token, db)
+
+    return await run_idempotent(db, token, idempotency_key or client_request_id,
+                                request_hash("audio", hashlib.sha256(audio).hexdigest()), handle)
 
 
 # -------------------------
 # Clinician APIs
 # -------------------------
 @app.get("/api/clinician/tickets")
-def clinician_tickets(token: str, db: Session = Depends(get_db)):
+def clinician_tickets(token: str, limit: int = 50, cursor: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    Open-ticket queue, newest first, keyset-paginated by ticket id.
+    Only lightweight summaries; the heavy JSON is on /api/clinician/tickets/{id}.
+    Served from the in-memory index; its occasional reload reads the primary, not the replica.
+    """
     u = auth_user(token, db)
     if u.role != "clinician":
         raise HTTPException(status_code=403, detail="clinician only")
 
     clinic_id = u.clinic_id or DEMO_CLINIC_ID
-    ts = db.query(Ticket).filter_by(clinic_id=clinic_id, status="open").order_by(Ticket.created_at.desc()).all()
-    return {"tickets": [serialize_ticket(t) for t in ts], "clinic_id": clinic_id}
+    tickets, next_cursor = ticket_index.page_json(db, clinic_id, max(1, min(limit, TICKET_PAGE_MAX)), cursor)
+    return json_response(splice({"next_cursor": next_cursor, "clinic_id": clinic_id,
+                                 "last_event_id": manager.last_event_id("clinic", clinic_id)}, "tickets", tickets))
 
 
-@app.post("/api/clinician/reply")
-async def clinician_reply(body: ClinicianReplyIn, token: str, db: Session = Depends(get_db)):
+@app.get("/api/clinician/tickets/{ticket_id}")
+def clinician_ticket_detail(ticket_id: int, token: str, db: Session = Depends(get_read_db)):
     u = auth_user(token, db)
     if u.role != "clinician":
         raise HTTPException(status_code=403, detail="clinician only")
 
-    t = db.query(Ticket).filter_by(id=body.ticket_id).first()
+    clinic_id = u.clinic_id or DEMO_CLINIC_ID
+    # 索引里的 open ticket 可能刚创建/刚更新，副本有延迟：读主库；副本没有的也回主库确认一次
+    t = None if ticket_index.has(clinic_id, ticket_id) else db.query(Ticket).filter_by(id=ticket_id).first()
+    if t is None:
+        with router.for_token(token).SessionLocal() as wdb:
+            t = wdb.query(Ticket).filter_by(id=ticket_id).first()
+    if not t or t.clinic_id != clinic_id:
+        raise HTTPException(status_code=404, detail="ticket not found")
+    return json_response(json_bytes({"ticket": serialize_ticket(t)}))
+
+
+@app.post("/api/clinician/reply")
+async def clinician_reply(body: ClinicianReplyIn, token: str, db: AsyncSession = Depends(get_async_db)):
+    u = await db.run_sync(lambda s: auth_user(token, s))
+    if u.role != "clinician":
+        raise HTTPException(status_code=403, detail="clinician only")
+
+    t = await db.get(Ticket, body.ticket_id)
     if not t or t.clinic_id != (u.clinic_id or DEMO_CLINIC_ID):
         raise HTTPException(status_code=404, detail="ticket not found")
 
@@ -454,18 +645,19 @@ async def clinician_reply(body: ClinicianReplyIn, token: str, db: Session = Depe
     t.status = "closed"
     t.closed_at = datetime.utcnow()
 
-    db.commit()
-    db.refresh(m)
+    await db.commit()
+    ticket_index.remove(t.clinic_id, t.id)
+    mark_write(t.patient_id)
 
-    upsert_memory(db, t.patient_id, m.id, text, source_is_clinician=True)
+    await db.run_sync(upsert_memory, t.patient_id, m.id, text, True)
 
     # ✅ 推送给 patient 线程：病人端立刻能看到医生回复
     await manager.broadcast_thread(
         t.thread_id,
         {
             "type": "new_message",
-            "message": serialize_message(m),
-            "profile": profile_snapshot(db, t.patient_id),
+            "message": message_json(m),
+            "profile": await db.run_sync(profile_delta, t.patient_id),
             "escalation_required": False,
         },
     )
@@ -474,41 +666,135 @@ async def clinician_reply(body: ClinicianReplyIn, token: str, db: Session = Depe
     return {"ok": True}
 
 
+@app.post("/api/clinician/import")
+async def clinician_import(request: Request, token: str, nlp: bool = False):
+    """
+    Bulk onboarding: stream NDJSON (users, threads, messages) into the clinician's clinic.
+    Batches are imported while the body is still arriving; see app/bulk_import.py for the format.
+    """
+    with router.for_token(token).SessionLocal() as db:
+        u = await run_in_threadpool(auth_user, token, db)
+        if u.role != "clinician":
+            raise HTTPException(status_code=403, detail="clinician only")
+        # 导入过程中会 commit/expunge，先取出需要的字段
+        clinic_id, uid = u.clinic_id or DEMO_CLINIC_ID, u.id
+
+        def progress(r):
+            log.info("bulk import clinic=%s: %d lines, %d users, %d messages, %d errors",
+                     clinic_id, r.lines, r.users_created, r.messages, r.error_count)
+
+        with BulkImporter(db, clinic_id, actor_user_id=uid, nlp=nlp, progress=progress) as imp:
+            tail = b""
+            async for chunk in request.stream():
+                lines = (tail + chunk).split(b"\n")
+                tail = lines.pop()
+                if lines:
+                    await run_in_threadpool(imp.add_lines, lines)
+            if tail.strip():
+                await run_in_threadpool(imp.add_lines, [tail])
+            report = await run_in_threadpool(imp.finish)
+    return report.as_dict()
+
+
+# -------------------------
+# Ops
+# -------------------------
+@app.get("/api/ops/db_pool")
+def db_pool():
+    return {"pools": pool_stats()}
+
+
+def _pool_gauge(field: str):
+    return lambda: {(p["name"],): p[field] for p in pool_stats() if field in p}
+
+
+registry.register(Gauge("nightingale_ws_connections", "Open WebSocket connections by channel.", ("channel",),
+                        lambda: {(ch,): n for ch, n in manager.connection_counts().items()}))
+registry.register(Gauge("nightingale_db_pool_checked_out", "Connections currently checked out.", ("pool",),
+                        _pool_gauge("checked_out")))
+registry.register(Gauge("nightingale_startup_ready_seconds", "Seconds from import to ready (absent until ready).",
+                        (), lambda: {(): readiness.ready_s} if readiness.ready else {}))
+registry.register(Gauge("nightingale_db_pool_wait_max_seconds", "Longest pool checkout wait so far.", ("pool",),
+                        lambda: {(p["name"],): p["wait_max_ms"] / 1000 for p in pool_stats() if "wait_max_ms" in p}))
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/healthz")
+async def healthz():
+    # liveness：只说明事件循环在跑，不检查依赖
+    return {"ok": True}
+
+
+@app.get("/readyz")
+async def readyz():
+    report = readiness.report()
+    if readiness.ready:
+        # 就绪后每次再 ping 一下每个分片，任一分片掉线都把流量摘掉
+        shards = router.all()
+        pings = await asyncio.gather(*(_db_ping(s.async_engine) for s in shards))
+        if len(shards) == 1:
+            report["checks"]["db_ping"] = pings[0]
+        else:
+            ok = all(p["status"] == "ok" for p in pings)
+            report["checks"]["db_ping"] = {"status": "ok" if ok else "failed",
+                                           "shards": {s.name: p for s, p in zip(shards, pings)}}
+        report["ready"] = report["checks"]["db_ping"]["status"] == "ok"
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+
+async def _db_ping(eng) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    try:
+        async def ping():
+            async with eng.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        await asyncio.wait_for(ping(), 2)
+        return {"status": "ok", "ms": round((time.perf_counter() - t0) * 1000, 1)}
+    except Exception as e:
+        return {"status": "failed", "detail": f"{type(e).__name__}: {e}"[:300]}
+
+
 # -------------------------
 # WebSockets
 # -------------------------
 @app.websocket("/ws/thread/{thread_id}")
-async def ws_thread(ws: WebSocket, thread_id: int, token: str):
-    db = SessionLocal()
+async def ws_thread(ws: WebSocket, thread_id: int, token: str, last_event_id: Optional[int] = None):
     try:
-        u = auth_user(token, db)
-        if u.role != "patient":
-            raise WebSocketDisconnect()
-        th = ensure_thread(db, u)
-        if th.id != thread_id:
-            raise WebSocketDisconnect()
-
-        await manager.connect_thread(thread_id, ws)
+        # 只在鉴权时持有 session，连接存活期间不占用连接池
+        async with router.for_token(token).AsyncSessionLocal() as db:
+            u = await db.run_sync(lambda s: auth_user(token, s))
+            if u.role != "patient":
+                raise WebSocketDisconnect()
+            th = await db.run_sync(lambda s: ensure_thread(s, u))
+            if th.id != thread_id:
+                raise WebSocketDisconnect()
+
+        await manager.connect_thread(thread_id, ws, last_event_id)
+        # 心跳由服务端发送；这里只是等待断开
         while True:
             await ws.receive_text()
     except WebSocketDisconnect:
-        await manager.disconnect(ws)
+        pass
     finally:
-        db.close()
+        await manager.disconnect(ws)
 
 
 @app.websocket("/ws/clinic/{clinic_id}")
-async def ws_clinic(ws: WebSocket, clinic_id: int, token: str):
-    db = SessionLocal()
+async def ws_clinic(ws: WebSocket, clinic_id: int, token: str, last_event_id: Optional[int] = None):
     try:
-        u = auth_user(token, db)
+        async with router.for_token(token).AsyncSessionLocal() as db:
+            u = await db.run_sync(lambda s: auth_user(token, s))
         if u.role != "clinician" or (u.clinic_id or DEMO_CLINIC_ID) != clinic_id:
             raise WebSocketDisconnect()
 
-        await manager.connect_clinic(clinic_id, ws)
+        await manager.connect_clinic(clinic_id, ws, last_event_id)
         while True:
             await ws.receive_text()
     except WebSocketDisconnect:
-        await manager.disconnect(ws)
+        pass
     finally:
-        db.close()
+        await manager.disconnect(ws)
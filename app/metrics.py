@@ -0,0 +1,146 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# 进程内指标，/metrics 以 Prometheus 文本格式输出。observe 只是一次 bisect + 加法，可以常开。
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels -> [每个桶的计数..., +Inf 桶, sum]
+        self.series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            row = self.series.get(labels)
+            if row is None:
+                row = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[idx] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = {k: list(v) for k, v in self.series.items()}
+        for labels, row in sorted(series.items()):
+            acc = 0
+            for le, n in zip(self.buckets, row):
+                acc += n
+                le_label = 'le="%s"' % le
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le_label)} {acc}"
+            acc += row[len(self.buckets)]
+            inf_label = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.labelnames, labels, inf_label)} {acc}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {row[-1]}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {acc}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            series = dict(self.series)
+        for labels, v in sorted(series.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {v}"
+
+
+class Gauge:
+    """Value is read from a callback at scrape time: {label tuple: value}."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name, self.help, self.labelnames, self.collect = name, help, tuple(labelnames), collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, v in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {v}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "nightingale_stage_seconds", "Time spent per message pipeline stage.", ("pipeline", "stage")))
+HTTP_SECONDS = registry.register(Histogram(
+    "nightingale_http_request_seconds", "HTTP request latency by route.", ("method", "route", "status")))
+HTTP_SQL_STATEMENTS = registry.register(Histogram(
+    "nightingale_http_request_sql_statements", "SQL statements issued per HTTP request.", ("route",),
+    buckets=(1, 2, 4, 8, 12, 16, 24, 32, 64)))
+UPSTREAM_SECONDS = registry.register(Histogram(
+    "nightingale_upstream_seconds", "Latency of calls to upstream services.", ("upstream",)))
+UPSTREAM_REQUESTS = registry.register(Counter(
+    "nightingale_upstream_requests_total", "Upstream calls by outcome.", ("upstream", "outcome")))
+BACKPLANE_DROPPED = registry.register(Counter(
+    "nightingale_backplane_dropped_frames_total", "Realtime frames not delivered to a peer worker.", ("reason",)))
+
+
+@contextmanager
+def stage(name: str, pipeline: str = "message"):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, pipeline, name)
+
+
+@contextmanager
+def upstream(name: str):
+    """Times an upstream call and counts ok/error, so error rate = error / (ok + error)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        UPSTREAM_REQUESTS.inc(name, "error")
+        raise
+    else:
+        UPSTREAM_REQUESTS.inc(name, "ok")
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - t0, name)
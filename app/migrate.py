@@ -0,0 +1,95 @@
+"""
+Idempotent schema upgrade for databases created by an earlier release.
+
+db/init.sql only runs when the MySQL volume is first created, so an existing database keeps
+its old schema. This module brings every shard up to the models:
+
+  tables    missing tables are created (CREATE TABLE from the model)
+  columns   missing columns are added with ALTER TABLE ... ADD COLUMN, using the model's
+            type, NOT NULL and server default
+  indexes   missing indexes declared on the models are created
+  backfill  columns added by this run are filled for existing rows (see BACKFILL)
+
+Every step checks the live schema first, so running it again is a no-op.
+
+    python -m app.migrate               # every shard
+    python -m app.migrate --dry-run     # print the statements only
+    python -m app.migrate --shard b
+"""
+import argparse
+import sys
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+
+from .db import Base
+from . import models  # noqa: F401  注册所有表
+
+# (table, column) -> 新加列之后对已有行执行的语句
+BACKFILL: Dict[Tuple[str, str], List[str]] = {
+    # 旧工单没有 updated_at，合并窗口按它判断
+    ("tickets", "updated_at"): ["UPDATE tickets SET updated_at = created_at WHERE updated_at IS NULL"],
+}
+
+
+def plan(conn: Connection) -> List[Tuple[str, Callable[[Connection], None]]]:
+    """(description, apply) for every change this database needs, in order."""
+    insp = inspect(conn)
+    have = set(insp.get_table_names())
+    dialect = conn.dialect
+    steps: List[Tuple[str, Callable[[Connection], None]]] = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in have:
+            ddl = CreateTable(table)
+            steps.append((str(ddl.compile(dialect=dialect)).strip(), lambda c, t=table: t.create(c)))
+            continue
+        cols = {c["name"] for c in insp.get_columns(table.name)}
+        added = []
+        for col in table.columns:
+            if col.name in cols:
+                continue
+            sql = f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(col).compile(dialect=dialect)}"
+            steps.append((sql, lambda c, s=sql: c.execute(text(s))))
+            added.append(col.name)
+        for col in added:
+            for sql in BACKFILL.get((table.name, col), []):
+                steps.append((sql, lambda c, s=sql: c.execute(text(s))))
+        indexes = {i["name"] for i in insp.get_indexes(table.name)}
+        for idx in sorted(table.indexes, key=lambda i: i.name):
+            if idx.name not in indexes:
+                ddl = CreateIndex(idx)
+                steps.append((str(ddl.compile(dialect=dialect)).strip(), lambda c, i=idx: i.create(c)))
+    return steps
+
+
+def upgrade(conn: Connection, dry_run: bool = False) -> List[str]:
+    """Apply (or with dry_run only list) the pending changes; returns their SQL."""
+    steps = plan(conn)
+    if not dry_run:
+        for _, apply in steps:
+            apply(conn)
+    return [sql for sql, _ in steps]
+
+
+def main():
+    from .shards import router
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    ap.add_argument("--shard", help="only this shard (default: every shard)")
+    a = ap.parse_args()
+
+    for shard in router.all():
+        if a.shard and shard.name != a.shard:
+            continue
+        with shard.engine.begin() as conn:
+            done = upgrade(conn, a.dry_run)
+        for sql in done:
+            print(f"{shard.name}: {sql};")
+        print(f"{shard.name}: {len(done)} change(s){' pending' if a.dry_run and done else ''}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
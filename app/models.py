@@ -3,6 +3,9 @@ from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, Enum
 from datetime import datetime
 from .db import Base
 
+# MySQL 用 BIGINT 主键；SQLite 只有 INTEGER PRIMARY KEY 才会自增（测试环境）
+PK=BigInteger().with_variant(Integer, "sqlite")
+
 ROLE_ENUM=("patient","clinician")
 SENDER_ENUM=("patient","assistant","clinician","system")
 RISK_ENUM=("low","medium","high")
@@ -14,23 +17,26 @@ FP_KIND=("ip","device","phone")
 
 class User(Base):
     __tablename__="users"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     email=Column(String(255), unique=True, nullable=False)
     password_hash=Column(String(255), nullable=False)
     role=Column(Enum(*ROLE_ENUM, name="role_enum"), nullable=False)
     clinic_id=Column(BigInteger, nullable=True)
     created_at=Column(DateTime, default=datetime.utcnow, nullable=False)
+    # 分片迁移保留 id；SQLite 分片靠 sqlite_sequence 分配 id 区间（见 app/shards.py）
+    __table_args__=({"sqlite_autoincrement": True},)
 
 class Thread(Base):
     __tablename__="threads"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     patient_id=Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), unique=True, nullable=False)
     clinic_id=Column(BigInteger, nullable=True)
     created_at=Column(DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__=({"sqlite_autoincrement": True},)
 
 class Message(Base):
     __tablename__="messages"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     thread_id=Column(BigInteger, ForeignKey("threads.id", ondelete="CASCADE"), index=True, nullable=False)
     sender_role=Column(Enum(*SENDER_ENUM, name="sender_enum"), nullable=False)
     content=Column(Text, nullable=False)
@@ -44,11 +50,12 @@ class Message(Base):
     audio_asset_id=Column(String(255), nullable=True)
     audio_transcript_id=Column(String(255), nullable=True)
     created_at=Column(DateTime, default=datetime.utcnow, nullable=False)
-    __table_args__=(Index("idx_messages_thread_created","thread_id","created_at"),)
+    # 归档后热表可能被删空；SQLite 需 AUTOINCREMENT 才不会复用 id（MySQL 本来就不复用）
+    __table_args__=(Index("idx_messages_thread_created","thread_id","created_at"), {"sqlite_autoincrement": True})
 
 class MemoryItem(Base):
     __tablename__="memory_items"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     patient_id=Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
     kind=Column(Enum(*MEM_KIND, name="mem_kind_enum"), nullable=False)
     value=Column(String(255), nullable=False)
@@ -58,10 +65,11 @@ class MemoryItem(Base):
     provenance_start=Column(Integer, default=0, nullable=False)
     provenance_end=Column(Integer, default=0, nullable=False)
     updated_at=Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    __table_args__=({"sqlite_autoincrement": True},)
 
 class Ticket(Base):
     __tablename__="tickets"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     clinic_id=Column(BigInteger, index=True, nullable=False)
     patient_id=Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     thread_id=Column(BigInteger, ForeignKey("threads.id", ondelete="CASCADE"), nullable=False)
@@ -70,26 +78,73 @@ class Ticket(Base):
     risk_level=Column(Enum("medium","high", name="ticket_risk_enum"), nullable=False)
     triage_summary_json=Column(JSON, nullable=False)
     profile_snapshot_json=Column(JSON, nullable=False)
+    escalation_count=Column(Integer, default=1, server_default="1", nullable=False)
     created_at=Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at=Column(DateTime, nullable=True)
+    triaged_at=Column(DateTime, nullable=True)
     closed_at=Column(DateTime, nullable=True)
-    __table_args__=(Index("idx_tickets_clinic_status","clinic_id","status","created_at"),)
+    __table_args__=(Index("idx_tickets_clinic_status","clinic_id","status","created_at"),
+                    Index("idx_tickets_thread_status","thread_id","status"), {"sqlite_autoincrement": True})
 
 class AuditEvent(Base):
     __tablename__="audit_events"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     event_type=Column(String(64), nullable=False)
     actor_user_id=Column(BigInteger, nullable=True)
     target_type=Column(String(64), nullable=True)
     target_id=Column(String(64), nullable=True)
     meta_json=Column(JSON, nullable=True)
     created_at=Column(DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__=({"sqlite_autoincrement": True},)
 
 class RequestFingerprint(Base):
     __tablename__="request_fingerprints"
-    id=Column(BigInteger, primary_key=True)
+    id=Column(PK, primary_key=True)
     kind=Column(Enum(*FP_KIND, name="fp_kind_enum"), nullable=False)
     fingerprint_hash=Column(String(64), nullable=False)
     strikes=Column(Integer, default=0, nullable=False)
     blocked_until=Column(DateTime, nullable=True)
     last_seen=Column(DateTime, default=datetime.utcnow, nullable=False)
     __table_args__=(UniqueConstraint("kind","fingerprint_hash", name="uniq_kind_hash"),)
+
+class IdempotencyRecord(Base):
+    __tablename__="idempotency_keys"
+    id=Column(PK, primary_key=True)
+    user_id=Column(BigInteger, nullable=False)
+    idem_key=Column(String(128), nullable=False)
+    request_hash=Column(String(64), nullable=False)
+    # 为空表示首个请求仍在处理中
+    response_json=Column(JSON(none_as_null=True), nullable=True)
+    created_at=Column(DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__=(UniqueConstraint("user_id","idem_key", name="uniq_user_idem_key"),
+                    Index("idx_idem_created","created_at"))
+
+ARCHIVE_KIND=("messages","audit_events")
+
+class ArchiveSegment(Base):
+    """Manifest of cold-storage segment files; a row only exists once its file is fully written."""
+    __tablename__="archive_segments"
+    id=Column(PK, primary_key=True)
+    kind=Column(Enum(*ARCHIVE_KIND, name="archive_kind_enum"), nullable=False)
+    path=Column(String(512), nullable=False)
+    row_count=Column(Integer, nullable=False)
+    id_min=Column(BigInteger, nullable=False)
+    id_max=Column(BigInteger, nullable=False)
+    # messages 段按 thread_id 排序，记录覆盖的 thread 区间；audit 段为空
+    key_min=Column(BigInteger, nullable=True)
+    key_max=Column(BigInteger, nullable=True)
+    created_min=Column(DateTime, nullable=False)
+    created_max=Column(DateTime, nullable=False)
+    archived_at=Column(DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__=(Index("idx_archive_kind_key","kind","key_min","key_max"),)
+
+SHARD_STATUS=("active","moving")
+
+class ClinicShard(Base):
+    """Which shard holds a clinic's rows; only read from the default shard. No row = default."""
+    __tablename__="clinic_shards"
+    clinic_id=Column(BigInteger, primary_key=True, autoincrement=False)
+    shard=Column(String(64), nullable=False)
+    # moving：迁移中，该诊所的请求返回 503
+    status=Column(Enum(*SHARD_STATUS, name="shard_status_enum"), default="active", nullable=False)
+    updated_at=Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import PROFILE_VERSION_CACHE_MAX
+
+# 实时协议里的 profile 以“条目”为单位增量下发：
+#   {"base": <客户端应持有的版本|None>, "version": <新版本>, "set": {key: item}, "del": [key]}
+# base 为 None 表示全量替换。版本是内容哈希，多个 worker 算出来的结果一致。
+
+
+def flatten_profile(snap: Dict) -> Dict[str, Any]:
+    items: Dict[str, Any] = {}
+
+    def put(prefix: str, item: Dict):
+        key = f"{prefix}:{item['value']}"
+        n = 2
+        while key in items:
+            key = f"{prefix}:{item['value']}#{n}"
+            n += 1
+        items[key] = item
+
+    if snap.get("chief_complaint") is not None:
+        items["chief_complaint"] = snap["chief_complaint"]
+    for s in snap.get("symptoms") or []:
+        put("symptom", s)
+    for m in snap.get("medications") or []:
+        put("medication", m)
+    for a in snap.get("allergies") or []:
+        put("allergy", a)
+    return items
+
+
+def unflatten_profile(items: Dict[str, Any]) -> Dict:
+    out = {"chief_complaint": items.get("chief_complaint"), "symptoms": [], "medications": [], "allergies": []}
+    buckets = {"symptom": "symptoms", "medication": "medications", "allergy": "allergies"}
+    for key, item in items.items():
+        prefix = key.split(":", 1)[0]
+        if prefix in buckets:
+            out[buckets[prefix]].append(item)
+    return out
+
+
+def profile_version(items: Dict[str, Any]) -> str:
+    raw = json.dumps(items, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def diff_items(old: Dict[str, Any], new: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    changed = {k: v for k, v in new.items() if old.get(k) != v}
+    removed = [k for k in old if k not in new]
+    return changed, removed
+
+
+def merge_deltas(a: Optional[Dict], b: Dict) -> Dict:
+    """Compose two consecutive deltas (a then b) into one."""
+    if a is None or b["base"] is None or b["base"] != a["version"]:
+        return b
+    changed = dict(a["set"])
+    for k in b["del"]:
+        changed.pop(k, None)
+    changed.update(b["set"])
+    removed = [k for k in a["del"] if k not in b["set"]]
+    removed += [k for k in b["del"] if k not in removed]
+    return {"base": a["base"], "version": b["version"], "set": changed, "del": removed}
+
+
+class ProfileVersions:
+    """Remembers the last profile pushed per patient so the next push only carries what changed."""
+
+    def __init__(self, maxsize: int = PROFILE_VERSION_CACHE_MAX):
+        self.maxsize = maxsize
+        self.last: "OrderedDict[int, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+
+    def delta(self, patient_id: int, snap: Dict) -> Dict:
+        items = flatten_profile(snap)
+        version = profile_version(items)
+        prev = self.last.pop(patient_id, None)
+        self.last[patient_id] = (version, items)
+        if len(self.last) > self.maxsize:
+            self.last.popitem(last=False)
+        if prev is None:
+            return {"base": None, "version": version, "set": items, "del": []}
+        changed, removed = diff_items(prev[1], items)
+        return {"base": prev[0], "version": version, "set": changed, "del": removed}
+
+
+profile_versions = ProfileVersions()
@@ -1,45 +1,348 @@
-
-from typing import Dict, Set
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
 from fastapi import WebSocket
 import asyncio
+import json
+import time
+
+from .backplane import Backplane, make_backplane
+from .config import (WS_SEND_QUEUE_MAX, WS_SEND_TIMEOUT_S, THREAD_COALESCE_MS,
+                     WS_REPLAY_BUFFER, WS_REPLAY_MAX_STREAMS, WS_REPLAY_MAX_AGE_S, WS_REPLAY_MAX_BYTES,
+                     WS_HEARTBEAT_S)
+from .profile_delta import merge_deltas
+from .fastjson import dumps as dumps_bytes, encode_items, splice
+
+Stream = Tuple[str, int]
+
+HEARTBEAT = '{"type":"heartbeat"}'
+RESET = '{"type":"reset"}'
+
+
+def dumps(payload: dict) -> str:
+    # thread 帧里的消息可以是已编码的 bytes（fastjson.message_cache），直接拼接
+    if payload.get("messages"):
+        return splice(payload, "messages", encode_items(payload["messages"])).decode("utf-8")
+    return dumps_bytes(payload).decode("utf-8")
+
+
+def merge_thread_events(events: List[dict]) -> dict:
+    """Fold a burst of new_message events for one thread into a single thread_update frame."""
+    frame = {"type": "thread_update", "messages": [], "profile": None,
+             "escalation_required": False, "ticket_id": None}
+    for e in events:
+        if e.get("message"):
+            frame["messages"].append(e["message"])
+        if e.get("profile"):
+            frame["profile"] = merge_deltas(frame["profile"], e["profile"])
+        frame["escalation_required"] = frame["escalation_required"] or bool(e.get("escalation_required"))
+        if e.get("ticket_id") is not None:
+            frame["ticket_id"] = e["ticket_id"]
+    return frame
+
+
+class Connection:
+    """One socket plus its bounded outbound queue, drained by a dedicated writer task."""
+    __slots__ = ("ws", "group", "key", "queue", "writer")
+
+    def __init__(self, ws: WebSocket, group: Dict[int, Dict[WebSocket, "Connection"]], key: int, maxsize: int):
+        self.ws = ws
+        self.group = group
+        self.key = key
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.writer: Optional[asyncio.Task] = None
+
+
+class ReplayBuffer:
+    """
+    Bounded per-stream ring of recent frames, used to resume a socket from last_event_id.
+
+    Event ids are microsecond timestamps bumped past every id already seen (a hybrid
+    logical clock), so they increase monotonically per stream even when several
+    workers publish through the backplane.
+
+    A ring keeps at most `size` frames, `max_bytes` of data and frames younger than
+    `max_age_s`. Only streams with a subscriber on this worker, or one that left less
+    than `max_age_s` ago, are recorded; a resume on any other stream gets a reset.
+    """
+
+    def __init__(self, size: int = WS_REPLAY_BUFFER, max_streams: int = WS_REPLAY_MAX_STREAMS,
+                 max_age_s: float = WS_REPLAY_MAX_AGE_S, max_bytes: int = WS_REPLAY_MAX_BYTES):
+        self.size = size
+        self.max_streams = max_streams
+        self.max_age_us = int(max_age_s * 1_000_000)
+        self.max_bytes = max_bytes
+        self.clock = time.time_ns() // 1000
+        # 比 started 更早的事件本进程从没见过
+        self.started = self.clock
+        self.streams: "OrderedDict[Stream, Deque[Tuple[int, str]]]" = OrderedDict()
+        self.bytes: Dict[Stream, int] = {}
+        self.floor: Dict[Stream, int] = {}
+        self.forgotten = self.started
+        self.watchers: Dict[Stream, int] = {}
+        # 最后一个订阅者离开的时刻（事件时钟）；ring 在窗口内继续记录，供断线重连补发
+        self.idle_since: Dict[Stream, int] = {}
+
+    def next_id(self) -> int:
+        self.clock = max(time.time_ns() // 1000, self.clock + 1)
+        return self.clock
+
+    def subscribe(self, stream: Stream):
+        self.watchers[stream] = self.watchers.get(stream, 0) + 1
+        self.idle_since.pop(stream, None)
+
+    def unsubscribe(self, stream: Stream):
+        n = self.watchers.get(stream, 0) - 1
+        if n > 0:
+            self.watchers[stream] = n
+            return
+        self.watchers.pop(stream, None)
+        if stream in self.streams:
+            self.idle_since[stream] = max(self.clock, time.time_ns() // 1000)
+
+    def _wanted(self, stream: Stream, event_id: int) -> bool:
+        if stream in self.watchers:
+            return True
+        since = self.idle_since.get(stream)
+        return since is not None and event_id - since <= self.max_age_us
+
+    def _forget(self, stream: Stream, event_id: int = 0):
+        ring = self.streams.pop(stream, None)
+        self.bytes.pop(stream, None)
+        self.idle_since.pop(stream, None)
+        self.forgotten = max(self.forgotten, self.floor.pop(stream, 0), ring[-1][0] if ring else 0, event_id)
+
+    def _ring(self, stream: Stream) -> Deque[Tuple[int, str]]:
+        ring = self.streams.get(stream)
+        if ring is None:
+            ring = self.streams[stream] = deque()
+            self.bytes[stream] = 0
+            # 之前没记录的帧可能已被跳过：比 forgotten 更早的位置不能补发
+            self.floor[stream] = self.forgotten
+            if len(self.streams) > self.max_streams:
+                self._forget(next(iter(self.streams)))
+        else:
+            self.streams.move_to_end(stream)
+        return ring
+
+    def _trim(self, stream: Stream, ring: Deque[Tuple[int, str]], now: int):
+        while ring and (len(ring) > self.size or self.bytes[stream] > self.max_bytes
+                        or ring[0][0] < now - self.max_age_us):
+            eid, data = ring.popleft()
+            self.bytes[stream] -= len(data)
+            self.floor[stream] = eid
+
+    def _expire(self, now: int):
+        # LRU 头部是最久没有新帧的 stream；每次顺手清理一两个，不做全量扫描
+        for _ in range(2):
+            if not self.streams:
+                return
+            stream, ring = next(iter(self.streams.items()))
+            last = ring[-1][0] if ring else self.floor.get(stream, 0)
+            if last >= now - self.max_age_us:
+                return
+            if stream in self.watchers:
+                self._trim(stream, ring, now)
+                self.streams.move_to_end(stream)
+            else:
+                self._forget(stream)
+
+    def record(self, stream: Stream, event_id: int, data: str):
+        self.clock = max(self.clock, event_id)
+        if not self._wanted(stream, event_id):
+            # 没人会来补发：只记下断档，不保存帧
+            self._forget(stream, event_id)
+            return
+        ring = self._ring(stream)
+        ring.append((event_id, data))
+        self.bytes[stream] += len(data)
+        self._trim(stream, ring, event_id)
+        self._expire(event_id)
+
+    def mark_gap(self, stream: Stream, event_id: int):
+        """An event of this stream never arrived: resuming from before it must reset."""
+        self.clock = max(self.clock, event_id)
+        if not self._wanted(stream, event_id):
+            self._forget(stream, event_id)
+            return
+        self._ring(stream)
+        self.floor[stream] = max(self.floor.get(stream, 0), event_id)
+
+    def last_id(self, stream: Stream) -> int:
+        ring = self.streams.get(stream)
+        return ring[-1][0] if ring else self.clock
+
+    def since(self, stream: Stream, last_event_id: int) -> Optional[List[str]]:
+        """Frames newer than last_event_id, or None when the gap is older than the buffer."""
+        ring = self.streams.get(stream)
+        floor = self.floor.get(stream, self.started if ring is not None else self.forgotten)
+        if last_event_id < floor:
+            return None
+        return [data for eid, data in (ring or ()) if eid > last_event_id]
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.thread: Dict[int, Set[WebSocket]] = {}
-        self.clinic: Dict[int, Set[WebSocket]] = {}
-        self.lock = asyncio.Lock()
+    def __init__(self, queue_max: int = WS_SEND_QUEUE_MAX, send_timeout: float = WS_SEND_TIMEOUT_S,
+                 backplane: Optional[Backplane] = None, coalesce_ms: int = THREAD_COALESCE_MS,
+                 heartbeat_s: float = WS_HEARTBEAT_S, replay: Optional[ReplayBuffer] = None):
+        self.thread: Dict[int, Dict[WebSocket, Connection]] = {}
+        self.clinic: Dict[int, Dict[WebSocket, Connection]] = {}
+        # 反向索引：ws -> Connection，disconnect 不再扫描所有 key
+        self.conns: Dict[WebSocket, Connection] = {}
+        self.queue_max = queue_max
+        self.send_timeout = send_timeout
+        self.heartbeat_s = heartbeat_s
+        self.replay = replay or ReplayBuffer()
+        # 广播先发到 backplane，再由它投递给每个 worker（包括本进程）
+        self.backplane = backplane or make_backplane()
+        self.backplane.attach(self._deliver)
+        # 同一 thread 在窗口期内的事件合并成一帧
+        self.coalesce_window = coalesce_ms / 1000.0
+        self._pending: Dict[int, Tuple[List[dict], asyncio.Task]] = {}
+        # 进程内状态（如 open-ticket 索引）订阅 clinic 事件，包括其他 worker 发出的
+        self.clinic_listeners: List[Callable[[int, dict], None]] = []
+
+    def on_clinic_event(self, listener: Callable[[int, dict], None]):
+        self.clinic_listeners.append(listener)
+
+    async def start(self):
+        await self.backplane.start()
 
-    async def connect_thread(self, thread_id: int, ws: WebSocket):
+    async def connect_thread(self, thread_id: int, ws: WebSocket, last_event_id: Optional[int] = None):
+        await self.start()
         await ws.accept()
-        async with self.lock:
-            self.thread.setdefault(thread_id, set()).add(ws)
+        self._register(ws, self.thread, ("thread", thread_id), last_event_id)
 
-    async def connect_clinic(self, clinic_id: int, ws: WebSocket):
+    async def connect_clinic(self, clinic_id: int, ws: WebSocket, last_event_id: Optional[int] = None):
+        await self.start()
         await ws.accept()
-        async with self.lock:
-            self.clinic.setdefault(clinic_id, set()).add(ws)
+        self._register(ws, self.clinic, ("clinic", clinic_id), last_event_id)
 
     async def disconnect(self, ws: WebSocket):
-        async with self.lock:
-            for m in (self.thread, self.clinic):
-                for k in list(m.keys()):
-                    if ws in m[k]:
-                        m[k].remove(ws)
-                        if not m[k]:
-                            del m[k]
+        conn = self.conns.pop(ws, None)
+        if conn is not None:
+            self._unlink(conn)
+
+    def last_event_id(self, channel: str, key: int) -> int:
+        """High-water mark a client should resume from after a full HTTP load."""
+        return self.replay.last_id((channel, key))
+
+    def connection_counts(self) -> Dict[str, int]:
+        return {"thread": sum(len(g) for g in self.thread.values()),
+                "clinic": sum(len(g) for g in self.clinic.values())}
 
     async def broadcast_thread(self, thread_id: int, payload: dict):
-        for ws in list(self.thread.get(thread_id, set())):
-            try:
-                await ws.send_json(payload)
-            except Exception:
-                pass
+        if self.coalesce_window <= 0:
+            await self._publish("thread", thread_id, merge_thread_events([payload]))
+            return
+        pending = self._pending.get(thread_id)
+        if pending is not None and pending[1].get_loop() is asyncio.get_running_loop() and not pending[1].done():
+            pending[0].append(payload)
+            return
+        events = [payload]
+        self._pending[thread_id] = (events, asyncio.create_task(self._flush_thread(thread_id, events)))
 
     async def broadcast_clinic(self, clinic_id: int, payload: dict):
-        for ws in list(self.clinic.get(clinic_id, set())):
+        await self._publish("clinic", clinic_id, dict(payload))
+
+    async def flush(self):
+        """Publish every pending thread burst now (used on shutdown and in tests)."""
+        pending, self._pending = self._pending, {}
+        for thread_id, (events, task) in pending.items():
+            if not task.get_loop().is_closed():
+                task.cancel()
+            await self._publish("thread", thread_id, merge_thread_events(events))
+
+    async def _flush_thread(self, thread_id: int, events: List[dict]):
+        await asyncio.sleep(self.coalesce_window)
+        pending = self._pending.get(thread_id)
+        if pending is not None and pending[0] is events:
+            del self._pending[thread_id]
+        await self._publish("thread", thread_id, merge_thread_events(events))
+
+    async def _publish(self, channel: str, key: int, frame: dict):
+        frame["id"] = event_id = self.replay.next_id()
+        await self.backplane.publish(channel, key, event_id, dumps(frame))
+
+    def _deliver(self, channel: str, key: int, event_id: int, data: str):
+        if not data:
+            # backplane 丢了一帧：断档之前的 last_event_id 不能再补发，在线的客户端直接 reset
+            self.replay.mark_gap((channel, key), event_id)
+            group = (self.thread if channel == "thread" else self.clinic).get(key)
+            if group:
+                self._fanout(group, RESET)
+            return
+        self.replay.record((channel, key), event_id, data)
+        if channel == "clinic" and self.clinic_listeners:
+            event = json.loads(data)
+            for listener in self.clinic_listeners:
+                try:
+                    listener(key, event)
+                except Exception:
+                    pass
+        group = (self.thread if channel == "thread" else self.clinic).get(key)
+        if group:
+            self._fanout(group, data)
+
+    def _register(self, ws: WebSocket, group: Dict[int, Dict[WebSocket, Connection]], stream: Stream,
+                  last_event_id: Optional[int]):
+        conn = Connection(ws, group, stream[1], self.queue_max)
+        if last_event_id is not None:
+            # 注册和补发之间没有 await，不会漏掉并发到达的事件
+            missed = self.replay.since(stream, last_event_id)
+            if missed is None or len(missed) >= self.queue_max:
+                conn.queue.put_nowait(RESET)
+            else:
+                for data in missed:
+                    conn.queue.put_nowait(data)
+        group.setdefault(stream[1], {})[ws] = conn
+        self.conns[ws] = conn
+        self.replay.subscribe(stream)
+        conn.writer = asyncio.create_task(self._write_loop(conn))
+
+    def _unlink(self, conn: Connection):
+        self.replay.unsubscribe(("thread" if conn.group is self.thread else "clinic", conn.key))
+        members = conn.group.get(conn.key)
+        if members is not None:
+            members.pop(conn.ws, None)
+            if not members:
+                del conn.group[conn.key]
+        if conn.writer is not None and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+
+    def _fanout(self, group: Dict[WebSocket, Connection], data: str):
+        # 只入队不等待：慢的浏览器不会拖住其他接收者，队列满即视为慢消费者
+        for conn in list(group.values()):
             try:
-                await ws.send_json(payload)
-            except Exception:
-                pass
+                conn.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self._evict(conn)
+
+    def _evict(self, conn: Connection):
+        if self.conns.get(conn.ws) is not conn:
+            return
+        del self.conns[conn.ws]
+        self._unlink(conn)
+        asyncio.ensure_future(self._close(conn.ws, self.send_timeout))
+
+    async def _write_loop(self, conn: Connection):
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(conn.queue.get(), self.heartbeat_s)
+                except asyncio.TimeoutError:
+                    # 空闲时由服务端发心跳，客户端不用再 ping
+                    data = HEARTBEAT
+                await asyncio.wait_for(conn.ws.send_text(data), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._evict(conn)
+
+    @staticmethod
+    async def _close(ws: WebSocket, timeout: float):
+        try:
+            await asyncio.wait_for(ws.close(code=1013), timeout)
+        except Exception:
+            pass
 
 manager = ConnectionManager()
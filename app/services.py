@@ -1,43 +1,62 @@
 
+import asyncio
+import weakref
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from datetime import datetime
-from typing import Dict, List
-from .models import MemoryItem, Ticket
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from .models import MemoryItem, Thread, Ticket
 from .nlp.memory import extract_memory_facts
-from .config import USE_LLM_TRIAGE
+from .config import USE_LLM_TRIAGE, ESCALATION_COALESCE_WINDOW_S, TRIAGE_REFRESH_INTERVAL_S
 from .llm.ollama import ollama_generate
+from .ticket_index import ticket_index, ticket_summary
 
 def upsert_memory(db: Session, patient_id: int, message_id: int, text: str, source_is_clinician: bool=False):
     facts = extract_memory_facts(text)
+    if not facts:
+        return
+    # 一次取出该患者所有 active 条目，逐条 fact 在内存里匹配（原来每条 fact 一次查询）
+    active=db.query(MemoryItem).filter_by(patient_id=patient_id, status="active").all()
+    apply_memory_facts(db, patient_id, message_id, facts, active)
+    db.commit()
+
+def apply_memory_facts(db: Session, patient_id: int, message_id: int, facts: List[Dict], active: List[MemoryItem]):
+    """Apply extracted facts against the patient's active items; `active` is updated in place, no commit."""
+    def find(kind, value):
+        # MySQL 的 utf8mb4_unicode_ci 比较不区分大小写，这里保持一致
+        v=value.lower()
+        return [i for i in active if i.kind==kind and i.value.lower()==v]
+    def add(kind, value, status, timeline, start, end):
+        item=MemoryItem(patient_id=patient_id, kind=kind, value=value, status=status,
+                        timeline_text=timeline, provenance_message_id=message_id,
+                        provenance_start=start, provenance_end=end, updated_at=datetime.utcnow())
+        db.add(item)
+        if status=="active": active.append(item)
     for f in facts:
         kind=f["kind"]; value=f["value"].strip(); status=f["status"]; timeline=f.get("timeline_text")
         start,end=f["span"]
         if kind=="chief_complaint":
-            prev=db.query(MemoryItem).filter_by(patient_id=patient_id, kind="chief_complaint", status="active").all()
-            for p in prev: p.status="resolved"
-            db.add(MemoryItem(patient_id=patient_id, kind=kind, value=value, status="active",
-                              timeline_text=timeline, provenance_message_id=message_id,
-                              provenance_start=start, provenance_end=end, updated_at=datetime.utcnow()))
+            for p in [i for i in active if i.kind=="chief_complaint"]:
+                p.status="resolved"; active.remove(p)
+            add(kind, value, "active", timeline, start, end)
             continue
         if kind=="medication" and status=="stopped":
-            act=db.query(MemoryItem).filter_by(patient_id=patient_id, kind="medication", value=value, status="active").all()
+            act=find("medication", value)
             for a in act:
                 a.status="stopped"; a.timeline_text=timeline or a.timeline_text
                 a.provenance_message_id=message_id; a.provenance_start=start; a.provenance_end=end
+                active.remove(a)
             if not act:
-                db.add(MemoryItem(patient_id=patient_id, kind="medication", value=value, status="stopped",
-                                  timeline_text=timeline, provenance_message_id=message_id,
-                                  provenance_start=start, provenance_end=end, updated_at=datetime.utcnow()))
+                add("medication", value, "stopped", timeline, start, end)
             continue
-        ex=db.query(MemoryItem).filter_by(patient_id=patient_id, kind=kind, value=value, status="active").first()
+        ex=find(kind, value)
         if ex:
+            ex=ex[0]
             ex.updated_at=datetime.utcnow()
             ex.provenance_message_id=message_id; ex.provenance_start=start; ex.provenance_end=end
             continue
-        db.add(MemoryItem(patient_id=patient_id, kind=kind, value=value, status="active",
-                          timeline_text=timeline, provenance_message_id=message_id,
-                          provenance_start=start, provenance_end=end, updated_at=datetime.utcnow()))
-    db.commit()
+        add(kind, value, "active", timeline, start, end)
 
 def profile_snapshot(db: Session, patient_id: int) -> Dict:
     items=db.query(MemoryItem).filter_by(patient_id=patient_id).all()
@@ -58,8 +77,9 @@ def profile_snapshot(db: Session, patient_id: int) -> Dict:
 def prov(i: MemoryItem) -> Dict:
     return {"message_id": i.provenance_message_id, "start": i.provenance_start, "end": i.provenance_end}
 
-async def triage_summary(db: Session, patient_id: int, trigger: str) -> List[str]:
-    snap=profile_snapshot(db, patient_id)
+async def triage_summary(db: AsyncSession, patient_id: int, trigger: str, snap: Optional[Dict]=None) -> List[str]:
+    if snap is None:
+        snap=await db.run_sync(profile_snapshot, patient_id)
     bullets=[]
     if snap.get("chief_complaint"): bullets.append(f"Chief complaint: {snap['chief_complaint']}")
     if snap.get("symptoms"): bullets.append("Symptoms: " + ", ".join([s["value"] for s in snap["symptoms"]][:5]))
@@ -80,12 +100,77 @@ async def triage_summary(db: Session, patient_id: int, trigger: str) -> List[str
     except Exception:
         return bullets
 
-async def create_ticket(db: Session, clinic_id: int, patient_id: int, thread_id: int, triggering_message_id: int, risk_level: str, triggering_text: str):
-    summary=await triage_summary(db, patient_id, triggering_text)
-    snap=profile_snapshot(db, patient_id)
+async def create_ticket(db: AsyncSession, clinic_id: int, patient_id: int, thread_id: int, triggering_message_id: int, risk_level: str, triggering_text: str, snap: Optional[Dict]=None, summary: Optional[List[str]]=None):
+    if snap is None:
+        snap=await db.run_sync(profile_snapshot, patient_id)
+    if summary is None:
+        summary=await triage_summary(db, patient_id, triggering_text, snap)
+    now=datetime.utcnow()
     t=Ticket(clinic_id=clinic_id, patient_id=patient_id, thread_id=thread_id,
              status="open", triggering_message_id=triggering_message_id,
              risk_level=risk_level, triage_summary_json=summary, profile_snapshot_json=snap,
-             created_at=datetime.utcnow(), closed_at=None)
-    db.add(t); db.commit(); db.refresh(t)
+             escalation_count=1, created_at=now, updated_at=now, triaged_at=now, closed_at=None)
+    db.add(t); await db.commit()
+    ticket_index.add(ticket_summary(t))
     return t
+
+RISK_RANK={"medium":1,"high":2}
+# 同进程内按 thread 串行（SQLite 不支持 FOR UPDATE）；不用的锁随 GC 消失
+_thread_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]"=weakref.WeakValueDictionary()
+
+async def _coalesce_target(db: AsyncSession, thread_id: int, now: datetime) -> Optional[Ticket]:
+    if ESCALATION_COALESCE_WINDOW_S<=0:
+        return None
+    cutoff=now-timedelta(seconds=ESCALATION_COALESCE_WINDOW_S)
+    return (await db.execute(
+        select(Ticket).filter(Ticket.thread_id==thread_id, Ticket.status=="open", Ticket.updated_at>=cutoff)
+        .order_by(Ticket.id.desc()).limit(1))).scalars().first()
+
+def _needs_triage(t: Optional[Ticket], now: datetime) -> bool:
+    # 摘要（可能要调 LLM）新 ticket 必须有，已有 ticket 每个间隔最多刷新一次
+    return t is None or t.triaged_at is None or (now-t.triaged_at).total_seconds()>=TRIAGE_REFRESH_INTERVAL_S
+
+async def escalate(db: AsyncSession, clinic_id: int, patient_id: int, thread_id: int, triggering_message_id: int, risk_level: str, triggering_text: str, snap: Optional[Dict]=None) -> Tuple[Ticket, bool]:
+    """
+    Open a ticket for a risky message, or fold it into the thread's open ticket when that
+    ticket saw an escalation within ESCALATION_COALESCE_WINDOW_S. Returns (ticket, created).
+
+    The triage summary is computed before the write transaction, so a slow LLM never holds a
+    connection or lock. The write transaction locks the thread row (SELECT ... FOR UPDATE), so
+    concurrent risky messages of one thread serialize and coalesce instead of each opening a ticket.
+    """
+    now=datetime.utcnow()
+    if snap is None:
+        snap=await db.run_sync(profile_snapshot, patient_id)
+    summary=None
+    if _needs_triage(await _coalesce_target(db, thread_id, now), now):
+        await db.commit()  # 结束只读事务，LLM 调用期间不占连接
+        summary=await triage_summary(db, patient_id, triggering_text, snap)
+    lock=_thread_locks.setdefault(thread_id, asyncio.Lock())
+    async with lock:
+        return await _escalate_locked(db, clinic_id, patient_id, thread_id, triggering_message_id, risk_level, triggering_text, snap, summary, now)
+
+async def _escalate_locked(db: AsyncSession, clinic_id: int, patient_id: int, thread_id: int, triggering_message_id: int, risk_level: str, triggering_text: str, snap: Dict, summary: Optional[List[str]], now: datetime) -> Tuple[Ticket, bool]:
+    while True:
+        await db.commit()
+        await db.execute(select(Thread.id).filter(Thread.id==thread_id).with_for_update())
+        t=await _coalesce_target(db, thread_id, now)
+        if summary is None and _needs_triage(t, now):
+            # 加锁前看到的 ticket 已被关闭：提交放锁（rollback 会让调用方的对象过期），算好摘要再来
+            await db.commit()
+            summary=await triage_summary(db, patient_id, triggering_text, snap)
+            continue
+        break
+    if t is None:
+        return await create_ticket(db, clinic_id, patient_id, thread_id, triggering_message_id, risk_level, triggering_text, snap, summary), True
+    t.escalation_count=(t.escalation_count or 1)+1
+    t.updated_at=now
+    if RISK_RANK[risk_level]>RISK_RANK.get(t.risk_level,0):
+        t.risk_level=risk_level
+    if summary is not None:
+        t.triage_summary_json=summary
+        t.profile_snapshot_json=snap
+        t.triaged_at=now
+    await db.commit()
+    ticket_index.add(ticket_summary(t))
+    return t, False
@@ -0,0 +1,430 @@
+"""
+Clinic sharding.
+
+DATABASE_URL is the `default` shard. DATABASE_SHARDS adds more, e.g.
+"b=mysql+pymysql://...;c=mysql+pymysql://...". The clinic_shards table on the default shard
+maps clinic_id to a shard; a clinic with no row lives on the default shard. Each process
+caches that table for SHARD_MAP_TTL_S. Request sessions are chosen from the token's
+clinic_id claim, so routing adds no query. With a single shard the directory is never read.
+
+Ids are globally unique, so a moved clinic keeps its ids, and tokens, WebSocket channels
+and id-keyed caches stay valid. MySQL shards use interleaved auto-increment (increment
+SHARD_ID_STRIDE, offset = shard position + 1). SQLite shards get disjoint id ranges from
+`init`.
+
+    python -m app.shards list
+    python -m app.shards init b                          # create tables, set the id counters
+    python -m app.shards move --clinic-id 1001 --to b    # copy in batches, switch, delete source rows
+
+A move works in these steps:
+
+1. Mark the clinic `moving`. Its requests get 503 with Retry-After.
+2. Wait one cache TTL, so that every worker has seen the mark.
+3. Copy users, threads, messages, memory items, tickets and idempotency keys in batches.
+   Archived messages are copied back into the hot table.
+4. Compare the row counts.
+5. Point the directory at the target and delete the source rows.
+
+If anything fails before the switch, the partial copy is removed and the clinic is active
+on the source again. Audit events and archive segment files stay on the source.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, event, func, insert, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import db as dbmod
+from .archive import archived_messages
+from .config import DATABASE_SHARDS, SHARD_MAP_TTL_S, SHARD_ID_STRIDE, SHARD_MOVE_BATCH
+from .models import ClinicShard, IdempotencyRecord, MemoryItem, Message, Thread, Ticket, User
+from .security import decode_token
+
+DEFAULT = "default"
+SQLITE_ID_SPAN = 10 ** 12
+RETRY_AFTER_S = 30
+IN_CHUNK = 1000
+# 这些表的 id 被其他表、缓存和 WebSocket 频道引用，迁移时必须保留
+ID_MODELS = (User, Thread, Message, MemoryItem, Ticket)
+
+
+class ShardMoveError(Exception):
+    pass
+
+
+class Shard:
+    def __init__(self, name: str, index: int, engine, async_engine, session_local=None, async_session_local=None,
+                 read_sessionmaker: Optional[Callable[[Optional[int]], sessionmaker]] = None):
+        self.name, self.index = name, index
+        self.engine, self.async_engine = engine, async_engine
+        self.SessionLocal = session_local or sessionmaker(bind=engine, autocommit=False, autoflush=False, future=True)
+        self.AsyncSessionLocal = async_session_local or async_sessionmaker(bind=async_engine, autoflush=False,
+                                                                           expire_on_commit=False)
+        self._read = read_sessionmaker
+
+    def read_sessionmaker(self, user_id: Optional[int]) -> sessionmaker:
+        # 只读副本只在 default 分片上配置
+        return self._read(user_id) if self._read else self.SessionLocal
+
+
+def _interleave_ids(engine, index: int):
+    if engine.dialect.name != "mysql":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_increment(dbapi_conn, record):
+        cur = dbapi_conn.cursor()
+        cur.execute(f"SET SESSION auto_increment_increment = {SHARD_ID_STRIDE}, "
+                    f"auto_increment_offset = {index + 1}")
+        cur.close()
+
+
+class ShardRouter:
+    def __init__(self, ttl_s: float = SHARD_MAP_TTL_S):
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        self.default = Shard(DEFAULT, 0, dbmod.engine, dbmod.async_engine, dbmod.SessionLocal,
+                             dbmod.AsyncSessionLocal, dbmod.read_sessionmaker)
+        self.shards: Dict[str, Shard] = {DEFAULT: self.default}
+        # clinic_id -> (shard, status)
+        self.directory: Dict[int, Tuple[str, str]] = {}
+        self.loaded_at: Optional[float] = None
+
+    def add(self, name: str, url: str) -> Shard:
+        if name in self.shards:
+            raise ValueError(f"shard {name!r} already exists")
+        index = max(s.index for s in self.shards.values()) + 1
+        if index >= SHARD_ID_STRIDE:
+            raise ValueError(f"at most SHARD_ID_STRIDE={SHARD_ID_STRIDE} shards")
+        if len(self.shards) == 1:
+            _interleave_ids(self.default.engine, 0)
+            _interleave_ids(self.default.async_engine.sync_engine, 0)
+        engine = dbmod.make_engine(url, f"shard_{name}")
+        async_engine = dbmod.make_async_engine(dbmod.async_url(url), f"shard_{name}")
+        _interleave_ids(engine, index)
+        _interleave_ids(async_engine.sync_engine, index)
+        shard = Shard(name, index, engine, async_engine)
+        self.shards[name] = shard
+        dbmod.extra_engines[name] = engine
+        dbmod.extra_engines[f"{name}_async"] = async_engine.sync_engine
+        self.invalidate()
+        return shard
+
+    def remove(self, name: str):
+        shard = self.shards.pop(name)
+        dbmod.extra_engines.pop(name, None)
+        dbmod.extra_engines.pop(f"{name}_async", None)
+        shard.engine.dispose()
+        self.invalidate()
+
+    def all(self) -> List[Shard]:
+        return list(self.shards.values())
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def _ensure_loaded(self):
+        with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl_s:
+                return
+        # 同步查询，每个 TTL 最多一次
+        with self.default.SessionLocal() as db:
+            rows = db.query(ClinicShard.clinic_id, ClinicShard.shard, ClinicShard.status).all()
+        with self.lock:
+            self.directory = {r.clinic_id: (r.shard, r.status) for r in rows}
+            self.loaded_at = time.monotonic()
+
+    def locate(self, clinic_id: Optional[int]) -> Tuple[str, str]:
+        """(shard name, status) for a clinic."""
+        if len(self.shards) == 1 or clinic_id is None:
+            return DEFAULT, "active"
+        self._ensure_loaded()
+        return self.directory.get(int(clinic_id), (DEFAULT, "active"))
+
+    def for_clinic(self, clinic_id: Optional[int]) -> Shard:
+        name, status = self.locate(clinic_id)
+        if status == "moving":
+            raise HTTPException(status_code=503, detail="clinic is being moved, retry shortly",
+                                headers={"Retry-After": str(RETRY_AFTER_S)})
+        shard = self.shards.get(name)
+        if shard is None:
+            raise RuntimeError(f"clinic {clinic_id} is mapped to unknown shard {name!r}")
+        return shard
+
+    def for_token(self, token: str) -> Shard:
+        if len(self.shards) == 1:
+            return self.default
+        try:
+            clinic_id = decode_token(token).get("clinic_id")
+        except Exception:
+            clinic_id = None  # 无效 token 之后会被 auth_user 拒绝
+        return self.for_clinic(clinic_id)
+
+    def assign(self, clinic_id: int, shard: str, status: str = "active"):
+        if shard not in self.shards:
+            raise ValueError(f"unknown shard {shard!r}")
+        with self.default.SessionLocal() as db:
+            row = db.get(ClinicShard, clinic_id)
+            if row is None:
+                row = ClinicShard(clinic_id=clinic_id)
+                db.add(row)
+            row.shard, row.status, row.updated_at = shard, status, datetime.utcnow()
+            db.commit()
+        self.invalidate()
+
+
+router = ShardRouter()
+for _spec in filter(None, (s.strip() for s in DATABASE_SHARDS.split(";"))):
+    _name, _, _url = _spec.partition("=")
+    router.add(_name.strip(), _url.strip())
+
+
+# -------------------------
+# FastAPI dependencies（按 token 里的 clinic_id 选分片）
+# -------------------------
+def get_db(token: str = ""):
+    db = router.for_token(token).SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(token: str = ""):
+    db = router.for_token(token).read_sessionmaker(dbmod._token_user_id(token))()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db(token: str = ""):
+    async with router.for_token(token).AsyncSessionLocal() as db:
+        yield db
+
+
+# -------------------------
+# Shard setup and clinic moves
+# -------------------------
+def _sqlite_seq(conn, table: str) -> Optional[int]:
+    return conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = :t"), {"t": table}).scalar()
+
+
+def init_shard(shard: Shard) -> Dict[str, int]:
+    """Create missing tables and start the shard's id counters above every id in use on any shard."""
+    dbmod.Base.metadata.create_all(shard.engine)
+    out = {}
+    for model in ID_MODELS:
+        table = model.__tablename__
+        top = 0
+        for other in router.all():
+            with other.engine.connect() as conn:
+                top = max(top, conn.execute(select(func.max(model.id))).scalar() or 0)
+        with shard.engine.begin() as conn:
+            if shard.engine.dialect.name == "sqlite":
+                # SQLite 没有交错自增：每个分片一个 id 区间
+                start = max(top, shard.index * SQLITE_ID_SPAN)
+                cur = _sqlite_seq(conn, table)
+                if cur is None:
+                    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:t, :s)"), {"t": table, "s": start})
+                elif cur < start:
+                    conn.execute(text("UPDATE sqlite_sequence SET seq = :s WHERE name = :t"), {"t": table, "s": start})
+                out[table] = max(cur or 0, start)
+            else:
+                conn.execute(text(f"ALTER TABLE {table} AUTO_INCREMENT = {top + 1}"))
+                out[table] = top + 1
+    return out
+
+
+def _chunks(ids: List[int], n: int = IN_CHUNK) -> Iterable[List[int]]:
+    for i in range(0, len(ids), n):
+        yield ids[i:i + n]
+
+
+def _plan(db: Session, clinic_id: int) -> List[Tuple[type, List]]:
+    """(model, filters) for every row of the clinic, parents first."""
+    users = [i for (i,) in db.execute(select(User.id).where(User.clinic_id == clinic_id).order_by(User.id))]
+    threads = [i for c in _chunks(users) for (i,) in db.execute(select(Thread.id).where(Thread.patient_id.in_(c)))]
+    return [
+        (User, [User.clinic_id == clinic_id]),
+        (Thread, [Thread.id.in_(c) for c in _chunks(threads)]),
+        (Message, [Message.thread_id.in_(c) for c in _chunks(threads)]),
+        (MemoryItem, [MemoryItem.patient_id.in_(c) for c in _chunks(users)]),
+        (Ticket, [Ticket.clinic_id == clinic_id]),
+        (IdempotencyRecord, [IdempotencyRecord.user_id.in_(c) for c in _chunks(users)]),
+    ]
+
+
+def _row_batches(db: Session, model, cond, batch: int) -> Iterable[List[Dict]]:
+    table, last = model.__table__, None
+    while True:
+        q = select(table).where(cond)
+        if last is not None:
+            q = q.where(table.c.id > last)
+        rows = [dict(r) for r in db.execute(q.order_by(table.c.id).limit(batch)).mappings()]
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]["id"]
+
+
+def _count(db: Session, clinic_id: int) -> Dict[str, int]:
+    return {model.__tablename__: sum(db.execute(select(func.count()).select_from(model).where(c)).scalar()
+                                     for c in conds)
+            for model, conds in _plan(db, clinic_id)}
+
+
+def purge_clinic(db: Session, clinic_id: int, batch: int = SHARD_MOVE_BATCH) -> Dict[str, int]:
+    """Delete every row of the clinic from one shard, children first."""
+    out = {}
+    for model, conds in reversed(_plan(db, clinic_id)):
+        n = 0
+        for cond in conds:
+            while True:
+                ids = [i for (i,) in db.execute(select(model.id).where(cond).order_by(model.id).limit(batch))]
+                if not ids:
+                    break
+                db.execute(delete(model).where(model.id.in_(ids)))
+                db.commit()
+                n += len(ids)
+        out[model.__tablename__] = n
+    return out
+
+
+def _check_id_space(src: Session, tgt: Session, target: Shard, plan):
+    if target.engine.dialect.name != "sqlite":
+        return  # MySQL 交错自增：别的分片的 id 永远不会被目标分片再分配
+    for model, conds in plan:
+        if model not in ID_MODELS:
+            continue
+        top = max([src.execute(select(func.max(model.id)).where(c)).scalar() or 0 for c in conds] or [0])
+        seq = _sqlite_seq(tgt.connection(), model.__tablename__) or 0
+        if top > seq:
+            raise ShardMoveError(f"{model.__tablename__}: ids up to {top} would push shard {target.name!r}'s id "
+                                 f"counter ({seq}) into another shard's range; run `init` on it or move to a "
+                                 f"shard with a higher range")
+
+
+def _copy(src: Session, tgt: Session, target: Shard, clinic_id: int, batch: int,
+          progress: Optional[Callable[[str, int], None]]) -> Dict[str, int]:
+    plan = _plan(src, clinic_id)
+    _check_id_space(src, tgt, target, plan)
+    out = {}
+    thread_ids: List[int] = []
+    for model, conds in plan:
+        name, n = model.__tablename__, 0
+        for cond in conds:
+            for rows in _row_batches(src, model, cond, batch):
+                if model is Thread:
+                    thread_ids.extend(r["id"] for r in rows)
+                if model is IdempotencyRecord:
+                    for r in rows:
+                        del r["id"]  # 没有被引用，由目标库重新分配
+                try:
+                    tgt.execute(insert(model), rows)
+                    tgt.commit()
+                except IntegrityError as e:
+                    tgt.rollback()
+                    raise ShardMoveError(f"{name}: {e.orig}") from e
+                n += len(rows)
+                if progress:
+                    progress(name, n)
+        out[name] = n
+
+    # 归档的消息放回目标库热表，之后由目标库的归档任务重新归档
+    cols = [c.key for c in Message.__table__.columns]
+    n, pending = 0, []
+    for tid in thread_ids + [None]:
+        if tid is not None:
+            msgs, _ = archived_messages(src, tid, None, sys.maxsize)
+            pending.extend({k: getattr(m, k) for k in cols} for m in msgs)
+        if pending and (len(pending) >= batch or tid is None):
+            try:
+                tgt.execute(insert(Message), pending)
+                tgt.commit()
+            except IntegrityError as e:
+                tgt.rollback()
+                raise ShardMoveError(f"archived messages: {e.orig}") from e
+            n += len(pending)
+            pending = []
+    out["archived_messages"] = n
+    return out
+
+
+def move_clinic(clinic_id: int, target: str, batch: int = SHARD_MOVE_BATCH, settle_s: Optional[float] = None,
+                progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, Dict[str, int]]:
+    """Move all rows of a clinic to another shard; returns copied and deleted row counts."""
+    if target not in router.shards:
+        raise ShardMoveError(f"unknown shard {target!r}")
+    router.invalidate()
+    # moving 状态下源分片仍是权威数据：中断的迁移可以直接重跑
+    src_name, _ = router.locate(clinic_id)
+    if src_name == target:
+        return {"copied": {}, "deleted": {}}
+    src, tgt = router.shards[src_name], router.shards[target]
+
+    router.assign(clinic_id, src_name, "moving")
+    # 等所有 worker 的目录缓存过期，确认不再有写入落到源分片
+    time.sleep(router.ttl_s + 1 if settle_s is None else settle_s)
+    try:
+        with src.SessionLocal() as s, tgt.SessionLocal() as t:
+            purge_clinic(t, clinic_id, batch)  # 上次中断留下的半份数据
+            copied = _copy(s, t, tgt, clinic_id, batch, progress)
+            expected = _count(s, clinic_id)
+            expected["messages"] += copied["archived_messages"]
+            got = _count(t, clinic_id)
+            if got != expected:
+                raise ShardMoveError(f"row counts differ after copy: source {expected}, target {got}")
+    except BaseException:
+        with tgt.SessionLocal() as t:
+            purge_clinic(t, clinic_id, batch)
+        router.assign(clinic_id, src_name, "active")
+        raise
+    router.assign(clinic_id, target, "active")
+    with src.SessionLocal() as s:
+        deleted = purge_clinic(s, clinic_id, batch)
+    return {"copied": copied, "deleted": deleted}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list", help="shards and clinic assignments")
+    init = sub.add_parser("init", help="create tables on a shard and set its id counters")
+    init.add_argument("shard")
+    mv = sub.add_parser("move", help="move a clinic to another shard")
+    mv.add_argument("--clinic-id", type=int, required=True)
+    mv.add_argument("--to", required=True)
+    mv.add_argument("--batch", type=int, default=SHARD_MOVE_BATCH)
+    mv.add_argument("--settle-s", type=float, help="wait after marking the clinic moving (default SHARD_MAP_TTL_S + 1)")
+    a = ap.parse_args()
+
+    if a.cmd == "list":
+        with router.default.SessionLocal() as db:
+            rows = db.query(ClinicShard).order_by(ClinicShard.clinic_id).all()
+        for s in router.all():
+            print(f"{s.name:12} #{s.index}  {s.engine.url.render_as_string(hide_password=True)}")
+        for r in rows:
+            print(f"clinic {r.clinic_id}: {r.shard} ({r.status})")
+    elif a.cmd == "init":
+        print(json.dumps(init_shard(router.shards[a.shard]), indent=2))
+    else:
+        def progress(table: str, n: int):
+            print(f"\r{table}: {n} rows", end="", file=sys.stderr, flush=True)
+
+        report = move_clinic(a.clinic_id, a.to, a.batch, a.settle_s, progress)
+        print(file=sys.stderr)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Startup as a background task plus readiness reporting.
+
+The process starts serving immediately; `/healthz` answers as soon as the event loop runs.
+`Readiness.run()` then goes through these phases in order and records each one:
+
+  db        async `SELECT 1` on every shard with exponential backoff (logs an error after DB_STARTUP_TIMEOUT_S
+            but keeps retrying, so a late database still brings the worker up)
+  replica   same for DATABASE_READ_URL, if one is configured
+  schema    tables/columns from db/init.sql compared with each shard; read-only unless
+            DB_AUTO_CREATE=true, in which case app.migrate brings the shard up to date here
+            (missing tables, columns and indexes). A mismatch (e.g. the upgrade has not run
+            yet) is re-checked with backoff, not fatal
+  warmup    fill the sync and async pools, run registered warmups (demo accounts) and the NLP
+            matchers once
+  ollama / llm / asr
+            one short GET each through the shared HTTP client; failures only mark the
+            dependency degraded, replies then use the fallback paths
+
+`/readyz` returns 503 until db, replica, schema and warmup are ok, and afterwards whenever
+a shard does not answer a ping.
+"""
+import asyncio
+import logging
+import re
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import inspect, text
+from starlette.concurrency import run_in_threadpool
+
+from .config import (DB_STARTUP_TIMEOUT_S, DB_AUTO_CREATE, WARMUP_DB_CONNECTIONS, SCHEMA_FILE, OLLAMA_BASE_URL,
+                     ASR_BASE_URL)
+
+# 尽早取时间：main 导入本模块时开始计 cold start
+T0 = time.perf_counter()
+
+log = logging.getLogger("nightingale.startup")
+
+CRITICAL = ("db", "replica", "schema", "warmup")
+BACKOFF_START_S = 0.1
+BACKOFF_MAX_S = 2.0
+SCHEMA_RETRY_MAX_S = 10.0
+PROBE_TIMEOUT_S = 2.0
+WARMUP_TEXT = ("My name is Alex Tan, NRIC S1234567D, phone 91234567. I have a cough and chest pain. "
+               "I take metformin. I stopped ibuprofen last week. I am allergic to penicillin.")
+
+_TABLE_RE = re.compile(r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?\s*\((.*?)\)\s*ENGINE", re.I | re.S)
+_NOT_COLUMN = {"PRIMARY", "UNIQUE", "KEY", "INDEX", "FOREIGN", "CONSTRAINT", "FULLTEXT", "CHECK"}
+
+
+def expected_schema(path: str = SCHEMA_FILE) -> Dict[str, Set[str]]:
+    """table -> column names, parsed from the CREATE TABLE statements of init.sql."""
+    with open(path, encoding="utf-8") as f:
+        sql = re.sub(r"--[^\n]*", "", f.read())
+    out: Dict[str, Set[str]] = {}
+    for table, body in _TABLE_RE.findall(sql):
+        cols = set()
+        for line in body.split("\n"):
+            tok = line.strip().split(None, 1)
+            if tok and tok[0].upper() not in _NOT_COLUMN:
+                cols.add(tok[0].strip("`,"))
+        out[table] = cols
+    return out
+
+
+def schema_problems(conn, expected: Dict[str, Set[str]]) -> List[str]:
+    insp = inspect(conn)
+    have = set(insp.get_table_names())
+    problems = []
+    for table, cols in sorted(expected.items()):
+        if table not in have:
+            problems.append(f"missing table {table}")
+            continue
+        missing = cols - {c["name"] for c in insp.get_columns(table)}
+        if missing:
+            problems.append(f"{table}: missing columns {', '.join(sorted(missing))}")
+    return problems
+
+
+class Phase:
+    __slots__ = ("status", "detail", "attempts", "seconds", "critical")
+
+    def __init__(self, critical: bool):
+        self.status, self.detail, self.attempts, self.seconds, self.critical = "pending", "", 0, None, critical
+
+    def as_dict(self) -> Dict:
+        d = {"status": self.status, "critical": self.critical}
+        if self.detail:
+            d["detail"] = self.detail
+        if self.attempts > 1:
+            d["attempts"] = self.attempts
+        if self.seconds is not None:
+            d["ms"] = round(self.seconds * 1000, 1)
+        return d
+
+
+class Readiness:
+    def __init__(self):
+        self.phases: Dict[str, Phase] = {}
+        self.ready_s: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        # 额外的同步 warmup（在线程池里跑），例如 main 的 demo 账号
+        self.warmups: List[Callable[[], None]] = []
+        self.reset()
+
+    def reset(self):
+        self.phases = {n: Phase(n in CRITICAL) for n in CRITICAL + ("ollama", "llm", "asr")}
+        self.ready_s = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_s is not None
+
+    def start(self):
+        self.reset()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+
+    def report(self) -> Dict:
+        return {"ready": self.ready,
+                "cold_start_ms": round(self.ready_s * 1000, 1) if self.ready_s is not None else None,
+                "uptime_s": round(time.perf_counter() - T0, 1),
+                "checks": {n: p.as_dict() for n, p in self.phases.items()}}
+
+    async def _phase(self, name: str, coro):
+        p, t0 = self.phases[name], time.perf_counter()
+        p.status = "running"
+        try:
+            detail = await coro
+            p.status, p.detail = "ok", detail or ""
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            p.status, p.detail = ("failed" if p.critical else "degraded"), f"{type(e).__name__}: {e}"[:300]
+            log.warning("startup phase %s: %s", name, p.detail)
+        p.seconds = time.perf_counter() - t0
+        return p.status == "ok"
+
+    async def run(self):
+        from .db import engine, read_engine
+        from .shards import router
+
+        shards = router.all()
+        if not await self._phase("db", self._wait_db(
+                "db", lambda: asyncio.gather(*(_ping(s.async_engine) for s in shards)))):
+            return
+        if read_engine is engine:
+            self.phases["replica"].status, self.phases["replica"].detail = "ok", "not configured"
+        elif not await self._phase("replica", self._wait_db(
+                "replica", lambda: run_in_threadpool(_sync_ping, read_engine))):
+            return
+        delay = BACKOFF_START_S
+        while True:
+            self.phases["schema"].attempts += 1
+            if await self._phase("schema", self._schema(shards)):
+                break
+            # 库结构不对（比如迁移还在跑）：过一会儿再查，不用重启进程
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SCHEMA_RETRY_MAX_S)
+        # 外部服务探测和 warmup 并行，它们不影响就绪
+        probes = asyncio.gather(
+            self._phase("ollama", self._probe(f"{OLLAMA_BASE_URL.rstrip('/')}/api/tags")),
+            self._phase("llm", self._probe(_llm_base_url())),
+            self._phase("asr", self._probe(ASR_BASE_URL)))
+        if await self._phase("warmup", self._warmup(shards)):
+            self.ready_s = time.perf_counter() - T0
+            log.info("ready %.0f ms after import", self.ready_s * 1000)
+        await probes
+
+    async def _wait_db(self, name: str, ping):
+        p = self.phases[name]
+        deadline = time.monotonic() + DB_STARTUP_TIMEOUT_S
+        delay, warned = BACKOFF_START_S, False
+        while True:
+            p.attempts += 1
+            try:
+                await asyncio.wait_for(ping(), PROBE_TIMEOUT_S * 2)
+                return ""
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                p.detail = f"{type(e).__name__}: {e}"[:300]
+                if not warned and time.monotonic() > deadline:
+                    # 不退出进程：数据库恢复后 worker 自己变为就绪
+                    log.error("%s not reachable after %.0fs, still retrying: %s", name, DB_STARTUP_TIMEOUT_S, p.detail)
+                    warned = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX_S)
+
+    async def _schema(self, shards) -> str:
+        expected = expected_schema()
+        problems, created = [], []
+        for shard in shards:
+            async with shard.async_engine.connect() as conn:
+                found = await conn.run_sync(schema_problems, expected)
+            if found and DB_AUTO_CREATE:
+                from .migrate import upgrade
+                async with shard.async_engine.begin() as conn:
+                    await conn.run_sync(upgrade)
+                async with shard.async_engine.connect() as conn:
+                    found = await conn.run_sync(schema_problems, expected)
+                created.append(shard.name)
+            problems += [f"{shard.name}: {p}" if len(shards) > 1 else p for p in found]
+        if problems:
+            raise RuntimeError("; ".join(problems[:10]) + " (run `python -m app.migrate`)")
+        return f"{len(expected)} tables" + (f", upgraded schema on {', '.join(created)}" if created else "")
+
+    async def _warmup(self, shards) -> str:
+        from .nlp.memory import extract_memory_facts
+        from .nlp.redaction import redact_no_phi
+        from .nlp.risk import assess_risk
+
+        n = max(0, WARMUP_DB_CONNECTIONS)
+        # 同时借出 n 个连接，连接池里才会真正建好 n 个
+        for shard in shards:
+            await asyncio.gather(*(_ping(shard.async_engine) for _ in range(n)))
+            await asyncio.gather(*(run_in_threadpool(_sync_ping, shard.engine) for _ in range(n)))
+
+        for fn in self.warmups:
+            await run_in_threadpool(fn)
+        assess_risk(WARMUP_TEXT), redact_no_phi(WARMUP_TEXT), extract_memory_facts(WARMUP_TEXT)
+        return f"{n} db connections per pool"
+
+    async def _probe(self, url: str) -> str:
+        from .http_client import http_client
+        # 任何 HTTP 响应都说明可达；顺便建立 keep-alive 连接
+        r = await http_client().get(url, timeout=PROBE_TIMEOUT_S)
+        return f"HTTP {r.status_code}"
+
+
+def _llm_base_url() -> str:
+    from .llm_client import LLM_BASE_URL
+    return f"{LLM_BASE_URL.rstrip('/')}/api/tags"
+
+
+async def _ping(eng):
+    async with eng.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+
+def _sync_ping(eng):
+    with eng.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+readiness = Readiness()
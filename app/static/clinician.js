@@ -1,5 +1,6 @@
 
 let token=null, clinicId=null, selected=null, ws=null;
+let lastEventId=null, reconnectDelay=500, staleTimer=null, nextCursor=null;
 
 function setStatus(m){document.getElementById("authStatus").innerText=m}
 
@@ -10,37 +11,83 @@ async function login(){
   if(!r.ok){setStatus("Login failed");return}
   const d=await r.json(); token=d.token; setStatus("Logged in");
   await refreshTickets();
+  connectWS();
 }
 
 async function refreshTickets(){
   const r=await fetch(`/api/clinician/tickets?token=${encodeURIComponent(token)}`);
   const d=await r.json(); clinicId=d.clinic_id;
-  renderTickets(d.tickets); connectWS();
+  if(d.last_event_id!=null) lastEventId=d.last_event_id;
+  document.getElementById("tickets").innerHTML="";
+  renderTickets(d.tickets); setNextCursor(d.next_cursor);
+}
+
+async function loadMoreTickets(){
+  if(nextCursor==null) return;
+  const r=await fetch(`/api/clinician/tickets?token=${encodeURIComponent(token)}&cursor=${nextCursor}`);
+  const d=await r.json();
+  renderTickets(d.tickets); setNextCursor(d.next_cursor);
+}
+
+function setNextCursor(c){
+  nextCursor=c; document.getElementById("moreTickets").classList.toggle("hidden", c==null);
 }
 
 function connectWS(){
-  if(ws) ws.close();
-  ws=new WebSocket(`ws://${location.host}/ws/clinic/${clinicId}?token=${encodeURIComponent(token)}`);
-  ws.onopen=()=>ws.send("ping");
+  if(ws){ws.onclose=null; ws.close();}
+  const resume=lastEventId!=null?`&last_event_id=${lastEventId}`:"";
+  const proto=location.protocol==="https:"?"wss":"ws";
+  ws=new WebSocket(`${proto}://${location.host}/ws/clinic/${clinicId}?token=${encodeURIComponent(token)}${resume}`);
+  ws.onopen=()=>{reconnectDelay=500; armStaleTimer();};
   ws.onmessage=(e)=>{
+    armStaleTimer();
     const m=JSON.parse(e.data);
-    if(m.type==="ticket_created" || m.type==="ticket_closed"){ refreshTickets(); }
+    if(m.id!=null) lastEventId=m.id;
+    if(m.type==="reset"){ refreshTickets(); }
+    else if(m.type==="ticket_created" && m.ticket){ prependTicket(m.ticket, true); }
+    else if(m.type==="ticket_updated" && m.ticket){ prependTicket(m.ticket, false); }
+    else if(m.type==="ticket_closed"){ removeTicket(m.ticket_id); }
+  };
+  ws.onclose=()=>{
+    ws=null; clearTimeout(staleTimer);
+    setTimeout(connectWS,reconnectDelay); reconnectDelay=Math.min(reconnectDelay*2,10000);
   };
-  setInterval(()=>{try{ws.send("ping")}catch(e){}},4000);
+}
+
+// 服务端空闲时发心跳，超时未收到任何帧则重连
+function armStaleTimer(){clearTimeout(staleTimer); staleTimer=setTimeout(()=>{if(ws) ws.close();},40000);}
+
+function ticketElement(t){
+  const div=document.createElement("div");
+  div.className="ticket"; div.dataset.id=t.id; div.onclick=()=>selectTicket(t.id);
+  const repeats=(t.escalation_count||1)>1?` ×${t.escalation_count}`:"";
+  div.innerHTML=`<b>Ticket #${t.id}</b> (risk=${t.risk_level}${repeats})<br/><small>thread=${t.thread_id} patient=${t.patient_id}</small><br/>${escapeHtml(t.headline)}`;
+  return div;
 }
 
 function renderTickets(tickets){
-  const box=document.getElementById("tickets"); box.innerHTML="";
-  tickets.forEach(t=>{
-    const div=document.createElement("div");
-    div.className="ticket"; div.onclick=()=>selectTicket(t);
-    div.innerHTML=`<b>Ticket #${t.id}</b> (risk=${t.risk_level})<br/><small>thread=${t.thread_id} patient=${t.patient_id}</small><br/>${(t.triage_summary||[]).slice(0,3).map(escapeHtml).join("<br/>")}`;
-    box.appendChild(div);
-  });
+  const box=document.getElementById("tickets");
+  tickets.forEach(t=>box.appendChild(ticketElement(t)));
+}
+
+// 实时事件只增删单个条目，不再整表重拉
+function prependTicket(t, insert){
+  const box=document.getElementById("tickets");
+  const old=box.querySelector(`[data-id="${t.id}"]`);
+  if(old){ old.replaceWith(ticketElement(t)); return; }
+  if(insert) box.prepend(ticketElement(t));
 }
 
-function selectTicket(t){
-  selected=t; document.getElementById("ticketDetail").innerText=JSON.stringify(t,null,2);
+function removeTicket(id){
+  const el=document.getElementById("tickets").querySelector(`[data-id="${id}"]`);
+  if(el) el.remove();
+}
+
+async function selectTicket(id){
+  const r=await fetch(`/api/clinician/tickets/${id}?token=${encodeURIComponent(token)}`);
+  if(!r.ok) return;
+  selected=(await r.json()).ticket;
+  document.getElementById("ticketDetail").innerText=JSON.stringify(selected,null,2);
 }
 
 async function sendReply(){
@@ -48,7 +95,6 @@ async function sendReply(){
   const text=document.getElementById("replyText").value; document.getElementById("replyText").value="";
   const r=await fetch(`/api/clinician/reply?token=${encodeURIComponent(token)}`,{method:"POST",headers:{'Content-Type':'application/json'},body:JSON.stringify({ticket_id:selected.id,text})});
   document.getElementById("replyStatus").innerText=r.ok?"Sent":"Failed";
-  await refreshTickets();
 }
 
 function escapeHtml(s){return (s||"").replaceAll("&","&amp;").replaceAll("<","&lt;").replaceAll(">","&gt;");}
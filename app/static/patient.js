@@ -1,8 +1,11 @@
 let token = null, threadId = null, ws = null;
-let wsPingTimer = null;
-let pollTimer = null;
+// 断线重连时带上 lastEventId，服务端只补发错过的事件
+let lastEventId = null, reconnectDelay = 500, reconnectTimer = null, staleTimer = null;
+const HEARTBEAT_GRACE_MS = 40000;
 let sendingText = false;
 let sendingAudio = false;
+// profile 以条目 map 保存，WS 推送的是相对 profileVersion 的增量
+let profileItems = {}, profileVersion = null;
 
 function setStatus(m){ document.getElementById("authStatus").innerText = m; }
 
@@ -20,8 +23,17 @@ function escapeHtml(s){
 
 function appendMessage(m){
   const box = document.getElementById("chat");
+  if(m.id != null){
+    // replay 可能重复投递；真实消息到达后移除本地占位
+    if(box.querySelector(`[data-id="${m.id}"]`)) return;
+    if(m.sender_role === "patient"){
+      const placeholder = box.querySelector(".msg.pending");
+      if(placeholder) placeholder.remove();
+    }
+  }
   const div = document.createElement("div");
-  div.className = `msg ${m.sender_role}`;
+  div.className = `msg ${m.sender_role}` + (m.id == null ? " pending" : "");
+  if(m.id != null) div.dataset.id = m.id;
   div.innerHTML = `
     <div>${escapeHtml(m.content)}</div>
     <div class="meta">
@@ -36,6 +48,49 @@ function renderProfile(p){
   document.getElementById("profile").innerText = JSON.stringify(p || {}, null, 2);
 }
 
+function flattenProfile(p){
+  const items = {};
+  const put = (prefix, it) => {
+    let key = `${prefix}:${it.value}`, n = 2;
+    while(key in items){ key = `${prefix}:${it.value}#${n}`; n++; }
+    items[key] = it;
+  };
+  if(p && p.chief_complaint != null) items.chief_complaint = p.chief_complaint;
+  ((p && p.symptoms) || []).forEach(it => put("symptom", it));
+  ((p && p.medications) || []).forEach(it => put("medication", it));
+  ((p && p.allergies) || []).forEach(it => put("allergy", it));
+  return items;
+}
+
+function unflattenProfile(items){
+  const out = {chief_complaint: items.chief_complaint ?? null, symptoms: [], medications: [], allergies: []};
+  const buckets = {symptom: "symptoms", medication: "medications", allergy: "allergies"};
+  Object.keys(items).forEach(k => {
+    const b = buckets[k.split(":")[0]];
+    if(b) out[b].push(items[k]);
+  });
+  return out;
+}
+
+function setProfile(p, version){
+  profileItems = flattenProfile(p);
+  profileVersion = version ?? null;
+  renderProfile(p);
+}
+
+// 返回 false 表示本地版本对不上，需要全量拉取
+function applyProfileDelta(d){
+  if(!d) return true;
+  if(d.version === profileVersion) return true;
+  if(d.base !== null && d.base !== profileVersion) return false;
+  if(d.base === null) profileItems = {};
+  (d.del || []).forEach(k => { delete profileItems[k]; });
+  Object.assign(profileItems, d.set || {});
+  profileVersion = d.version;
+  renderProfile(unflattenProfile(profileItems));
+  return true;
+}
+
 async function login(){
   const email = document.getElementById("email").value;
   const password = document.getElementById("password").value;
@@ -58,7 +113,6 @@ async function login(){
   await loadThread();
   await refresh(true);
   connectWS();
-  startPolling();
 }
 
 async function loadThread(){
@@ -68,51 +122,66 @@ async function loadThread(){
 }
 
 function connectWS(){
-  try{
-    if(ws){ ws.close(); ws = null; }
-    if(wsPingTimer){ clearInterval(wsPingTimer); wsPingTimer = null; }
-
-    ws = new WebSocket(wsUrl(`/ws/thread/${threadId}?token=${encodeURIComponent(token)}`));
-
-    ws.onopen = () => {
-      try{ ws.send("ping"); } catch(e){}
-    };
-
-    ws.onmessage = (e) => {
-      // 后端推送格式不确定：尽量兼容
-      let msg = null;
-      try{ msg = JSON.parse(e.data); } catch(err){ return; }
-
-      if(msg.type === "new_message" && msg.message){
-        appendMessage(msg.message);
-        if(msg.profile) renderProfile(msg.profile);
-
-        if(msg.escalation_required){
-          document.getElementById("escalateBox").classList.remove("hidden");
-          document.getElementById("ticketInfo").innerText = msg.ticket_id ? ("Ticket #"+msg.ticket_id) : "";
-        }else{
-          document.getElementById("escalateBox").classList.add("hidden");
-        }
-      }
-    };
+  if(reconnectTimer){ clearTimeout(reconnectTimer); reconnectTimer = null; }
+  if(ws){ ws.onclose = null; ws.close(); ws = null; }
 
-    ws.onclose = () => {
-      // 断线后交给轮询兜底
-    };
+  const resume = lastEventId != null ? `&last_event_id=${lastEventId}` : "";
+  ws = new WebSocket(wsUrl(`/ws/thread/${threadId}?token=${encodeURIComponent(token)}${resume}`));
 
-    wsPingTimer = setInterval(()=>{
-      try{ ws && ws.readyState === 1 && ws.send("ping"); }catch(e){}
-    }, 5000);
+  ws.onopen = () => { reconnectDelay = 500; armStaleTimer(); };
 
-  }catch(e){
-    // WebSocket失败也没关系，轮询会兜底
-  }
+  ws.onmessage = (e) => {
+    armStaleTimer();
+    let msg = null;
+    try{ msg = JSON.parse(e.data); } catch(err){ return; }
+    if(msg.id != null) lastEventId = msg.id;
+
+    if(msg.type === "reset"){
+      // 断开太久，服务端 replay 缓冲已覆盖不到：全量拉一次
+      refresh(true);
+      return;
+    }
+    if(msg.type === "thread_update"){
+      (msg.messages || []).forEach(appendMessage);
+      if(!applyProfileDelta(msg.profile)) refresh(false);
+
+      if(msg.escalation_required){
+        document.getElementById("escalateBox").classList.remove("hidden");
+        document.getElementById("ticketInfo").innerText = msg.ticket_id ? ("Ticket #"+msg.ticket_id) : "";
+      }else{
+        document.getElementById("escalateBox").classList.add("hidden");
+      }
+    }
+  };
+
+  ws.onclose = () => {
+    ws = null;
+    if(staleTimer){ clearTimeout(staleTimer); staleTimer = null; }
+    reconnectTimer = setTimeout(connectWS, reconnectDelay);
+    reconnectDelay = Math.min(reconnectDelay * 2, 10000);
+  };
 }
 
-function startPolling(){
-  if(pollTimer) clearInterval(pollTimer);
-  // 每2秒拉一次，确保无需刷新页面也能看到新消息
-  pollTimer = setInterval(()=>{ refresh(false); }, 2000);
+// 服务端空闲时会发心跳；太久没收到任何帧就认为连接已死，主动重连
+function armStaleTimer(){
+  if(staleTimer) clearTimeout(staleTimer);
+  staleTimer = setTimeout(()=>{ if(ws) ws.close(); }, HEARTBEAT_GRACE_MS);
+}
+
+function wsOpen(){ return ws && ws.readyState === 1; }
+
+// 网络错误时用同一个 Idempotency-Key 重试，服务端只会执行一次
+async function postWithRetry(url, opts, attempts = 3){
+  const key = (crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`);
+  opts.headers = Object.assign({}, opts.headers, {"Idempotency-Key": key});
+  for(let i = 0; ; i++){
+    try{
+      return await fetch(url, opts);
+    }catch(err){
+      if(i + 1 >= attempts) throw err;
+      await new Promise(res => setTimeout(res, 500 * 2 ** i));
+    }
+  }
 }
 
 async function refresh(clear=false){
@@ -122,16 +191,11 @@ async function refresh(clear=false){
 
   const d = await r.json();
 
-  if(clear){
-    document.getElementById("chat").innerHTML = "";
-    (d.messages || []).forEach(appendMessage);
-  }else{
-    // 简单做法：直接全量重绘，稳定但不最省
-    document.getElementById("chat").innerHTML = "";
-    (d.messages || []).forEach(appendMessage);
-  }
+  document.getElementById("chat").innerHTML = "";
+  (d.messages || []).forEach(appendMessage);
+  if(d.last_event_id != null) lastEventId = d.last_event_id;
 
-  renderProfile(d.profile);
+  setProfile(d.profile, d.profile_version);
 
   // escalation box 同步一下（如果后端在messages里也给了）
   if(d.escalation_required){
@@ -165,7 +229,7 @@ async function sendText(){
   if(btn) btn.disabled = true;
 
   try{
-    const r = await fetch(`/api/patient/message?token=${encodeURIComponent(token)}`,{
+    const r = await postWithRetry(`/api/patient/message?token=${encodeURIComponent(token)}`,{
       method:"POST",
       headers:{'Content-Type':'application/json'},
       body: JSON.stringify({text})
@@ -184,8 +248,8 @@ async function sendText(){
       document.getElementById("ticketInfo").innerText = d.ticket_id ? ("Ticket #"+d.ticket_id) : "";
     }
 
-    // 2) 发完主动拉一次最新，保证立刻看到assistant回复/后端写入的最终内容
-    await refresh(false);
+    // 2) WS 会推送 assistant 回复；只有 WS 断开时才主动拉取
+    if(!wsOpen()) await refresh(false);
 
   }finally{
     sendingText = false;
@@ -218,7 +282,7 @@ async function sendAudio(){
     const fd = new FormData();
     fd.append("file", f, f.name);
 
-    const r = await fetch(`/api/patient/message_audio?token=${encodeURIComponent(token)}`,{
+    const r = await postWithRetry(`/api/patient/message_audio?token=${encodeURIComponent(token)}`,{
       method:"POST",
       body: fd
     });
@@ -238,8 +302,8 @@ async function sendAudio(){
     // 发完清空选择，避免你点第二次又把同一个文件再发一遍
     fileInput.value = "";
 
-    // 拉取最新：如果后端把“转写文本/assistant回复”写进messages，这里会立刻显示
-    await refresh(false);
+    // 转写文本和 assistant 回复走 WS；断开时才拉取
+    if(!wsOpen()) await refresh(false);
 
   }finally{
     sendingAudio = false;
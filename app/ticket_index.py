@@ -0,0 +1,162 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .config import TICKET_INDEX_TTL_S
+from .fastjson import dumps
+from .models import Ticket
+
+# 列表只需要这些列；triage_summary_json 只取第一条作为 headline，profile_snapshot_json 不读
+SUMMARY_COLUMNS = (Ticket.id, Ticket.clinic_id, Ticket.patient_id, Ticket.thread_id, Ticket.status,
+                   Ticket.triggering_message_id, Ticket.risk_level, Ticket.triage_summary_json,
+                   Ticket.escalation_count, Ticket.created_at, Ticket.updated_at)
+
+
+def ticket_summary(t) -> Dict[str, Any]:
+    summary = t.triage_summary_json or []
+    return {
+        "id": t.id,
+        "clinic_id": t.clinic_id,
+        "patient_id": t.patient_id,
+        "thread_id": t.thread_id,
+        "status": t.status,
+        "triggering_message_id": t.triggering_message_id,
+        "risk_level": t.risk_level,
+        "headline": (summary[0] if summary else "")[:160],
+        "escalation_count": t.escalation_count or 1,
+        "created_at": t.created_at.isoformat() + "Z",
+        "updated_at": (t.updated_at or t.created_at).isoformat() + "Z",
+    }
+
+
+class OpenTicketIndex:
+    """
+    Per-clinic in-memory view of open tickets, newest first, loaded lazily from the DB once
+    per clinic and then kept current by create_ticket / clinician_reply (and by ticket events
+    arriving from other workers over the realtime backplane).
+    """
+
+    def __init__(self, ttl_s: float = TICKET_INDEX_TTL_S):
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        self.tickets: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        # 同一份 summary 的 JSON 编码，列表接口直接拼接
+        self.encoded: Dict[int, Dict[int, bytes]] = {}
+        self.ids: Dict[int, List[int]] = {}
+        self.loaded_at: Dict[int, float] = {}
+        # 正在从 DB 加载的诊所 -> 每个加载者一份事件日志；加载期间到达的 add/remove 记下来，装入快照后重放
+        self.loading: Dict[int, List[List[Tuple]]] = {}
+
+    def page(self, db: Session, clinic_id: int, limit: int,
+             cursor: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        Keyset page ordered by id desc; cursor is the last id of the previous page.
+        db must be a primary session: a reload from a lagging replica would replace
+        fresh entries with stale ones.
+        """
+        self._ensure_loaded(db, clinic_id)
+        with self.lock:
+            ids = self.ids.get(clinic_id, [])
+            end = len(ids) if cursor is None else bisect_left(ids, cursor)
+            start = max(0, end - limit)
+            page = [self.tickets[clinic_id][i] for i in reversed(ids[start:end])]
+        next_cursor = page[-1]["id"] if page and start > 0 else None
+        return page, next_cursor
+
+    def page_json(self, db: Session, clinic_id: int, limit: int,
+                  cursor: Optional[int] = None) -> Tuple[List[bytes], Optional[int]]:
+        """Same page as page(), each summary already JSON-encoded."""
+        page, next_cursor = self.page(db, clinic_id, limit, cursor)
+        with self.lock:
+            enc = self.encoded.get(clinic_id, {})
+            out = [enc.get(t["id"]) for t in page]
+        return [b if b is not None else dumps(t) for b, t in zip(out, page)], next_cursor
+
+    def add(self, summary: Dict[str, Any]):
+        clinic_id = summary["clinic_id"]
+        data = dumps(summary)
+        with self.lock:
+            for journal in self.loading.get(clinic_id, ()):
+                journal.append(("add", summary, data))
+            if clinic_id not in self.loaded_at:
+                return  # 还没加载过的诊所，下一次 page() 会从 DB 读到
+            self._add_locked(clinic_id, summary, data)
+
+    def _add_locked(self, clinic_id: int, summary: Dict[str, Any], data: bytes):
+        bucket = self.tickets.setdefault(clinic_id, {})
+        if summary["id"] not in bucket:
+            insort(self.ids.setdefault(clinic_id, []), summary["id"])
+        bucket[summary["id"]] = summary
+        self.encoded.setdefault(clinic_id, {})[summary["id"]] = data
+
+    def has(self, clinic_id: int, ticket_id: int) -> bool:
+        with self.lock:
+            return ticket_id in self.tickets.get(clinic_id, {})
+
+    def remove(self, clinic_id: int, ticket_id: int):
+        with self.lock:
+            for journal in self.loading.get(clinic_id, ()):
+                journal.append(("remove", ticket_id))
+            self._remove_locked(clinic_id, ticket_id)
+
+    def _remove_locked(self, clinic_id: int, ticket_id: int):
+        if self.tickets.get(clinic_id, {}).pop(ticket_id, None) is None:
+            return
+        self.encoded.get(clinic_id, {}).pop(ticket_id, None)
+        ids = self.ids[clinic_id]
+        del ids[bisect_left(ids, ticket_id)]
+
+    def on_clinic_event(self, clinic_id: int, event: Dict[str, Any]):
+        if event.get("type") in ("ticket_created", "ticket_updated") and event.get("ticket"):
+            self.add(event["ticket"])
+        elif event.get("type") == "ticket_closed":
+            self.remove(clinic_id, event.get("ticket_id"))
+
+    def invalidate(self, clinic_id: Optional[int] = None):
+        with self.lock:
+            for cid in ([clinic_id] if clinic_id is not None else list(self.loaded_at)):
+                self.loaded_at.pop(cid, None)
+                self.tickets.pop(cid, None)
+                self.encoded.pop(cid, None)
+                self.ids.pop(cid, None)
+
+    def _ensure_loaded(self, db: Session, clinic_id: int):
+        loaded_at = self.loaded_at.get(clinic_id)
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl_s:
+            return
+        # TTL 兜底：backplane 丢帧时最多 ttl 秒后自愈
+        journal: List[Tuple] = []
+        with self.lock:
+            self.loading.setdefault(clinic_id, []).append(journal)
+        try:
+            rows = db.query(*SUMMARY_COLUMNS).filter(Ticket.clinic_id == clinic_id, Ticket.status == "open").all()
+            bucket = {r.id: ticket_summary(r) for r in rows}
+            encoded = {i: dumps(t) for i, t in bucket.items()}
+        except BaseException:
+            with self.lock:
+                self._end_load(clinic_id, journal)
+            raise
+        with self.lock:
+            self._end_load(clinic_id, journal)
+            self.tickets[clinic_id] = bucket
+            self.encoded[clinic_id] = encoded
+            self.ids[clinic_id] = sorted(bucket)
+            self.loaded_at[clinic_id] = time.monotonic()
+            # 快照读出之后才到的事件按顺序补上；快照里已有的重放一遍也无妨
+            for op, *args in journal:
+                if op == "add":
+                    self._add_locked(clinic_id, *args)
+                else:
+                    self._remove_locked(clinic_id, *args)
+
+    def _end_load(self, clinic_id: int, journal: List[Tuple]):
+        journals = self.loading[clinic_id]
+        journals.remove(journal)
+        if not journals:
+            del self.loading[clinic_id]
+
+
+ticket_index = OpenTicketIndex()
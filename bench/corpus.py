@@ -0,0 +1,95 @@
+"""
+Seeded generator of synthetic patient messages for the NLP microbenchmarks.
+
+Mix of short chat messages, PHI-dense messages (names, NRIC, phone numbers),
+non-English / code-switched messages and long ASR-style transcripts. The same
+seed always yields the same corpus.
+"""
+import random
+from typing import Dict, List, Optional
+
+FIRST = ["Tan", "Lim", "Siti", "Ahmad", "Priya", "Wei Ling", "Muthu", "Grace", "Daniel", "Nurul"]
+LAST = ["Wong", "Ng", "Rahman", "Kumar", "Chua", "Goh", "Lee", "Pillai"]
+SYMPTOMS = ["a headache", "a dry cough", "a rash on my arm", "back pain", "a sore throat", "nausea",
+            "a runny nose", "stomach cramps", "joint pain", "trouble sleeping"]
+MEDS = ["ibuprofen", "paracetamol", "Zyrtec", "metformin", "amlodipine", "Advil", "omeprazole"]
+ALLERGENS = ["penicillin", "nuts", "shellfish", "aspirin", "latex"]
+TIMES = ["since yesterday", "for three days", "since last week", "this morning", "on and off for a month"]
+RISKY = ["I have crushing chest pain.", "It is getting worse.", "I have a high fever.", "I feel dizzy and confused.",
+         "There is tightness in my chest.", "I feel short of breath, shortness of breath when walking."]
+FILLER = ["um", "uh", "like", "you know", "so", "actually"]
+# 本地常见的非英文 / 夹杂英文的说法
+FOREIGN = [
+    "我头痛了两天，吃了 panadol 还是没好。",
+    "医生，我咳嗽很厉害，晚上睡不着。",
+    "Saya demam sejak semalam dan rasa pening.",
+    "Sakit perut sejak pagi, I take omeprazole.",
+    "எனக்கு காய்ச்சல் இருக்கிறது, two days already.",
+    "胸口有点闷, I have chest tightness lah.",
+]
+
+
+def _nric(r: random.Random) -> str:
+    return r.choice("STFG") + "".join(r.choice("0123456789") for _ in range(7)) + r.choice("ABCDEFGHIJZ")
+
+
+def _phone(r: random.Random) -> str:
+    num = r.choice("689") + "".join(r.choice("0123456789") for _ in range(7))
+    return r.choice(["", "+65 ", "+65-", "65"]) + num
+
+
+def _clinical(r: random.Random) -> str:
+    kind = r.random()
+    if kind < 0.35:
+        return f"I have {r.choice(SYMPTOMS)} {r.choice(TIMES)}."
+    if kind < 0.6:
+        return f"I take {r.choice(MEDS)} twice a day."
+    if kind < 0.75:
+        return f"I stopped {r.choice(MEDS)} {r.choice(TIMES)} because it made me drowsy."
+    if kind < 0.9:
+        return f"I am allergic to {r.choice(ALLERGENS)}."
+    return r.choice(RISKY)
+
+
+def short_message(r: random.Random) -> str:
+    return " ".join(_clinical(r) for _ in range(r.randint(1, 3)))
+
+
+def phi_message(r: random.Random) -> str:
+    name = f"{r.choice(FIRST)} {r.choice(LAST)}"
+    parts = [f"My name is {name}.", f"My IC is {_nric(r)}.", f"You can call me at {_phone(r)}.",
+             f"My daughter's number is {_phone(r)}.", _clinical(r), f"I'm {r.choice(FIRST)}, by the way."]
+    r.shuffle(parts)
+    return " ".join(parts[: r.randint(3, len(parts))])
+
+
+def foreign_message(r: random.Random) -> str:
+    return " ".join([r.choice(FOREIGN)] + ([_clinical(r)] if r.random() < 0.5 else []))
+
+
+def long_transcript(r: random.Random, sentences: int = 60) -> str:
+    # ASR 长转写：口语填充词多、无标点段落、PHI 穿插
+    out = []
+    for _ in range(sentences):
+        roll = r.random()
+        if roll < 0.1:
+            s = phi_message(r)
+        elif roll < 0.2:
+            s = r.choice(FOREIGN)
+        else:
+            s = _clinical(r)
+        if r.random() < 0.5:
+            s = f"{r.choice(FILLER)} {s[0].lower()}{s[1:]}"
+        out.append(s)
+    return " ".join(out)
+
+
+KINDS = {"short": short_message, "phi": phi_message, "foreign": foreign_message, "long": long_transcript}
+DEFAULT_MIX = {"short": 0.5, "phi": 0.2, "foreign": 0.15, "long": 0.15}
+
+
+def generate(n: int, seed: int = 0, mix: Optional[Dict[str, float]] = None) -> List[str]:
+    r = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds, weights = list(mix), list(mix.values())
+    return [KINDS[k](r) for k in r.choices(kinds, weights, k=n)]
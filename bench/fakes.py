@@ -0,0 +1,142 @@
+"""
+Deterministic stand-ins for the upstreams the app calls, so the closed loop can be
+load-tested without Ollama or a Whisper model:
+
+- Ollama   POST /api/generate, POST /api/chat  (JSON or NDJSON streaming)
+- ASR      POST /asr/transcribe
+
+One process serves both; point OLLAMA_BASE_URL, LLM_BASE_URL and ASR_BASE_URL at it.
+
+    python -m bench.fakes --port 9100 --llm-latency-ms 300 --asr-latency-ms 500
+
+Latency = base + jitter, where jitter is derived from a hash of the request body,
+so the same input always sees the same delay and the same answer.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from typing import List
+
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "200"))
+LLM_JITTER_MS = float(os.getenv("FAKE_LLM_JITTER_MS", "100"))
+# 流式时每个 chunk 之间的间隔（模拟逐 token 输出）
+LLM_CHUNK_MS = float(os.getenv("FAKE_LLM_CHUNK_MS", "20"))
+ASR_LATENCY_MS = float(os.getenv("FAKE_ASR_LATENCY_MS", "400"))
+ASR_JITTER_MS = float(os.getenv("FAKE_ASR_JITTER_MS", "200"))
+# 上传内容以此开头时直接当作转写结果，压测脚本借此控制 transcript
+TRANSCRIPT_PREFIX = b"TRANSCRIPT:"
+
+REPLIES = [
+    "Thanks for sharing. When did this start, and has it been getting better or worse?",
+    "I understand. Are you having any other symptoms, such as fever or shortness of breath?",
+    "Got it. Have you taken anything for it so far, and did it help?",
+    "Thank you. On a scale of 1 to 10, how severe is it right now?",
+]
+TRIAGE = [
+    "- Patient reports new or worsening symptoms",
+    "- Current medications listed in profile",
+    "- No known allergies beyond profile",
+    "- Recommend clinician review",
+]
+TRANSCRIPTS = [
+    "I have had a headache since yesterday.",
+    "I take ibuprofen for back pain.",
+    "I have a cough and a mild fever.",
+    "I am allergic to penicillin.",
+]
+
+app = FastAPI(title="Nightingale fake upstreams")
+
+
+def _digest(data: bytes) -> int:
+    return int.from_bytes(hashlib.sha1(data).digest()[:8], "big")
+
+
+async def _delay(data: bytes, base_ms: float, jitter_ms: float):
+    ms = base_ms + (_digest(data) % 1000) / 1000 * jitter_ms
+    if ms > 0:
+        await asyncio.sleep(ms / 1000)
+
+
+def _chunks(text: str) -> List[str]:
+    words = text.split(" ")
+    return [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+
+
+def _ndjson(frames):
+    async def gen():
+        for i, f in enumerate(frames):
+            if i and LLM_CHUNK_MS > 0:
+                await asyncio.sleep(LLM_CHUNK_MS / 1000)
+            yield json.dumps(f) + "\n"
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    raw = await request.body()
+    body = json.loads(raw or b"{}")
+    model = body.get("model", "fake")
+    # 以 prompt 为键：同一输入不论是否流式，内容和延迟都一样
+    key = (body.get("prompt") or "").encode()
+    text = "\n".join(TRIAGE[: 3 + _digest(key) % 2])
+    await _delay(key, LLM_LATENCY_MS, LLM_JITTER_MS)
+    if body.get("stream", True):
+        frames = [{"model": model, "response": c, "done": False} for c in _chunks(text)]
+        frames.append({"model": model, "response": "", "done": True})
+        return _ndjson(frames)
+    return JSONResponse({"model": model, "response": text, "done": True})
+
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    raw = await request.body()
+    body = json.loads(raw or b"{}")
+    model = body.get("model", "fake")
+    key = json.dumps(body.get("messages") or [], sort_keys=True).encode()
+    text = REPLIES[_digest(key) % len(REPLIES)]
+    await _delay(key, LLM_LATENCY_MS, LLM_JITTER_MS)
+    if body.get("stream", True):
+        frames = [{"model": model, "message": {"role": "assistant", "content": c}, "done": False}
+                  for c in _chunks(text)]
+        frames.append({"model": model, "message": {"role": "assistant", "content": ""}, "done": True})
+        return _ndjson(frames)
+    return JSONResponse({"model": model, "message": {"role": "assistant", "content": text}, "done": True})
+
+
+@app.post("/asr/transcribe")
+async def transcribe(file: UploadFile = File(...)):
+    data = await file.read()
+    await _delay(data, ASR_LATENCY_MS, ASR_JITTER_MS)
+    if data.startswith(TRANSCRIPT_PREFIX):
+        text = data[len(TRANSCRIPT_PREFIX):].decode("utf-8", "replace").strip()
+    else:
+        text = TRANSCRIPTS[_digest(data) % len(TRANSCRIPTS)]
+    return {"transcript": text, "confidence": 0.9, "language": "en"}
+
+
+def main():
+    global LLM_LATENCY_MS, LLM_JITTER_MS, LLM_CHUNK_MS, ASR_LATENCY_MS, ASR_JITTER_MS
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--llm-latency-ms", type=float, default=LLM_LATENCY_MS)
+    ap.add_argument("--llm-jitter-ms", type=float, default=LLM_JITTER_MS)
+    ap.add_argument("--llm-chunk-ms", type=float, default=LLM_CHUNK_MS)
+    ap.add_argument("--asr-latency-ms", type=float, default=ASR_LATENCY_MS)
+    ap.add_argument("--asr-jitter-ms", type=float, default=ASR_JITTER_MS)
+    a = ap.parse_args()
+    LLM_LATENCY_MS, LLM_JITTER_MS, LLM_CHUNK_MS = a.llm_latency_ms, a.llm_jitter_ms, a.llm_chunk_ms
+    ASR_LATENCY_MS, ASR_JITTER_MS = a.asr_latency_ms, a.asr_jitter_ms
+
+    import uvicorn
+    uvicorn.run(app, host=a.host, port=a.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+End-to-end load driver for the patient/clinician closed loop.
+
+Simulates N patients (text + audio messages, optional polling, one thread WebSocket each)
+and M clinicians (ticket queue polling, ticket detail, replies, one clinic WebSocket each),
+then reports throughput and p50/p95/p99 per endpoint plus realtime delivery latency.
+
+By default it starts everything itself: the fake upstreams (bench.fakes) and the app on a
+fresh SQLite file. Point it at a local MySQL with --database-url, or at an already
+running stack with --base-url.
+
+    python -m bench.load --patients 50 --clinicians 5 --duration 60 --out run.json
+    python -m bench.load --patients 50 --clinicians 5 --duration 60 --baseline run.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import websockets
+
+from .fakes import TRANSCRIPT_PREFIX
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENIGN = [
+    "I have a headache since yesterday.",
+    "I take ibuprofen for my back pain.",
+    "I stopped taking ibuprofen last week.",
+    "I have a rash on my arm. I take Zyrtec.",
+    "I am allergic to penicillin.",
+    "My chief complaint is a sore throat.",
+    "I have a cough that started three days ago.",
+]
+MEDIUM = ["My headache is getting worse.", "I have a high fever and feel dizzy."]
+HIGH = ["I have crushing chest pain radiating to my arm.", "I feel short of breath and have shortness of breath."]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def add(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+    def error(self, name: str):
+        self.errors[name] += 1
+
+    async def request(self, client: httpx.AsyncClient, name: str, method: str, url: str, **kw) -> Optional[httpx.Response]:
+        t0 = time.perf_counter()
+        try:
+            r = await client.request(method, url, **kw)
+        except httpx.HTTPError:
+            self.error(name)
+            return None
+        self.add(name, time.perf_counter() - t0)
+        if r.status_code >= 400:
+            self.error(name)
+            return None
+        return r
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # nearest-rank
+    if not sorted_values:
+        return 0.0
+    k = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[k - 1]
+
+
+def summarize(rec: Recorder, elapsed: float) -> Dict[str, Dict[str, float]]:
+    out = {}
+    for name in sorted(set(rec.samples) | set(rec.errors)):
+        v = sorted(rec.samples.get(name, []))
+        out[name] = {
+            "count": len(v), "errors": rec.errors.get(name, 0), "rps": round(len(v) / elapsed, 2),
+            "p50_ms": round(percentile(v, 50) * 1000, 1), "p95_ms": round(percentile(v, 95) * 1000, 1),
+            "p99_ms": round(percentile(v, 99) * 1000, 1),
+            "max_ms": round((v[-1] if v else 0) * 1000, 1),
+        }
+    return out
+
+
+def ws_url(base: str, path: str) -> str:
+    return ("wss" if base.startswith("https") else "ws") + base[base.index(":"):] + path
+
+
+async def signup(client: httpx.AsyncClient, rec: Recorder, email: str, role: str) -> Dict:
+    r = await rec.request(client, "POST /api/auth/signup", "POST", "/api/auth/signup",
+                          json={"email": email, "password": "password", "role": role})
+    if r is None:
+        raise RuntimeError(f"signup failed for {email}")
+    return r.json()
+
+
+class Run:
+    def __init__(self, args, base_url: str):
+        self.a = args
+        self.base = base_url.rstrip("/")
+        self.rec = Recorder()
+        self.deadline = 0.0
+        self.run_id = uuid.uuid4().hex[:8]
+        # patient_id -> 最近一次风险消息的发送时间；clinic WS 收到对应 ticket 事件时算送达延迟
+        self.risky_sent: Dict[int, float] = {}
+
+    def alive(self) -> bool:
+        return time.perf_counter() < self.deadline
+
+    async def patient(self, i: int, client: httpx.AsyncClient):
+        rnd = random.Random(self.a.seed * 1000003 + i)
+        me = await signup(client, self.rec, f"load-p{i}-{self.run_id}@bench.example.com", "patient")
+        token, uid = me["token"], me["user"]["id"]
+        r = await self.rec.request(client, "GET /api/patient/thread", "GET", "/api/patient/thread",
+                                   params={"token": token})
+        thread_id = r.json()["thread_id"]
+        pending: Dict[str, float] = {}
+        waiting_reply: List[float] = []
+
+        async def listen():
+            try:
+                async with websockets.connect(ws_url(self.base, f"/ws/thread/{thread_id}?token={token}")) as ws:
+                    async for raw in ws:
+                        now = time.perf_counter()
+                        m = json.loads(raw)
+                        if m.get("type") != "thread_update":
+                            continue
+                        for msg in m.get("messages") or []:
+                            if msg.get("sender_role") == "patient":
+                                for marker in [k for k in pending if k in (msg.get("content") or "")]:
+                                    self.rec.add("ws patient echo", now - pending.pop(marker))
+                            elif msg.get("sender_role") == "assistant" and waiting_reply:
+                                self.rec.add("ws assistant reply", now - waiting_reply.pop(0))
+            except (OSError, websockets.WebSocketException):
+                self.rec.error("ws thread connect")
+
+        async def poll():
+            while self.alive():
+                await asyncio.sleep(self.a.poll_interval)
+                await self.rec.request(client, "GET /api/patient/messages", "GET", "/api/patient/messages",
+                                       params={"token": token})
+
+        listener = asyncio.create_task(listen())
+        poller = asyncio.create_task(poll()) if self.a.poll_interval > 0 else None
+        n = 0
+        while self.alive():
+            await asyncio.sleep(rnd.expovariate(1000 / self.a.think_ms) if self.a.think_ms > 0 else 0)
+            if not self.alive():
+                break
+            n += 1
+            roll = rnd.random()
+            pool = HIGH if roll < self.a.high_ratio else MEDIUM if roll < self.a.high_ratio * 3 else BENIGN
+            # 消息里带唯一标记，WS 回推时据此配对
+            marker = f"[{self.run_id}-{i}-{n}]"
+            text = f"{rnd.choice(pool)} {marker}"
+            t0 = time.perf_counter()
+            pending[marker] = t0
+            waiting_reply.append(t0)
+            if pool is not BENIGN:
+                self.risky_sent[uid] = t0
+            if rnd.random() < self.a.audio_ratio:
+                await self.rec.request(client, "POST /api/patient/message_audio", "POST", "/api/patient/message_audio",
+                                       params={"token": token},
+                                       files={"file": ("clip.wav", TRANSCRIPT_PREFIX + text.encode(), "audio/wav")})
+            else:
+                await self.rec.request(client, "POST /api/patient/message", "POST", "/api/patient/message",
+                                       params={"token": token}, json={"text": text})
+        await asyncio.sleep(self.a.drain_s)
+        listener.cancel()
+        if poller:
+            poller.cancel()
+
+    async def clinician(self, i: int, client: httpx.AsyncClient):
+        rnd = random.Random(self.a.seed * 7919 + i)
+        me = await signup(client, self.rec, f"load-c{i}-{self.run_id}@bench.example.com", "clinician")
+        token, clinic_id = me["token"], me["user"]["clinic_id"]
+        seen: Dict[int, float] = {}
+
+        async def listen():
+            try:
+                async with websockets.connect(ws_url(self.base, f"/ws/clinic/{clinic_id}?token={token}")) as ws:
+                    async for raw in ws:
+                        now = time.perf_counter()
+                        m = json.loads(raw)
+                        t = m.get("ticket") or {}
+                        sent = self.risky_sent.get(t.get("patient_id"))
+                        if sent is not None and seen.get(t["patient_id"]) != sent:
+                            seen[t["patient_id"]] = sent
+                            self.rec.add("ws ticket event", now - sent)
+            except (OSError, websockets.WebSocketException):
+                self.rec.error("ws clinic connect")
+
+        listener = asyncio.create_task(listen())
+        while self.alive():
+            r = await self.rec.request(client, "GET /api/clinician/tickets", "GET", "/api/clinician/tickets",
+                                       params={"token": token})
+            tickets = r.json()["tickets"] if r is not None else []
+            if tickets and rnd.random() < 0.5:
+                t = rnd.choice(tickets[:10])
+                await self.rec.request(client, "GET /api/clinician/tickets/{ticket_id}", "GET",
+                                       f"/api/clinician/tickets/{t['id']}", params={"token": token})
+                if rnd.random() < self.a.reply_ratio:
+                    # 并发下别的 clinician 可能已关单，404 计入错误数但属预期
+                    await self.rec.request(client, "POST /api/clinician/reply", "POST", "/api/clinician/reply",
+                                           params={"token": token},
+                                           json={"ticket_id": t["id"], "text": "Please call the clinic now."})
+            await asyncio.sleep(self.a.clinician_poll_interval)
+        await asyncio.sleep(self.a.drain_s)
+        listener.cancel()
+
+    async def run(self) -> Dict:
+        limits = httpx.Limits(max_connections=self.a.max_connections, max_keepalive_connections=self.a.max_connections)
+        async with httpx.AsyncClient(base_url=self.base, timeout=120, limits=limits) as client:
+            self.deadline = time.perf_counter() + self.a.duration
+            t0 = time.perf_counter()
+            await asyncio.gather(*[self.patient(i, client) for i in range(self.a.patients)],
+                                 *[self.clinician(i, client) for i in range(self.a.clinicians)])
+            elapsed = time.perf_counter() - t0 - self.a.drain_s
+        results = summarize(self.rec, elapsed)
+        realtime = {k: results.pop(k) for k in list(results) if k.startswith("ws ")}
+        return {"meta": {"run_id": self.run_id, "elapsed_s": round(elapsed, 2),
+                         "args": {k: v for k, v in vars(self.a).items() if k not in ("out", "baseline")}},
+                "endpoints": results, "realtime": realtime}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url: str, timeout: float = 60, interval: float = 0.2):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(interval)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_local(a) -> Tuple[str, List[subprocess.Popen], float]:
+    fakes_port, app_port = free_port(), free_port()
+    fakes = subprocess.Popen([sys.executable, "-m", "bench.fakes", "--port", str(fakes_port),
+                              "--llm-latency-ms", str(a.llm_latency_ms), "--asr-latency-ms", str(a.asr_latency_ms)],
+                             cwd=ROOT)
+    fakes_url = f"http://127.0.0.1:{fakes_port}"
+    workdir = tempfile.mkdtemp(prefix="nightingale-bench-")
+    env = dict(os.environ,
+               DATABASE_URL=a.database_url or "sqlite+pysqlite:///" + os.path.join(workdir, "bench.db"),
+               OLLAMA_BASE_URL=fakes_url, LLM_BASE_URL=fakes_url, ASR_BASE_URL=fakes_url,
+               USE_LLM_TRIAGE="true", DB_AUTO_CREATE="true")
+    if a.workers > 1:
+        env.update(REALTIME_BACKPLANE="unix", REALTIME_BACKPLANE_DIR=os.path.join(workdir, "backplane"))
+    t0 = time.perf_counter()
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                            "--port", str(app_port), "--workers", str(a.workers), "--log-level", "warning"],
+                           cwd=ROOT, env=env)
+    procs = [fakes, app]
+    try:
+        wait_http(fakes_url + "/docs")
+        wait_http(f"http://127.0.0.1:{app_port}/readyz", interval=0.02)
+        # 冷启动：spawn uvicorn（含解释器启动和 import）到 /readyz 返回 200
+        cold_start_ms = round((time.perf_counter() - t0) * 1000, 1)
+    except Exception:
+        stop(procs)
+        raise
+    return f"http://127.0.0.1:{app_port}", procs, cold_start_ms
+
+
+def stop(procs: List[subprocess.Popen]):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        try:
+            p.wait(10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def delta(new: float, old: float) -> str:
+    if not old:
+        return ""
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def print_report(report: Dict, baseline: Optional[Dict]):
+    print(f"\nrun {report['meta']['run_id']}: {report['meta']['elapsed_s']}s")
+    hdr = f"{'':44} {'n':>6} {'err':>5} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8}"
+    for section in ("endpoints", "realtime"):
+        print(f"\n{hdr}  (ms)" + ("   Δp95  Δrps" if baseline else ""))
+        for name, s in report[section].items():
+            line = (f"{name:44} {s['count']:>6} {s['errors']:>5} {s['rps']:>7} "
+                    f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8}")
+            old = (baseline or {}).get(section, {}).get(name)
+            if old:
+                line += f"   {delta(s['p95_ms'], old['p95_ms']):>5} {delta(s['rps'], old['rps']):>5}"
+            print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base-url", help="target a running app instead of starting one locally")
+    ap.add_argument("--database-url", help="local mode: e.g. a local MySQL (default: fresh SQLite file)")
+    ap.add_argument("--workers", type=int, default=1, help="local mode: uvicorn workers")
+    ap.add_argument("--llm-latency-ms", type=float, default=200, help="local mode: fake Ollama latency")
+    ap.add_argument("--asr-latency-ms", type=float, default=400, help="local mode: fake ASR latency")
+    ap.add_argument("--patients", type=int, default=20)
+    ap.add_argument("--clinicians", type=int, default=3)
+    ap.add_argument("--duration", type=float, default=30, help="seconds of load")
+    ap.add_argument("--think-ms", type=float, default=1000, help="mean pause between a patient's messages")
+    ap.add_argument("--poll-interval", type=float, default=0, help="patient polling period in s (0 = WS only)")
+    ap.add_argument("--clinician-poll-interval", type=float, default=2)
+    ap.add_argument("--audio-ratio", type=float, default=0.2)
+    ap.add_argument("--high-ratio", type=float, default=0.05, help="share of high-risk messages (medium is 2x)")
+    ap.add_argument("--reply-ratio", type=float, default=0.3)
+    ap.add_argument("--max-connections", type=int, default=200)
+    ap.add_argument("--drain-s", type=float, default=2, help="wait for in-flight WS frames after the run")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="write the JSON report here")
+    ap.add_argument("--baseline", help="compare against an earlier JSON report")
+    a = ap.parse_args()
+
+    procs: List[subprocess.Popen] = []
+    base, cold_start_ms = a.base_url, None
+    if not base:
+        base, procs, cold_start_ms = start_local(a)
+        print(f"app ready {cold_start_ms} ms after spawn")
+    try:
+        report = asyncio.run(Run(a, base).run())
+    finally:
+        stop(procs)
+    report["meta"]["cold_start_ms"] = cold_start_ms
+
+    baseline = None
+    if a.baseline:
+        with open(a.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if a.out:
+        with open(a.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
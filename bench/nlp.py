@@ -0,0 +1,151 @@
+"""
+Microbenchmarks for the per-message NLP hot paths: assess_risk, redact_no_phi,
+extract_memory_facts and the three combined (what post_message runs).
+
+Reports messages/second per function and per message kind (see bench.corpus), and
+peak bytes allocated per call (tracemalloc). Results can be saved as a JSON baseline
+and later runs checked against it.
+
+    python -m bench.nlp                       # print
+    python -m bench.nlp --save                # write bench/baselines/nlp.json
+    python -m bench.nlp --check               # exit 1 on regression beyond --tolerance
+
+Baselines are machine-specific: regenerate them on the machine that runs --check.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from app.nlp.memory import extract_memory_facts
+from app.nlp.redaction import redact_no_phi
+from app.nlp.risk import assess_risk
+
+from .corpus import DEFAULT_MIX, KINDS, generate
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "nlp.json")
+
+
+def pipeline(text: str):
+    return assess_risk(text), redact_no_phi(text), extract_memory_facts(text)
+
+
+FUNCTIONS: Dict[str, Callable] = {
+    "assess_risk": assess_risk,
+    "redact_no_phi": redact_no_phi,
+    "extract_memory_facts": extract_memory_facts,
+    "pipeline": pipeline,
+}
+
+
+def throughput(fn: Callable, corpus: List[str], repeat: int) -> float:
+    # 取多轮中最快的一轮，减少调度噪声
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - t0)
+    return len(corpus) / best if best > 0 else float("inf")
+
+
+def alloc_per_call(fn: Callable, corpus: List[str]) -> float:
+    fn(corpus[0])  # 预热：正则编译缓存等一次性分配不计入
+    tracemalloc.start()
+    total = 0
+    try:
+        for text in corpus:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            fn(text)
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total / len(corpus)
+
+
+def run(n: int, seed: int, repeat: int, alloc_sample: int) -> Dict:
+    corpus = generate(n, seed)
+    by_kind = {k: generate(max(1, n // 10), seed + i + 1, {k: 1.0}) for i, k in enumerate(KINDS)}
+    results = {}
+    for name, fn in FUNCTIONS.items():
+        results[name] = {
+            "msgs_per_s": round(throughput(fn, corpus, repeat), 1),
+            "alloc_peak_bytes_per_call": round(alloc_per_call(fn, corpus[:alloc_sample]), 1),
+            "msgs_per_s_by_kind": {k: round(throughput(fn, c, repeat), 1) for k, c in by_kind.items()},
+        }
+    return {
+        "meta": {"n": n, "seed": seed, "repeat": repeat, "alloc_sample": alloc_sample, "mix": DEFAULT_MIX,
+                 "avg_chars": round(sum(map(len, corpus)) / len(corpus), 1),
+                 "python": sys.version.split()[0], "platform": platform.platform()},
+        "results": results,
+    }
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    problems = []
+    for name, new in report["results"].items():
+        old = baseline["results"].get(name)
+        if not old:
+            continue
+        if new["msgs_per_s"] < old["msgs_per_s"] * (1 - tolerance):
+            problems.append(f"{name}: {new['msgs_per_s']} msgs/s vs baseline {old['msgs_per_s']}")
+        if new["alloc_peak_bytes_per_call"] > old["alloc_peak_bytes_per_call"] * (1 + tolerance):
+            problems.append(f"{name}: {new['alloc_peak_bytes_per_call']} B/call vs baseline "
+                            f"{old['alloc_peak_bytes_per_call']}")
+    return problems
+
+
+def print_report(report: Dict, baseline: Dict = None):
+    m = report["meta"]
+    print(f"{m['n']} messages (seed={m['seed']}, avg {m['avg_chars']} chars), best of {m['repeat']}")
+    kinds = list(KINDS)
+    print(f"{'':22} {'msgs/s':>10} {'B/call':>9} " + " ".join(f"{k:>9}" for k in kinds))
+    for name, r in report["results"].items():
+        line = (f"{name:22} {r['msgs_per_s']:>10} {r['alloc_peak_bytes_per_call']:>9} "
+                + " ".join(f"{r['msgs_per_s_by_kind'][k]:>9}" for k in kinds))
+        old = (baseline or {}).get("results", {}).get(name)
+        if old:
+            line += f"   ({(r['msgs_per_s'] / old['msgs_per_s'] - 1) * 100:+.0f}% msgs/s)"
+        print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=5000, help="corpus size")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--alloc-sample", type=int, default=500, help="messages traced for allocation stats")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    ap.add_argument("--check", action="store_true", help="fail if worse than the baseline beyond --tolerance")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    a = ap.parse_args()
+
+    report = run(a.n, a.seed, a.repeat, a.alloc_sample)
+    baseline = None
+    if os.path.exists(a.baseline):
+        with open(a.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if a.save:
+        os.makedirs(os.path.dirname(a.baseline), exist_ok=True)
+        with open(a.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {a.baseline}")
+    if a.check:
+        if baseline is None:
+            sys.exit(f"no baseline at {a.baseline}; run with --save first")
+        problems = compare(report, baseline, a.tolerance)
+        for p in problems:
+            print("REGRESSION", p)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Microbenchmark for message serialization: a GET /messages page (PAGE messages plus the
+envelope) and a WebSocket thread_update frame, encoded
+
+  baseline   serialize_message dicts -> jsonable_encoder -> json.dumps (what JSONResponse did)
+  cold       app.fastjson with an empty message cache (every row encoded once)
+  warm       app.fastjson with every row already cached (repeat polls of the same thread)
+
+Messages are built in memory from bench.corpus, no database involved. Reports pages/second
+and the speedup over baseline.
+
+    python -m bench.serialize
+    python -m bench.serialize --page 200 --rounds 2000
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+
+from app.fastjson import FragmentCache, orjson, splice
+from app.main import serialize_message
+from app.models import Message
+
+from .corpus import generate
+
+ENVELOPE = {"older_before": None, "profile": {"allergies": ["penicillin"], "medications": ["metformin"]},
+            "profile_version": "abc123", "last_event_id": 0}
+
+
+def messages(n: int, seed: int) -> List[Message]:
+    t0 = datetime(2024, 3, 1, 9, 0)
+    out = []
+    for i, text in enumerate(generate(n, seed)):
+        role = "patient" if i % 2 == 0 else "assistant"
+        cites = [] if role == "patient" else [{"type": "message_span", "message_id": i, "start": 0, "end": 12}]
+        out.append(Message(id=i + 1, thread_id=1, sender_role=role, content=text, created_at=t0 + timedelta(minutes=i),
+                           risk_level="low" if role == "patient" else None,
+                           confidence=None if role == "patient" else "med", citations_json=cites))
+    return out
+
+
+def baseline_page(msgs: List[Message]) -> bytes:
+    body = dict(ENVELOPE, messages=[serialize_message(m) for m in msgs])
+    return json.dumps(jsonable_encoder(body), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def fast_page(cache: FragmentCache, msgs: List[Message]) -> bytes:
+    return splice(ENVELOPE, "messages", [cache.get(m.id, lambda m=m: serialize_message(m)) for m in msgs])
+
+
+def baseline_frame(msgs: List[Message]) -> bytes:
+    frame = {"type": "thread_update", "messages": [serialize_message(m) for m in msgs], "profile": None}
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def fast_frame(cache: FragmentCache, msgs: List[Message]) -> bytes:
+    frame = {"type": "thread_update", "profile": None}
+    return splice(frame, "messages", [cache.get(m.id, lambda m=m: serialize_message(m)) for m in msgs])
+
+
+def rate(fn: Callable[[], bytes], rounds: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        best = min(best, time.perf_counter() - t0)
+    return rounds / best if best > 0 else float("inf")
+
+
+def run(page: int, rounds: int, seed: int = 0, repeat: int = 3) -> Dict:
+    msgs = messages(page, seed)
+    # 三条路径结果必须等价
+    assert json.loads(baseline_page(msgs)) == json.loads(fast_page(FragmentCache(page), msgs))
+    assert json.loads(baseline_frame(msgs[:2])) == json.loads(fast_frame(FragmentCache(2), msgs[:2]))
+
+    warm = FragmentCache(page)
+    fast_page(warm, msgs)
+    results = {}
+    for name, base, cold, hot in (
+            ("page", lambda: baseline_page(msgs),
+             lambda: fast_page(FragmentCache(page), msgs), lambda: fast_page(warm, msgs)),
+            ("ws_frame", lambda: baseline_frame(msgs[-1:]),
+             lambda: fast_frame(FragmentCache(1), msgs[-1:]), lambda: fast_frame(warm, msgs[-1:]))):
+        n = rounds if name == "page" else rounds * page
+        r = {"baseline": rate(base, n, repeat), "cold": rate(cold, n, repeat), "warm": rate(hot, n, repeat)}
+        results[name] = {k: round(v, 1) for k, v in r.items()}
+        results[name]["warm_speedup"] = round(r["warm"] / r["baseline"], 2)
+        results[name]["cold_speedup"] = round(r["cold"] / r["baseline"], 2)
+    return {"meta": {"page": page, "rounds": rounds, "seed": seed, "repeat": repeat,
+                     "page_bytes": len(baseline_page(msgs)), "encoder": "orjson" if orjson else "json",
+                     "python": sys.version.split()[0]},
+            "results": results}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--page", type=int, default=50, help="messages per page")
+    ap.add_argument("--rounds", type=int, default=500, help="pages encoded per timing run")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=3)
+    a = ap.parse_args()
+
+    report = run(a.page, a.rounds, a.seed, a.repeat)
+    m = report["meta"]
+    print(f"{m['page']} messages/page ({m['page_bytes']} B), encoder {m['encoder']}, best of {m['repeat']}")
+    print(f"{'':10} {'baseline/s':>12} {'cold/s':>12} {'warm/s':>12} {'cold x':>8} {'warm x':>8}")
+    for name, r in report["results"].items():
+        print(f"{name:10} {r['baseline']:>12} {r['cold']:>12} {r['warm']:>12} "
+              f"{r['cold_speedup']:>8} {r['warm_speedup']:>8}")
+
+
+if __name__ == "__main__":
+    main()
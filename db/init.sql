@@ -63,11 +63,15 @@ CREATE TABLE IF NOT EXISTS tickets (
   risk_level ENUM('medium','high') NOT NULL,
   triage_summary_json JSON NOT NULL,
   profile_snapshot_json JSON NOT NULL,
+  escalation_count INT NOT NULL DEFAULT 1,
   created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updated_at DATETIME NULL,
+  triaged_at DATETIME NULL,
   closed_at DATETIME NULL,
   FOREIGN KEY (patient_id) REFERENCES users(id) ON DELETE CASCADE,
   FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE,
-  INDEX idx_tickets_clinic_status (clinic_id, status, created_at)
+  INDEX idx_tickets_clinic_status (clinic_id, status, created_at),
+  INDEX idx_tickets_thread_status (thread_id, status)
 ) ENGINE=InnoDB;
 
 CREATE TABLE IF NOT EXISTS audit_events (
@@ -90,3 +94,36 @@ CREATE TABLE IF NOT EXISTS request_fingerprints (
   last_seen DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
   UNIQUE KEY uniq_kind_hash (kind, fingerprint_hash)
 ) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  id BIGINT PRIMARY KEY AUTO_INCREMENT,
+  user_id BIGINT NOT NULL,
+  idem_key VARCHAR(128) NOT NULL,
+  request_hash CHAR(64) NOT NULL,
+  response_json JSON NULL,
+  created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE KEY uniq_user_idem_key (user_id, idem_key),
+  INDEX idx_idem_created (created_at)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS archive_segments (
+  id BIGINT PRIMARY KEY AUTO_INCREMENT,
+  kind ENUM('messages','audit_events') NOT NULL,
+  path VARCHAR(512) NOT NULL,
+  row_count INT NOT NULL,
+  id_min BIGINT NOT NULL,
+  id_max BIGINT NOT NULL,
+  key_min BIGINT NULL,
+  key_max BIGINT NULL,
+  created_min DATETIME NOT NULL,
+  created_max DATETIME NOT NULL,
+  archived_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_archive_kind_key (kind, key_min, key_max)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS clinic_shards (
+  clinic_id BIGINT PRIMARY KEY,
+  shard VARCHAR(64) NOT NULL,
+  status ENUM('active','moving') NOT NULL DEFAULT 'active',
+  updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB;
@@ -1,10 +1,15 @@
 
 import os
+import tempfile
 import pytest
 from fastapi.testclient import TestClient
 
-os.environ["DATABASE_URL"] = "sqlite+pysqlite:///:memory:"
+# 文件库：同步 engine（pysqlite）和 async engine（aiosqlite）需要看到同一份数据
+os.environ["DATABASE_URL"] = "sqlite+pysqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
 os.environ["USE_LLM_TRIAGE"] = "false"
+# 测试里不连真实 LLM：指向必然拒绝连接的端口，走兜底回复
+os.environ.setdefault("LLM_BASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("OLLAMA_BASE_URL", "http://127.0.0.1:9")
 
 from app.main import app
 from app.db import engine, Base, SessionLocal
@@ -25,3 +30,13 @@ def client():
     finally:
         db.close()
     yield c
+
+@pytest.fixture
+def query_budget():
+    """Assert an endpoint stayed within its SQL statement budget (X-DB-Queries from the middleware)."""
+    def check(response, budget):
+        used = int(response.headers["X-DB-Queries"])
+        assert used <= budget, (f"{response.request.method} {response.request.url.path} issued {used} SQL "
+                                f"statements, budget is {budget}")
+        return response
+    return check
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+from app.archive import catalog, archive_messages, archive_audit_events, query_audit_events
+from app.db import SessionLocal
+from app.models import Message, Thread, AuditEvent, ArchiveSegment
+
+def signup(client, email):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": "patient"})
+    assert r.status_code == 200
+    return r.json()["token"], r.json()["user"]["id"]
+
+def backdate(model, days, **filters):
+    db = SessionLocal()
+    try:
+        for row in db.query(model).filter_by(**filters).all():
+            row.created_at = row.created_at - timedelta(days=days)
+        db.commit()
+    finally:
+        db.close()
+
+def test_idle_thread_moves_to_archive_and_reads_fall_through(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(catalog, "directory", str(tmp_path))
+    token, uid = signup(client, "archive-1@test.example.com")
+    for text in ("I have a cough.", "I take Advil.", "I am allergic to nuts."):
+        client.post(f"/api/patient/message?token={token}", json={"text": text})
+    before = client.get(f"/api/patient/messages?token={token}").json()["messages"]
+    assert len(before) == 6
+
+    db = SessionLocal()
+    thread_id = db.query(Thread).filter_by(patient_id=uid).first().id
+    db.close()
+    backdate(Message, 400, thread_id=thread_id)
+    db = SessionLocal()
+    try:
+        assert archive_messages(db) == 6
+        assert db.query(Message).filter_by(thread_id=thread_id).count() == 0
+        seg = db.query(ArchiveSegment).filter_by(kind="messages").order_by(ArchiveSegment.id.desc()).first()
+        assert seg.key_min <= thread_id <= seg.key_max and (tmp_path / seg.path).exists()
+    finally:
+        db.close()
+
+    r = client.get(f"/api/patient/messages?token={token}").json()
+    assert [m["id"] for m in r["messages"]] == [m["id"] for m in before]
+    assert r["messages"][0]["content"] == before[0]["content"] and r["older_before"] is None
+
+    # 新消息进热表；翻页跨越热/冷两层
+    client.post(f"/api/patient/message?token={token}", json={"text": "It is better now."})
+    r = client.get(f"/api/patient/messages?token={token}&limit=3").json()
+    assert [m["content"] for m in r["messages"][1:2]] == ["It is better now."]
+    assert r["messages"][0]["id"] == before[-1]["id"] and r["older_before"] == before[-1]["id"]
+    page = client.get(f"/api/patient/messages?token={token}&limit=3&before={r['older_before']}").json()
+    assert [m["id"] for m in page["messages"]] == [m["id"] for m in before[2:5]]
+    last = client.get(f"/api/patient/messages?token={token}&limit=3&before={page['older_before']}").json()
+    assert [m["id"] for m in last["messages"]] == [m["id"] for m in before[:2]] and last["older_before"] is None
+
+def test_old_audit_events_are_archived_and_still_queryable(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(catalog, "directory", str(tmp_path))
+    _, uid = signup(client, "archive-2@test.example.com")
+    backdate(AuditEvent, 500, actor_user_id=uid)
+    db = SessionLocal()
+    try:
+        assert archive_audit_events(db) >= 1
+        assert db.query(AuditEvent).filter_by(actor_user_id=uid).count() == 0
+        events = query_audit_events(db, actor_user_id=uid)
+        assert [e.event_type for e in events] == ["signup"]
+        assert query_audit_events(db, actor_user_id=uid, since=datetime.utcnow() - timedelta(days=30)) == []
+    finally:
+        db.close()
+
+def test_catalog_sees_segments_archived_by_another_process(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(catalog, "directory", str(tmp_path))
+    token, uid = signup(client, "archive-3@test.example.com")
+    client.post(f"/api/patient/message?token={token}", json={"text": "I have a cough."})
+    assert len(client.get(f"/api/patient/messages?token={token}").json()["messages"]) == 2
+    db = SessionLocal()
+    thread_id = db.query(Thread).filter_by(patient_id=uid).first().id
+    db.close()
+    backdate(Message, 400, thread_id=thread_id)
+    # CLI 进程归档：本进程的目录缓存不会被 invalidate
+    monkeypatch.setattr(catalog, "invalidate", lambda: None)
+    db = SessionLocal()
+    try:
+        assert archive_messages(db) == 2
+    finally:
+        db.close()
+    assert len(client.get(f"/api/patient/messages?token={token}").json()["messages"]) == 2
@@ -0,0 +1,23 @@
+from app.assets import asset_cache
+
+def test_pages_and_fingerprinted_assets_are_cached_with_etags(client):
+    r = client.get("/patient", headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200 and r.headers["content-encoding"] == "gzip"
+    assert r.headers["cache-control"] == "no-cache" and "X-DB-Queries" not in r.headers
+    url = asset_cache.asset_url("patient.js")
+    assert url != "/static/patient.js" and url in r.text
+
+    js = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert js.status_code == 200 and "immutable" in js.headers["cache-control"]
+    assert "javascript" in js.headers["content-type"] and "content-encoding" not in js.headers
+    raw = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert raw.headers["content-encoding"] == "gzip" and raw.content == js.content  # httpx 自动解压
+
+    # 条件请求：304，且不经过 DB 中间件
+    for etag in (js.headers["etag"], raw.headers["etag"], "W/" + js.headers["etag"]):
+        r304 = client.get(url, headers={"If-None-Match": etag})
+        assert r304.status_code == 304 and r304.content == b"" and "X-DB-Queries" not in r304.headers
+    assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+    # 未登记的路径照常走应用
+    assert "X-DB-Queries" in client.get("/metrics").headers
@@ -0,0 +1,45 @@
+import json
+from fastapi.testclient import TestClient
+
+from bench import fakes
+from bench.load import percentile
+
+def test_fake_upstreams_are_deterministic_and_stream(monkeypatch):
+    monkeypatch.setattr(fakes, "LLM_LATENCY_MS", 0)
+    monkeypatch.setattr(fakes, "ASR_LATENCY_MS", 0)
+    monkeypatch.setattr(fakes, "LLM_CHUNK_MS", 0)
+    c = TestClient(fakes.app)
+    body = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "stream": False}
+    a = c.post("/api/chat", json=body).json()["message"]["content"]
+    assert a and a == c.post("/api/chat", json=body).json()["message"]["content"]
+
+    r = c.post("/api/generate", json={"model": "m", "prompt": "x"})
+    frames = [json.loads(ln) for ln in r.text.splitlines()]
+    assert frames[-1]["done"] and not frames[0]["done"]
+    assert "".join(f["response"] for f in frames) == c.post(
+        "/api/generate", json={"model": "m", "prompt": "x", "stream": False}).json()["response"]
+
+    r = c.post("/asr/transcribe", files={"file": ("a.wav", fakes.TRANSCRIPT_PREFIX + b" I feel dizzy.", "audio/wav")})
+    assert r.json()["transcript"] == "I feel dizzy."
+
+def test_percentile_nearest_rank():
+    v = [i / 100 for i in range(1, 101)]
+    assert percentile(v, 50) == 0.5 and percentile(v, 99) == 0.99 and percentile([], 95) == 0.0
+
+def test_nlp_corpus_is_seeded_and_benchmark_flags_regressions():
+    from bench.corpus import generate
+    from bench.nlp import compare, run
+
+    assert generate(50, seed=3) == generate(50, seed=3) != generate(50, seed=4)
+    report = run(n=40, seed=0, repeat=1, alloc_sample=5)
+    assert set(report["results"]) == {"assess_risk", "redact_no_phi", "extract_memory_facts", "pipeline"}
+    assert compare(report, report, 0.25) == []
+    slower = {"results": {k: dict(v, msgs_per_s=v["msgs_per_s"] * 2) for k, v in report["results"].items()}}
+    assert len(compare(report, slower, 0.25)) == 4
+
+def test_serialize_benchmark_paths_agree():
+    from bench.serialize import run
+
+    report = run(page=10, rounds=5, repeat=1)
+    assert set(report["results"]) == {"page", "ws_frame"}
+    assert all(r["warm"] > 0 and r["baseline"] > 0 for r in report["results"].values())
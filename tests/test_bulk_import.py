@@ -0,0 +1,102 @@
+import json
+
+from app.bulk_import import BulkImporter
+from app.db import SessionLocal
+from app.models import MemoryItem, Message, Thread, User
+
+def ndjson(*recs):
+    return "\n".join(json.dumps(r) for r in recs) + "\n"
+
+def login(client, email):
+    r = client.post("/api/auth/login", json={"email": email, "password": "password"})
+    assert r.status_code == 200
+    return r.json()["token"]
+
+def test_import_endpoint_streams_users_threads_and_messages(client):
+    clinician = login(client, "clinician@test.example.com")
+    body = ndjson(
+        {"type": "user", "email": "bulk-a@test.example.com", "role": "patient", "password": "password"},
+        {"type": "user", "email": "bulk-b@test.example.com", "role": "patient"},
+        {"type": "user", "email": "patient@test.example.com", "role": "patient", "password": "x"},  # 已存在
+        {"type": "thread", "patient_email": "bulk-a@test.example.com", "created_at": "2024-03-01T09:00:00"},
+        {"type": "message", "patient_email": "bulk-a@test.example.com", "sender_role": "patient",
+         "content": "I take Advil. My name is John Doe.", "created_at": "2024-03-01T09:01:00"},
+        {"type": "message", "patient_email": "bulk-a@test.example.com", "sender_role": "clinician",
+         "content": "Noted.", "created_at": "2024-03-01T09:02:00"},
+        {"type": "message", "patient_email": "bulk-b@test.example.com", "sender_role": "patient",
+         "content": "I stopped Advil last week", "created_at": "2024-03-02T09:00:00"},
+        {"type": "message", "patient_email": "nobody@test.example.com", "content": "hi"},
+        "not json",
+    )
+    r = client.post(f"/api/clinician/import?token={clinician}&nlp=true", content=body.replace('"not json"', "{oops"))
+    assert r.status_code == 200, r.text
+    rep = r.json()
+    assert (rep["users_created"], rep["users_skipped"], rep["threads_created"], rep["messages"]) == (2, 1, 2, 3)
+    assert rep["error_count"] == 2 and rep["memory_facts"] >= 2
+
+    # 导入的账号可直接登录，历史消息带 NLP 结果
+    patient = login(client, "bulk-a@test.example.com")
+    msgs = client.get(f"/api/patient/messages?token={patient}").json()
+    assert [m["sender_role"] for m in msgs["messages"]] == ["patient", "clinician"]
+    assert msgs["profile"]["medications"][0]["value"] == "Advil"
+    db = SessionLocal()
+    try:
+        m = db.query(Message).filter(Message.content.like("I take Advil%")).one()
+        assert "John Doe" not in m.redacted_for_llm
+        assert db.query(Thread).join(User, User.id == Thread.patient_id).filter(
+            User.email == "bulk-a@test.example.com").one().created_at.year == 2024
+    finally:
+        db.close()
+
+    assert client.post(f"/api/clinician/import?token={patient}", content=body).status_code == 403
+
+def test_importer_batches_without_nlp(client):
+    recs = [{"type": "user", "email": f"bulk-many-{i}@test.example.com", "role": "patient", "password_hash": "x:y"}
+            for i in range(25)]
+    recs += [{"type": "message", "patient_email": f"bulk-many-{i % 25}@test.example.com", "content": f"msg {i}"}
+             for i in range(100)]
+    batches = []
+    db = SessionLocal()
+    try:
+        with BulkImporter(db, 1001, batch_size=30, workers=2, progress=lambda r: batches.append(r.messages)) as imp:
+            rep = imp.run(ndjson(*recs).splitlines())
+        assert (rep.users_created, rep.threads_created, rep.messages, rep.error_count) == (25, 25, 100, 0)
+        assert len(batches) == 5 and batches == sorted(batches)
+        assert db.query(MemoryItem).join(User, User.id == MemoryItem.patient_id).filter(
+            User.email.like("bulk-many-%")).count() == 0
+    finally:
+        db.close()
+
+def test_bad_fields_are_reported_per_line(client):
+    clinician = login(client, "clinician@test.example.com")
+    body = ndjson(
+        {"type": "user", "email": ["bulk-bad@test.example.com"], "role": "patient"},
+        {"type": "user", "email": "bulk-badts@test.example.com", "role": "patient", "created_at": "yesterday"},
+        {"type": "user", "email": "bulk-good@test.example.com", "role": "patient", "password": "password"},
+        {"type": "message", "patient_email": "bulk-good@test.example.com", "content": "bad", "created_at": 5},
+        {"type": "message", "patient_email": {"x": 1}, "content": "bad"},
+        {"type": "message", "patient_email": "bulk-good@test.example.com", "content": ["bad"]},
+        {"type": "message", "patient_email": "bulk-good@test.example.com", "content": "I have a cough.",
+         "created_at": "2024-03-01T09:01:00Z"},
+    )
+    r = client.post(f"/api/clinician/import?token={clinician}", content=body)
+    assert r.status_code == 200, r.text
+    rep = r.json()
+    assert (rep["users_created"], rep["threads_created"], rep["messages"], rep["error_count"]) == (1, 1, 1, 5)
+    assert sorted(e["line"] for e in rep["errors"]) == [1, 2, 4, 5, 6]
+    patient = login(client, "bulk-good@test.example.com")
+    assert [m["content"] for m in client.get(f"/api/patient/messages?token={patient}").json()["messages"]] == [
+        "I have a cough."]
+
+def test_nlp_process_pool_is_shared_and_shut_down(client):
+    import app.bulk_import as bulk
+
+    pools = []
+    with SessionLocal() as db:
+        for _ in range(2):
+            with BulkImporter(db, 1001, nlp=True, workers=2) as imp:
+                pools.append(imp._nlp_pool)
+    assert pools[0] is pools[1] is bulk._nlp_pool
+    assert not pools[0]._shutdown_thread
+    bulk.shutdown_nlp_pool()
+    assert bulk._nlp_pool is None and pools[0]._shutdown_thread
@@ -0,0 +1,40 @@
+from sqlalchemy.orm import sessionmaker
+
+import app.db as dbmod
+
+def test_read_your_writes_routes_recent_writer_to_primary(monkeypatch):
+    replica = sessionmaker()
+    monkeypatch.setattr(dbmod, "ReadSessionLocal", replica)
+    monkeypatch.setattr(dbmod, "read_engine", object())
+    monkeypatch.setattr(dbmod, "_recent_writes", {})
+
+    assert dbmod.read_sessionmaker(42) is replica
+    dbmod.mark_write(42)
+    assert dbmod.read_sessionmaker(42) is dbmod.SessionLocal
+    assert dbmod.read_sessionmaker(43) is replica
+
+    monkeypatch.setattr(dbmod, "READ_YOUR_WRITES_S", -1)
+    dbmod.mark_write(42)
+    assert dbmod.read_sessionmaker(42) is replica
+
+def test_pool_stats_endpoint(client):
+    pools = client.get("/api/ops/db_pool").json()["pools"]
+    assert pools[0]["name"] == "primary"
+
+def test_async_pool_is_instrumented(tmp_path, monkeypatch, client):
+    import asyncio
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    pool_cls = type("TestAsyncQueuePool", (dbmod.TimedAsyncQueuePool,), {"stats": dbmod.PoolWaitStats("t_async")})
+    eng = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'a.db'}", poolclass=pool_cls)
+
+    async def run():
+        async with eng.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        await eng.dispose()
+    asyncio.run(run())
+    monkeypatch.setitem(dbmod.extra_engines, "t_async", eng.sync_engine)
+    row = {p["name"]: p for p in dbmod.pool_stats()}["t_async"]
+    assert row["checkouts"] == 1 and row["checked_out"] == 0 and row["timeouts"] == 0
+    assert 'nightingale_db_pool_checked_out{pool="t_async"} 0' in client.get("/metrics").text
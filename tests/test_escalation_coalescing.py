@@ -0,0 +1,55 @@
+def signup(client, email, role):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": role})
+    assert r.status_code == 200
+    return r.json()["token"]
+
+def test_risky_burst_attaches_to_open_ticket(client):
+    patient = signup(client, "storm-patient@test.example.com", "patient")
+    clinician = signup(client, "storm-clinician@test.example.com", "clinician")
+
+    first = client.post(f"/api/patient/message?token={patient}", json={"text": "My cough is getting worse."}).json()
+    second = client.post(f"/api/patient/message?token={patient}", json={"text": "Still getting worse today."}).json()
+    third = client.post(f"/api/patient/message?token={patient}", json={"text": "Now I have crushing chest pain."}).json()
+    assert first["ticket_id"] == second["ticket_id"] == third["ticket_id"]
+
+    t = client.get(f"/api/clinician/tickets/{first['ticket_id']}?token={clinician}").json()["ticket"]
+    assert t["risk_level"] == "high" and t["escalation_count"] == 3
+
+    client.post(f"/api/clinician/reply?token={clinician}", json={"ticket_id": t["id"], "text": "Calling you now."})
+    after = client.post(f"/api/patient/message?token={patient}", json={"text": "It is getting worse again."}).json()
+    assert after["ticket_id"] != t["id"]
+
+def test_concurrent_escalations_open_one_ticket_and_triage_outside_transaction(client, monkeypatch):
+    import asyncio
+    from app import services
+    from app.db import AsyncSessionLocal, SessionLocal
+    from app.models import Thread, Ticket, User
+
+    signup(client, "race-patient@test.example.com", "patient")
+    db = SessionLocal()
+    u = db.query(User).filter_by(email="race-patient@test.example.com").one()
+    th = Thread(patient_id=u.id, clinic_id=1001)
+    db.add(th)
+    db.commit()
+    uid, tid = u.id, th.id
+    db.close()
+
+    in_tx = []
+    async def slow_triage(db, patient_id, trigger, snap=None):
+        in_tx.append(db.in_transaction())
+        await asyncio.sleep(0.02)
+        return ["Trigger: " + trigger]
+    monkeypatch.setattr(services, "triage_summary", slow_triage)
+
+    async def one(text):
+        async with AsyncSessionLocal() as s:
+            t, created = await services.escalate(s, 1001, uid, tid, 1, "high", text, snap={})
+            return t.id, created
+    async def run():
+        return await asyncio.gather(one("chest pain"), one("worse"))
+    results = asyncio.run(run())
+    assert len({i for i, _ in results}) == 1 and sorted(c for _, c in results) == [False, True]
+    assert in_tx and not any(in_tx)
+    db = SessionLocal()
+    assert db.query(Ticket).filter_by(thread_id=tid).one().escalation_count == 2
+    db.close()
@@ -0,0 +1,39 @@
+import json
+
+from app.fastjson import FragmentCache, dumps, message_cache, splice
+
+def signup(client, email, role):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": role})
+    assert r.status_code == 200
+    return r.json()["token"]
+
+def test_splice_matches_plain_encoding_and_cache_is_bounded():
+    obj = {"a": 1, "b": "é", "c": None}
+    items = [{"id": 1, "x": "y"}, {"id": 2}]
+    assert json.loads(splice(obj, "items", [dumps(i) for i in items])) == dict(obj, items=items)
+    assert json.loads(splice(obj, "items", [])) == dict(obj, items=[])
+    cache, built = FragmentCache(2), []
+    for k in (1, 2, 1, 3, 1, 2):
+        cache.get(k, lambda k=k: built.append(k) or {"id": k})
+    # LRU：1 一直被访问，2 在插入 3 时被淘汰
+    assert built == [1, 2, 3, 2] and cache.hits == 2 and list(cache.items) == [1, 2]
+
+def test_message_poll_is_served_from_cached_fragments(client):
+    patient = signup(client, "fastjson-patient@test.example.com", "patient")
+    clinician = signup(client, "fastjson-clinician@test.example.com", "clinician")
+    client.post(f"/api/patient/message?token={patient}", json={"text": "I have a cough. I take Zyrtec."})
+    ticket_id = client.post(f"/api/patient/message?token={patient}",
+                            json={"text": "I have crushing chest pain."}).json()["ticket_id"]
+    r = client.get(f"/api/patient/messages?token={patient}")
+    assert r.headers["content-type"] == "application/json"
+    body = r.json()
+    assert [m["sender_role"] for m in body["messages"]][:2] == ["patient", "assistant"]
+    assert {"older_before", "profile", "profile_version", "last_event_id"} <= set(body)
+    hits = message_cache.hits
+    assert client.get(f"/api/patient/messages?token={patient}").json() == body
+    assert message_cache.hits - hits == len(body["messages"])
+
+    queue = client.get(f"/api/clinician/tickets?token={clinician}").json()
+    assert ticket_id in [t["id"] for t in queue["tickets"]] and "next_cursor" in queue
+    t = client.get(f"/api/clinician/tickets/{ticket_id}?token={clinician}").json()["ticket"]
+    assert t["id"] == ticket_id and t["status"] == "open"
@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+
+import app.main as main
+from fastapi.testclient import TestClient
+
+from app.db import SessionLocal
+from app.models import Ticket
+
+def signup(client, email):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": "patient"})
+    assert r.status_code == 200
+    return r.json()["token"], r.json()["user"]["id"]
+
+def ticket_count(patient_id):
+    db = SessionLocal()
+    try:
+        return db.query(Ticket).filter_by(patient_id=patient_id).count()
+    finally:
+        db.close()
+
+def test_retry_with_same_key_replays_first_response(client):
+    token, uid = signup(client, "idem-1@test.example.com")
+    body = {"text": "I have crushing chest pain."}
+    r1 = client.post(f"/api/patient/message?token={token}", json=body, headers={"Idempotency-Key": "k-1"})
+    r2 = client.post(f"/api/patient/message?token={token}", json=body, headers={"Idempotency-Key": "k-1"})
+    assert r1.status_code == r2.status_code == 200
+    assert r2.headers.get("Idempotent-Replayed") == "true"
+    assert r2.json() == r1.json()
+    assert ticket_count(uid) == 1
+
+    # body 字段也可以作为 key；换内容复用同一个 key 是错误
+    r3 = client.post(f"/api/patient/message?token={token}", json={"text": "other", "client_request_id": "k-1"})
+    assert r3.status_code == 422
+
+    msgs = client.get(f"/api/patient/messages?token={token}").json()["messages"]
+    assert [m["sender_role"] for m in msgs] == ["patient", "assistant"]
+
+def test_concurrent_duplicates_wait_for_the_first(client, monkeypatch):
+    token, _ = signup(client, "idem-2@test.example.com")
+    calls = []
+    real = main.handle_patient_message
+
+    async def slow(text, token, db):
+        calls.append(text)
+        await asyncio.sleep(0.2)
+        return await real(text, token, db)
+    monkeypatch.setattr(main, "handle_patient_message", slow)
+
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://t") as c:
+            return await asyncio.gather(*[
+                c.post(f"/api/patient/message?token={token}", json={"text": "I have a cough."},
+                       headers={"Idempotency-Key": "same"}) for _ in range(3)])
+    rs = asyncio.run(go())
+    assert len(calls) == 1
+    assert all(r.status_code == 200 for r in rs)
+    assert sum(r.headers.get("Idempotent-Replayed") == "true" for r in rs) == 2
+    assert rs[0].json() == rs[1].json() == rs[2].json()
+    msgs = client.get(f"/api/patient/messages?token={token}").json()["messages"]
+    assert [m["sender_role"] for m in msgs] == ["patient", "assistant"]
+
+def test_failed_first_attempt_releases_the_key(client, monkeypatch):
+    token, _ = signup(client, "idem-3@test.example.com")
+    real = main.handle_patient_message
+
+    async def boom(text, token, db):
+        raise RuntimeError("upstream down")
+    monkeypatch.setattr(main, "handle_patient_message", boom)
+    c = TestClient(main.app, raise_server_exceptions=False)
+    assert c.post(f"/api/patient/message?token={token}", json={"text": "hi"},
+                  headers={"Idempotency-Key": "retry-me"}).status_code == 500
+
+    monkeypatch.setattr(main, "handle_patient_message", real)
+    r = client.post(f"/api/patient/message?token={token}", json={"text": "hi"}, headers={"Idempotency-Key": "retry-me"})
+    assert r.status_code == 200 and "Idempotent-Replayed" not in r.headers
+
+def test_unavailable_store_fails_open(client, monkeypatch, caplog):
+    from sqlalchemy.exc import OperationalError
+    from app.idempotency import idempotency
+
+    token, uid = signup(client, "idem-4@test.example.com")
+
+    async def down(*a):
+        raise OperationalError("SELECT idempotency_keys", {}, Exception("no such table: idempotency_keys"))
+    monkeypatch.setattr(idempotency, "_claim_or_wait", down)
+    body = {"text": "I have crushing chest pain."}
+    r1 = client.post(f"/api/patient/message?token={token}", json=body, headers={"Idempotency-Key": "k-down"})
+    assert r1.status_code == 200 and "Idempotent-Replayed" not in r1.headers
+    assert "idempotency store unavailable" in caplog.text
+    # 进程内缓存仍然去重
+    r2 = client.post(f"/api/patient/message?token={token}", json=body, headers={"Idempotency-Key": "k-down"})
+    assert r2.headers.get("Idempotent-Replayed") == "true" and r2.json() == r1.json()
+    assert ticket_count(uid) == 1
@@ -0,0 +1,21 @@
+def signup(client, email, role):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": role})
+    assert r.status_code == 200
+    return r.json()["token"]
+
+def test_metrics_exposes_stage_and_route_histograms(client):
+    patient = signup(client, "metrics-patient@test.example.com", "patient")
+    client.get(f"/api/patient/messages?token={patient}")
+    r = client.post(f"/api/patient/message?token={patient}", json={"text": "I have crushing chest pain."})
+    assert r.status_code == 200
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    body = r.text
+    for s in ("assess_risk", "upsert_memory", "profile_snapshot", "escalate", "broadcast"):
+        assert f'nightingale_stage_seconds_count{{pipeline="message",stage="{s}"}}' in body
+    # 路由模板而不是具体 URL
+    assert 'route="/api/patient/message"' in body
+    assert 'nightingale_http_request_sql_statements_bucket{route="/api/patient/message"' in body
+    assert 'nightingale_ws_connections{channel="thread"} 0' in body
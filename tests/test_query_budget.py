@@ -0,0 +1,26 @@
+def signup(client, email, role):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": role})
+    assert r.status_code == 200
+    return r.json()["token"]
+
+def test_endpoint_query_budgets(client, query_budget):
+    patient = signup(client, "budget-patient@test.example.com", "patient")
+    clinician = signup(client, "budget-clinician@test.example.com", "clinician")
+    client.get(f"/api/patient/messages?token={patient}")  # 首次访问会建 thread
+
+    query_budget(client.post("/api/auth/login", json={"email": "budget-patient@test.example.com",
+                                                       "password": "password"}), 4)
+    # +1：归档目录的 max(id) 代际检查
+    query_budget(client.get(f"/api/patient/messages?token={patient}"), 6)
+    # 多条 fact 的消息：memory 只查一次，profile 快照只查一次
+    query_budget(client.post(f"/api/patient/message?token={patient}",
+                             json={"text": "I have a rash. I take Advil and I take Zyrtec. I am allergic to nuts."}), 14)
+    # +2：事务外预查 open ticket，加锁事务里 SELECT thread FOR UPDATE
+    r = query_budget(client.post(f"/api/patient/message?token={patient}",
+                                 json={"text": "I have crushing chest pain."}), 14)
+    ticket_id = r.json()["ticket_id"]
+    query_budget(client.post(f"/api/patient/message?token={patient}", json={"text": "It is getting worse."}), 10)
+    query_budget(client.get(f"/api/clinician/tickets?token={clinician}"), 4)
+    query_budget(client.get(f"/api/clinician/tickets/{ticket_id}?token={clinician}"), 3)
+    query_budget(client.post(f"/api/clinician/reply?token={clinician}",
+                             json={"ticket_id": ticket_id, "text": "Please go to the ED now."}), 11)
@@ -0,0 +1,246 @@
+import asyncio
+import json
+from app.realtime import ConnectionManager
+
+class FakeWS:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data):
+        if self.fail:
+            raise RuntimeError("broken pipe")
+        await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.closed = True
+
+def test_slow_consumer_does_not_block_others():
+    async def run():
+        m = ConnectionManager(queue_max=2, send_timeout=0.05)
+        fast, slow = FakeWS(), FakeWS(delay=10)
+        await m.connect_clinic(1, fast)
+        await m.connect_clinic(1, slow)
+        for i in range(5):
+            await m.broadcast_clinic(1, {"n": i})
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.1)
+        return m, fast, slow
+    m, fast, slow = asyncio.run(run())
+    assert [json.loads(d)["n"] for d in fast.sent] == [0, 1, 2, 3, 4]
+    assert slow.closed and slow not in m.conns
+    assert list(m.clinic[1]) == [fast]
+
+def test_broken_socket_is_evicted_and_disconnect_is_idempotent():
+    async def run():
+        m = ConnectionManager()
+        bad = FakeWS(fail=True)
+        await m.connect_clinic(7, bad)
+        await m.broadcast_clinic(7, {"type": "ticket_created"})
+        await asyncio.sleep(0.01)
+        await m.disconnect(bad)
+        return m
+    m = asyncio.run(run())
+    assert m.clinic == {} and m.conns == {}
+
+def test_unix_backplane_reaches_other_worker(tmp_path):
+    from app.backplane import UnixSocketBackplane
+
+    async def run():
+        a = ConnectionManager(backplane=UnixSocketBackplane(str(tmp_path)))
+        b = ConnectionManager(backplane=UnixSocketBackplane(str(tmp_path)))
+        await a.start()
+        await b.start()
+        on_a, on_b = FakeWS(), FakeWS()
+        await a.connect_clinic(3, on_a)
+        await b.connect_clinic(3, on_b)
+        await a.broadcast_clinic(3, {"type": "ticket_created", "n": 1})
+        await asyncio.sleep(0.05)
+        await a.backplane.close()
+        await b.backplane.close()
+        return on_a, on_b
+    on_a, on_b = asyncio.run(run())
+    assert [json.loads(d)["n"] for d in on_a.sent] == [1]
+    assert [json.loads(d)["n"] for d in on_b.sent] == [1]
+
+def test_dropped_backplane_frame_resets_peers(tmp_path):
+    from app.backplane import UnixSocketBackplane
+    from app.metrics import BACKPLANE_DROPPED
+
+    async def run():
+        a = ConnectionManager(backplane=UnixSocketBackplane(str(tmp_path)), coalesce_ms=0)
+        b = ConnectionManager(backplane=UnixSocketBackplane(str(tmp_path)), coalesce_ms=0)
+        await a.start()
+        await b.start()
+        assert 0 < a.backplane.max_frame < 16 * 1024 * 1024
+        on_b = FakeWS()
+        await b.connect_clinic(3, on_b)
+        await a.broadcast_clinic(3, {"type": "ticket_created", "n": 1})
+        await asyncio.sleep(0.05)
+        first = json.loads(on_b.sent[0])["id"]
+        a.backplane.max_frame = 200
+        await a.broadcast_clinic(3, {"type": "ticket_created", "n": 2, "pad": "x" * 500})
+        await asyncio.sleep(0.05)
+        late = FakeWS()
+        await b.connect_clinic(3, late, last_event_id=first)
+        await asyncio.sleep(0.05)
+        await a.backplane.close()
+        await b.backplane.close()
+        return on_b, late
+    dropped = BACKPLANE_DROPPED.series.get(("too_large",), 0)
+    on_b, late = asyncio.run(run())
+    assert [json.loads(d)["type"] for d in on_b.sent] == ["ticket_created", "reset"]
+    assert [json.loads(d)["type"] for d in late.sent] == ["reset"]
+    assert BACKPLANE_DROPPED.series[("too_large",)] == dropped + 1
+
+def test_thread_burst_is_coalesced_into_one_frame():
+    from app.profile_delta import ProfileVersions
+
+    pv = ProfileVersions()
+    snap1 = {"chief_complaint": "a cough", "symptoms": [{"value": "a cough", "timeline": None, "prov": {}}],
+             "medications": [], "allergies": []}
+    snap2 = dict(snap1, medications=[{"value": "Advil", "status": "active", "timeline": None, "prov": {}}])
+
+    async def run():
+        m = ConnectionManager(coalesce_ms=20)
+        ws = FakeWS()
+        await m.connect_thread(9, ws)
+        await m.broadcast_thread(9, {"type": "new_message", "message": {"id": 1}, "profile": pv.delta(5, snap1)})
+        await m.broadcast_thread(9, {"type": "new_message", "message": {"id": 2}, "profile": pv.delta(5, snap2),
+                                     "escalation_required": True, "ticket_id": 4})
+        await m.broadcast_thread(9, {"type": "new_message", "message": {"id": 3}, "profile": pv.delta(5, snap2),
+                                     "escalation_required": True, "ticket_id": 4})
+        await asyncio.sleep(0.1)
+        return ws
+    ws = asyncio.run(run())
+    assert len(ws.sent) == 1
+    frame = json.loads(ws.sent[0])
+    assert frame["type"] == "thread_update"
+    assert [x["id"] for x in frame["messages"]] == [1, 2, 3]
+    assert frame["profile"]["base"] is None
+    assert set(frame["profile"]["set"]) == {"chief_complaint", "symptom:a cough", "medication:Advil"}
+    assert frame["escalation_required"] is True and frame["ticket_id"] == 4
+
+def test_escalation_flag_survives_a_later_plain_message():
+    from app.realtime import merge_thread_events
+
+    frame = merge_thread_events([{"type": "new_message", "message": {"id": 1}, "escalation_required": True,
+                                  "ticket_id": 4},
+                                 {"type": "new_message", "message": {"id": 2}}])
+    assert frame["escalation_required"] is True and frame["ticket_id"] == 4
+
+def test_profile_delta_only_carries_changes():
+    from app.profile_delta import ProfileVersions
+
+    pv = ProfileVersions()
+    snap = {"chief_complaint": None, "symptoms": [], "medications": [
+        {"value": "Advil", "status": "active", "timeline": None, "prov": {}}], "allergies": []}
+    first = pv.delta(1, snap)
+    same = pv.delta(1, snap)
+    assert same["base"] == same["version"] == first["version"] and not same["set"] and not same["del"]
+    stopped = dict(snap, medications=[{"value": "Advil", "status": "stopped", "timeline": "last week", "prov": {}}],
+                   allergies=[{"value": "penicillin", "prov": {}}])
+    d = pv.delta(1, stopped)
+    assert d["base"] == first["version"]
+    assert set(d["set"]) == {"medication:Advil", "allergy:penicillin"}
+
+def test_resume_replays_only_missed_events():
+    async def run():
+        m = ConnectionManager(coalesce_ms=0)
+        first = FakeWS()
+        await m.connect_clinic(2, first)
+        for i in range(3):
+            await m.broadcast_clinic(2, {"type": "ticket_created", "ticket_id": i})
+        await asyncio.sleep(0.01)
+        seen = [json.loads(d) for d in first.sent]
+        await m.disconnect(first)
+        await m.broadcast_clinic(2, {"type": "ticket_created", "ticket_id": 3})
+        again = FakeWS()
+        await m.connect_clinic(2, again, last_event_id=seen[0]["id"])
+        await asyncio.sleep(0.01)
+        return seen, again
+    seen, again = asyncio.run(run())
+    assert [e["id"] for e in seen] == sorted(e["id"] for e in seen)
+    assert [json.loads(d)["ticket_id"] for d in again.sent] == [1, 2, 3]
+
+def test_resume_past_buffer_gets_reset_and_idle_gets_heartbeat():
+    from app.realtime import ReplayBuffer
+
+    async def run():
+        m = ConnectionManager(coalesce_ms=0, heartbeat_s=0.02, replay=ReplayBuffer(size=2))
+        old_id = m.last_event_id("thread", 5)
+        for i in range(3):
+            await m.broadcast_thread(5, {"type": "new_message", "message": {"id": i}})
+        ws = FakeWS()
+        await m.connect_thread(5, ws, last_event_id=old_id)
+        await asyncio.sleep(0.05)
+        return ws
+    ws = asyncio.run(run())
+    types = [json.loads(d)["type"] for d in ws.sent]
+    assert types[0] == "reset" and "heartbeat" in types[1:]
+
+def test_replay_ring_is_bounded_by_bytes_age_and_subscribers():
+    from app.realtime import ReplayBuffer
+
+    r = ReplayBuffer(size=100, max_age_s=1, max_bytes=10)
+    s, idle = ("thread", 1), ("thread", 2)
+    r.subscribe(s)
+    t = r.next_id()
+    for i in range(5):
+        r.record(s, t + i, "abcd")
+    r.record(idle, t + 5, "nobody listens")
+    assert idle not in r.streams and r.since(idle, t) is None
+    # 10 字节只放得下两帧
+    assert r.since(s, t + 2) == ["abcd", "abcd"] and r.since(s, t + 1) is None
+    r.record(s, t + 2_000_000, "late")
+    assert r.since(s, t + 3) is None and r.since(s, t + 4) == ["late"]
+    # 断线后在窗口内还能补发，之后停止记录
+    r.unsubscribe(s)
+    r.record(s, t + 2_500_000, "gone")
+    assert r.since(s, t + 2_000_000) == ["gone"]
+    r.record(s, t + 4_000_000, "later")
+    assert s not in r.streams and r.since(s, t + 2_500_000) is None
+
+def test_patient_socket_receives_update_from_async_post(client):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    # 同一个 portal：HTTP 请求和 WebSocket 跑在同一个事件循环里
+    with TestClient(app) as c:
+        token = c.post("/api/auth/login", json={"email": "patient@test.example.com", "password": "password"}).json()["token"]
+        thread_id = c.get(f"/api/patient/thread?token={token}").json()["thread_id"]
+        with c.websocket_connect(f"/ws/thread/{thread_id}?token={token}") as ws:
+            c.post(f"/api/patient/message?token={token}", json={"text": "I have a sore throat."})
+            frames = [ws.receive_json()]
+            while len([m for f in frames for m in f["messages"]]) < 2:
+                frames.append(ws.receive_json())
+    assert all(f["type"] == "thread_update" for f in frames)
+    assert [m["sender_role"] for f in frames for m in f["messages"]] == ["patient", "assistant"]
+    assert frames[0]["profile"]["version"]
+
+def test_shutdown_flushes_pending_bursts_before_closing_backplane(monkeypatch):
+    import app.main as main
+
+    calls = []
+    m = main.manager
+    monkeypatch.setattr(m, "coalesce_window", 60)
+
+    async def publish(channel, key, frame):
+        calls.append(("publish", key, [x["id"] for x in frame["messages"]]))
+
+    async def close():
+        calls.append(("close",))
+    monkeypatch.setattr(m, "_publish", publish)
+    monkeypatch.setattr(m.backplane, "close", close)
+
+    async def run():
+        await m.broadcast_thread(7, {"type": "new_message", "message": {"id": 1}})
+        await main.stop_realtime()
+    asyncio.run(run())
+    assert calls == [("publish", 7, [1]), ("close",)]
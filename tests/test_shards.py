@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from app.archive import catalog, archive_messages
+from app.bulk_import import BulkImporter
+from app.db import SessionLocal
+from app.models import ClinicShard, MemoryItem, Message, Ticket, User
+from app.security import hash_password
+from app.shards import ShardMoveError, init_shard, move_clinic, router
+
+def login(client, email):
+    r = client.post("/api/auth/login", json={"email": email, "password": "password"})
+    assert r.status_code == 200, r.text
+    return r.json()["token"]
+
+@pytest.fixture
+def shards(tmp_path):
+    from app.db import Base
+    b = router.add("b", f"sqlite+pysqlite:///{tmp_path / 'b.db'}")
+    init_shard(b)
+    # c 只建表不 init：id 计数器从 0 开始
+    c = router.add("c", f"sqlite+pysqlite:///{tmp_path / 'c.db'}")
+    Base.metadata.create_all(c.engine)
+    yield b, c
+    router.remove("b")
+    router.remove("c")
+    with SessionLocal() as db:
+        db.query(ClinicShard).delete()
+        db.commit()
+    router.invalidate()
+
+def count(shard, model, **filters):
+    with shard.SessionLocal() as db:
+        return db.query(model).filter_by(**filters).count()
+
+def test_requests_route_by_token_clinic(client, shards):
+    b, _ = shards
+    router.assign(2002, "b")
+    with b.SessionLocal() as db:
+        db.add(User(email="shard-b@test.example.com", password_hash=hash_password("password"), role="patient",
+                    clinic_id=2002))
+        db.commit()
+
+    token = login(client, "shard-b@test.example.com")
+    r = client.post(f"/api/patient/message?token={token}", json={"text": "I have a cough."})
+    assert r.status_code == 200
+    assert count(b, Message) == 2 and count(router.default, User, email="shard-b@test.example.com") == 0
+    with b.SessionLocal() as db:
+        assert min(m.id for m in db.query(Message)) > 10 ** 12  # b 的 id 区间
+    assert len(client.get(f"/api/patient/messages?token={token}").json()["messages"]) == 2
+    # default 分片的诊所不受影响
+    other = login(client, "patient@test.example.com")
+    assert client.get(f"/api/patient/thread?token={other}").status_code == 200
+
+    router.assign(2002, "b", "moving")
+    r = client.get(f"/api/patient/thread?token={token}")
+    assert r.status_code == 503 and r.headers["Retry-After"]
+
+def seed_clinic(client, monkeypatch, tmp_path, clinic_id):
+    lines = [json.dumps(r) for r in (
+        {"type": "user", "email": f"move-a-{clinic_id}@test.example.com", "role": "patient", "password": "password"},
+        {"type": "user", "email": f"move-b-{clinic_id}@test.example.com", "role": "patient", "password": "password"},
+        {"type": "message", "patient_email": f"move-b-{clinic_id}@test.example.com", "content": "I take Advil.",
+         "created_at": "2020-01-01T09:00:00"},
+        {"type": "message", "patient_email": f"move-b-{clinic_id}@test.example.com", "content": "I have a rash.",
+         "created_at": "2020-01-02T09:00:00"},
+    )]
+    with SessionLocal() as db, BulkImporter(db, clinic_id, nlp=True, workers=1) as imp:
+        imp.run(lines)
+    # b 的历史已归档；a 在热表里，并有一张 ticket
+    monkeypatch.setattr(catalog, "directory", str(tmp_path))
+    with SessionLocal() as db:
+        archive_messages(db)
+    token = login(client, f"move-a-{clinic_id}@test.example.com")
+    for text in ("I take metformin.", "I have crushing chest pain."):
+        assert client.post(f"/api/patient/message?token={token}", json={"text": text}).status_code == 200
+
+def test_move_clinic_copies_everything_and_switches(client, shards, monkeypatch, tmp_path):
+    b, _ = shards
+    seed_clinic(client, monkeypatch, tmp_path, 3003)
+    assert count(router.default, Ticket, clinic_id=3003) == 1
+
+    progress = []
+    report = move_clinic(3003, "b", batch=2, settle_s=0, progress=lambda t, n: progress.append(t))
+    assert report["copied"]["users"] == 2 and report["copied"]["tickets"] == 1
+    assert report["copied"]["archived_messages"] == 2 and report["copied"]["messages"] == 4
+    assert report["deleted"]["users"] == 2 and "memory_items" in progress
+    assert count(router.default, User, clinic_id=3003) == 0 and count(router.default, Ticket, clinic_id=3003) == 0
+    assert count(b, User, clinic_id=3003) == 2 and count(b, Message) == 6 and count(b, MemoryItem) >= 3
+    assert router.locate(3003) == ("b", "active")
+
+    # id 不变：迁移前签发的 token 继续可用，归档的历史也回到热表
+    token = login(client, "move-b-3003@test.example.com")
+    msgs = client.get(f"/api/patient/messages?token={token}").json()["messages"]
+    assert [m["content"] for m in msgs] == ["I take Advil.", "I have a rash."]
+    token = login(client, "move-a-3003@test.example.com")
+    assert client.post(f"/api/patient/message?token={token}", json={"text": "thanks"}).status_code == 200
+
+def test_move_refuses_to_break_target_id_range_and_rolls_back(client, shards, monkeypatch, tmp_path):
+    seed_clinic(client, monkeypatch, tmp_path, 4004)
+    with pytest.raises(ShardMoveError, match="id counter"):
+        move_clinic(4004, "c", settle_s=0)
+    _, c = shards
+    assert count(c, User) == 0 and count(router.default, User, clinic_id=4004) == 2
+    assert router.locate(4004) == ("default", "active")
+    token = login(client, "move-a-4004@test.example.com")
+    assert client.get(f"/api/patient/thread?token={token}").status_code == 200
+
+def test_bulk_import_skips_emails_registered_on_another_shard(client, shards):
+    b, _ = shards
+    with b.SessionLocal() as db:
+        db.add(User(email="bulk-elsewhere@test.example.com", password_hash=hash_password("password"),
+                    role="patient", clinic_id=2002))
+        db.commit()
+    recs = [{"type": "user", "email": "bulk-elsewhere@test.example.com", "role": "patient", "password_hash": "x:y"},
+            {"type": "user", "email": "bulk-here@test.example.com", "role": "patient", "password_hash": "x:y"}]
+    with SessionLocal() as db, BulkImporter(db, 1001) as imp:
+        rep = imp.run([json.dumps(r) for r in recs])
+        assert (rep.users_created, rep.users_skipped) == (1, 1)
+        assert db.query(User).filter_by(email="bulk-elsewhere@test.example.com").count() == 0
@@ -0,0 +1,114 @@
+import time
+
+from sqlalchemy import create_engine, inspect
+
+from app.db import Base
+from app.startup import expected_schema, schema_problems
+
+
+def wait_ready(client, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        r = client.get("/readyz")
+        if r.status_code == 200 or time.monotonic() > deadline:
+            return r
+        time.sleep(0.05)
+
+def test_init_sql_matches_models():
+    expected = expected_schema()
+    for table in Base.metadata.sorted_tables:
+        assert table.name in expected, table.name
+        assert {c.name for c in table.columns} == expected[table.name], table.name
+
+def test_schema_check_reports_missing_tables(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'empty.db'}")
+    with eng.connect() as conn:
+        problems = schema_problems(conn, expected_schema())
+    assert "missing table users" in problems
+
+def test_readyz_after_startup_and_healthz_skips_db(client):
+    with client:
+        r = client.get("/healthz")
+        assert r.status_code == 200 and r.json() == {"ok": True}
+        # 探针不经过 DB 中间件
+        assert "X-DB-Queries" not in r.headers
+
+        r = wait_ready(client)
+        assert r.status_code == 200, r.json()
+        body = r.json()
+        assert body["ready"] is True and body["cold_start_ms"] > 0
+        for name in ("db", "replica", "schema", "warmup", "db_ping"):
+            assert body["checks"][name]["status"] == "ok", (name, body["checks"][name])
+        # 测试环境里 LLM 指向拒绝连接的端口：只降级，不影响就绪
+        assert body["checks"]["ollama"]["critical"] is False
+
+        assert "nightingale_startup_ready_seconds " in client.get("/metrics").text
+
+def test_schema_mismatch_is_retried_and_readyz_pings_every_shard(client, monkeypatch):
+    from types import SimpleNamespace
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app import startup
+    from app.shards import router
+
+    real, calls = startup.expected_schema, []
+    def flaky(*a):
+        calls.append(1)
+        return {"migration_pending": {"id"}} if len(calls) == 1 else real(*a)
+    monkeypatch.setattr(startup, "expected_schema", flaky)
+    with client:
+        r = wait_ready(client)
+        assert r.status_code == 200, r.json()
+        assert r.json()["checks"]["schema"]["attempts"] >= 2
+
+        shards = router.all()
+        down = create_async_engine("sqlite+aiosqlite:////nonexistent-dir/down.db")
+        monkeypatch.setattr(router, "all", lambda: shards + [SimpleNamespace(name="down", async_engine=down)])
+        r = client.get("/readyz")
+        assert r.status_code == 503
+        ping = r.json()["checks"]["db_ping"]
+        assert ping["status"] == "failed" and ping["shards"]["down"]["status"] == "failed"
+        assert ping["shards"][shards[0].name]["status"] == "ok"
+
+def test_migrate_upgrades_an_older_database(tmp_path):
+    from sqlalchemy import text
+    from app.migrate import upgrade
+
+    eng = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(eng)
+    with eng.begin() as conn:
+        # 上一个版本的库：没有这些表和索引
+        for table in ("idempotency_keys", "archive_segments", "clinic_shards"):
+            conn.execute(text(f"DROP TABLE {table}"))
+        conn.execute(text("DROP INDEX idx_tickets_thread_status"))
+    with eng.begin() as conn:
+        assert len(upgrade(conn, dry_run=True)) == 4
+        assert len(upgrade(conn)) == 4
+        assert schema_problems(conn, expected_schema()) == []
+    with eng.begin() as conn:
+        assert upgrade(conn) == []
+    with eng.connect() as conn:
+        assert "idx_tickets_thread_status" in {i["name"] for i in inspect(conn).get_indexes("tickets")}
+
+def test_migrate_adds_ticket_columns_and_backfills(tmp_path):
+    from sqlalchemy import text
+    from app.migrate import upgrade
+
+    eng = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(eng)
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX idx_tickets_thread_status"))
+        for col in ("escalation_count", "updated_at", "triaged_at"):
+            conn.execute(text(f"ALTER TABLE tickets DROP COLUMN {col}"))
+        conn.execute(text(
+            "INSERT INTO tickets (clinic_id, patient_id, thread_id, status, triggering_message_id, risk_level,"
+            " triage_summary_json, profile_snapshot_json, created_at)"
+            " VALUES (1, 1, 1, 'open', 1, 'high', '{}', '{}', '2024-03-01 09:00:00')"))
+    with eng.begin() as conn:
+        sql = upgrade(conn)
+        assert sum(s.startswith("ALTER TABLE tickets ADD COLUMN") for s in sql) == 3
+        assert schema_problems(conn, expected_schema()) == []
+    with eng.connect() as conn:
+        row = conn.execute(text("SELECT escalation_count, updated_at, created_at, triaged_at FROM tickets")).one()
+        assert row[0] == 1 and row[1] == row[2] and row[3] is None
+    with eng.begin() as conn:
+        assert upgrade(conn) == []
@@ -0,0 +1,82 @@
+def signup(client, email, role):
+    r = client.post("/api/auth/signup", json={"email": email, "password": "password", "role": role})
+    assert r.status_code == 200
+    return r.json()["token"]
+
+def test_ticket_queue_pagination_and_detail(client):
+    clinician = signup(client, "queue-clinician@test.example.com", "clinician")
+    created = []
+    for i in range(3):
+        patient = signup(client, f"queue-patient{i}@test.example.com", "patient")
+        r = client.post(f"/api/patient/message?token={patient}", json={"text": "I have crushing chest pain."})
+        created.append(r.json()["ticket_id"])
+
+    first = client.get(f"/api/clinician/tickets?token={clinician}&limit=2").json()
+    assert [t["id"] for t in first["tickets"]][:2] == created[::-1][:2]
+    assert "profile_snapshot" not in first["tickets"][0] and "triage_summary" not in first["tickets"][0]
+    assert first["next_cursor"] == created[1]
+
+    second = client.get(f"/api/clinician/tickets?token={clinician}&limit=2&cursor={first['next_cursor']}").json()
+    assert created[0] == second["tickets"][0]["id"]
+
+    detail = client.get(f"/api/clinician/tickets/{created[2]}?token={clinician}").json()["ticket"]
+    assert detail["triage_summary"] and "profile_snapshot" in detail
+
+    assert client.post(f"/api/clinician/reply?token={clinician}",
+                       json={"ticket_id": created[2], "text": "Please call 995 now."}).status_code == 200
+    ids = [t["id"] for t in client.get(f"/api/clinician/tickets?token={clinician}&limit=100").json()["tickets"]]
+    assert created[2] not in ids and created[1] in ids
+
+def test_lagging_replica_does_not_hide_new_tickets(client, monkeypatch, tmp_path):
+    import shutil
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import app.db as dbmod
+    from app.ticket_index import ticket_index
+
+    clinician = signup(client, "lag-clinician@test.example.com", "clinician")
+    patient = signup(client, "lag-patient@test.example.com", "patient")
+    # 副本停在 ticket 创建之前
+    shutil.copy(dbmod.engine.url.database, tmp_path / "replica.db")
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    monkeypatch.setattr(dbmod, "ReadSessionLocal", sessionmaker(bind=replica))
+    monkeypatch.setattr(dbmod, "read_engine", replica)
+    ticket_id = client.post(f"/api/patient/message?token={patient}",
+                            json={"text": "I have crushing chest pain."}).json()["ticket_id"]
+
+    ticket_index.invalidate()
+    r = client.get(f"/api/clinician/tickets/{ticket_id}?token={clinician}")
+    assert r.status_code == 200 and r.json()["ticket"]["id"] == ticket_id
+    assert ticket_id in [t["id"] for t in client.get(f"/api/clinician/tickets?token={clinician}").json()["tickets"]]
+    assert client.get(f"/api/clinician/tickets/{ticket_id}?token={clinician}").status_code == 200
+    assert client.get(f"/api/clinician/tickets/999999?token={clinician}").status_code == 404
+    replica.dispose()
+
+def test_events_during_index_load_are_replayed():
+    from datetime import datetime
+    from types import SimpleNamespace
+    from app.ticket_index import OpenTicketIndex, ticket_summary
+
+    idx = OpenTicketIndex()
+
+    def row(i):
+        return SimpleNamespace(id=i, clinic_id=5, patient_id=1, thread_id=i, status="open", triggering_message_id=1,
+                               risk_level="high", triage_summary_json=["x"], escalation_count=1,
+                               created_at=datetime(2024, 3, 1), updated_at=None)
+
+    class DB:
+        def query(self, *cols):
+            return self
+
+        def filter(self, *a):
+            return self
+
+        def all(self):
+            # 快照读出的同时，其他请求新建了 3、关掉了 1
+            idx.add(ticket_summary(row(3)))
+            idx.remove(5, 1)
+            return [row(1), row(2)]
+
+    page, _ = idx.page(DB(), 5, 10)
+    assert [t["id"] for t in page] == [3, 2]
+    assert idx.loading == {}